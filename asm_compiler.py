@@ -1,14 +1,107 @@
 import argparse
+import json
+import logging
 import sys
 import os
+import build_cache
 import component
+import dataflow
+import datapack
+import layout
+import schem_writer
+from asm_decoder import Op, Kind, decode_line
+from events import EventSource
 
-class AssemblerCompiler:
-    def __init__(self):
-        self.EX = ["ADD", "SUB", "MUL", "DIV", "SET", "SHOW", "SAY", "CLR", "TAG", "SLF", "CALL", "RET", "IF", "ELSE", "GOTO", "VAR", "CMD"]
+log = logging.getLogger(__name__)
+
+# Op -> (name, players subcommand for an immediate, operation for a register, symbol)
+ARITHMETIC_FORMS = {
+    Op.ADD: ("ADD", "add", "+=", "+"),
+    Op.SUB: ("SUB", "remove", "-=", "-"),
+    Op.MUL: ("MUL", None, "*=", "*"),
+    Op.DIV: ("DIV", None, "/=", "/"),
+    Op.SET: ("SET", "set", "=", "="),
+}
+
+# IF comparison -> (execute keyword, score comparison)
+SCORE_COMPARE = {
+    ">": ("if", ">"),
+    "<": ("if", "<"),
+    "=": ("if", "="),
+    "!=": ("unless", "="),
+    "<=": ("if", "<="),
+    ">=": ("if", ">="),
+}
+
+# Objective holding the immediates that only exist as scores in game: each
+# value v is the fake player "#v" (see constants_needed)
+CONSTANTS_OBJECTIVE = "CONST"
+
+# Ops after which the next block is an impulse block (a return point)
+IMPULSE_NEXT = (Op.CALL, Op.ELSE)
+
+def operand_name(operand):
+    """Objective name of a decoded operand (immediates keep their ``#``)."""
+    kind, value = operand
+    return f"#{value}" if kind is Kind.IMM else value
+
+def score_holder(operand):
+    """``<holder> <objective>`` naming an operand's score; immediates read the constants scoreboard."""
+    kind, value = operand
+    return f"#{value} {CONSTANTS_OBJECTIVE}" if kind is Kind.IMM else f"REG {value}"
+
+def constants_needed(lines):
+    """Sorted immediates that must be set up as constants.
+
+    MUL and DIV have no ``scoreboard players`` form, ``players add`` and
+    ``remove`` reject negative amounts, IF compares two scores and SHOW
+    prints a score, so these immediates become constants.
+    """
+    constants = set()
+    for line in set(lines):
+        if "#" not in line:
+            continue
+        try:
+            ins = decode_line(line)
+        except ValueError:
+            continue
+        if ins.op is Op.MUL or ins.op is Op.DIV:
+            operands = (ins.b,)
+        elif ins.op is Op.ADD or ins.op is Op.SUB:
+            # players add/remove only take non-negative amounts
+            operands = (ins.b,) if ins.b[0] is Kind.IMM and ins.b[1] < 0 else ()
+        elif ins.op is Op.IF:
+            operands = (ins.a, ins.b)
+        elif ins.op is Op.SHOW:
+            operands = (ins.a,)
+        else:
+            continue
+        constants.update(value for kind, value in operands if kind is Kind.IMM)
+    return sorted(constants)
+
+class AssemblerCompiler(EventSource):
+    """Compiles assembly into a command_surface.
+
+    Subscribers (see events.EventSource) receive "label", "block", "wrap" and
+    "done" events while a surface is built, and compile_script forwards the
+    "export_block" and "saved" events of component.export_to_schematic.
+
+    ``stack_backend`` picks the call stack memory_setup builds, one of
+    component.STACK_BACKENDS.
+    """
+    def __init__(self, stack_backend="pile"):
+        super().__init__()
+        if stack_backend not in component.STACK_BACKENDS:
+            raise ValueError(f"Unknown stack backend: {stack_backend}")
+        self.stack_backend = stack_backend
         self.goto = {}
-        self.last_parts = None
-        self.temp = True
+        self.layout = None
+        self.last_if = None
+        # Report of the last compile_script with delta_origin (see component.export_delta)
+        self.delta_report = None
+        # Opcode -> emitter returning (command, log message)
+        self.emitters = {op: getattr(self, f"emit_{op.name.lower()}") for op in Op
+                         if hasattr(self, f"emit_{op.name.lower()}")}
         
     def read_script(self, input_file):
         """Read and parse the assembly script file."""
@@ -23,343 +116,285 @@ class AssemblerCompiler:
             print(f"Error reading file '{input_file}': {e}")
             sys.exit(1)
     
-    def setup_memory(self, stack_size, regex_size):
-        """Initialize command surface and registers."""
-        command_surface = component.memory_setup(stack_size=stack_size)
-        x, y = 1, 5
-        
-        command_surface[y][x] = component.CommandBlock("say start assembler ...", "")
-        x += 1
-        
-        # Setup registers
-        for i in range(regex_size):
-            command_surface[y][x] = component.CommandBlock(f"/scoreboard objectives add R{i} dummy")
-            command_surface[y][x+1] = component.CommandBlock(f"/scoreboard players set REG R{i} 0")
-            x += 2
-            
-        return command_surface, x, y
+    def setup_memory(self, stack_size, regex_size, constants=()):
+        """Initialize command surface, registers and the constants scoreboard.
 
-    def advance_position(self, x, y, mod, command_surface):
+        The setup commands start the chain at (5, 1) that the program
+        continues, wrapping onto the next rows like the program when they
+        do not fit on one. Returns the surface and the number of setup
+        blocks.
         """
-        Advance to the next position in the command surface.
-        Handles line wrapping and ensures enough rows exist.
-        
-        Args:
-            x: Current x position
-            y: Current y position
-            mod: Current direction (1 = right, -1 = left)
-            command_surface: The 2D grid of command blocks
-        
-        Returns:
-            tuple: (new_x, new_y, new_mod, new_orientation, wrap_pos)
-        """
-        x += mod
-        orientation = "south" if mod == 1 else "north"
-        
-        # Ensure we have enough rows
-        if y > len(command_surface) - 1:
-            component.add_line(command_surface)
-        
-        # Check if we need to wrap to next line
-        if len(command_surface[y]) <= x + 1 or x < 1:
-            # Store position for rotation blocks (this is where the turn happens)
-            turn_x = x
-            turn_y = y
-            
-            # Move to next line
-            y += 1             # Move to next row
-            mod = -mod         # Reverse direction
-            orientation = "south" if mod == 1 else "north"
-            
-            # Start at the beginning of new direction
-            # The x position stays at turn_x (where the rotation block is)
-            # Don't advance x here - we'll place rotation blocks at turn_x
-            
-            # Ensure new row exists
-            while y >= len(command_surface):
-                component.add_line(command_surface)
-            
-            return turn_x, y, mod, orientation, (turn_x, turn_y)
-        
-        return x, y, mod, orientation, None
+        command_surface = component.memory_setup(stack_size=stack_size, backend=self.stack_backend)
+        commands = ["say start assembler ..."]
+        for i in range(regex_size):
+            commands.append(f"/scoreboard objectives add R{i} dummy")
+            commands.append(f"/scoreboard players set REG R{i} 0")
+        if constants:
+            commands.append(f"/scoreboard objectives add {CONSTANTS_OBJECTIVE} dummy")
+            for value in constants:
+                commands.append(f"/scoreboard players set #{value} {CONSTANTS_OBJECTIVE} {value}")
+
+        setup = layout.SerpentineLayout(1, 5, command_surface.cols, skip=len(commands))
+        command_surface.ensure_rows(setup.rows_needed(0))
+        for index, (command, (y, x, orientation, turn)) in enumerate(zip(commands, setup.setup_blocks())):
+            command_surface[y, x] = component.CommandBlock(command, "chain" if index else "", orientation)
+            if turn:
+                self.place_turn(command_surface, turn)
+        return command_surface, len(commands)
+
+    def place_turn(self, command_surface, turn):
+        """Rotation block and the directional block below it, where a row of the chain ends."""
+        turn_y, turn_x, orientation = turn
+        # Place rotation block on this line at turn position
+        command_surface[turn_y, turn_x] = component.CommandBlock("", orientation="east")
+        # Place directional block on next line at same x position
+        command_surface[turn_y + 1, turn_x] = component.CommandBlock("", orientation=orientation)
+        log.debug("Line wrap at y=%s, turn_x=%s", turn_y + 1, turn_x)
+        if self.listeners:
+            self.notify("wrap", y=turn_y, x=turn_x, orientation=orientation)
 
-    def find_labels(self, script, command_surface, x, y):
+    def find_labels(self, script, command_surface, setup_size):
         """First pass: find all labels and their positions."""
-        w, z = x, y
-        print(y)
-        mod = 1
-        
-        for line in script:
-            if not line.strip():  # Skip empty lines
-                continue
-                
-            if line.startswith(":"):
-                label = line.split(":")[1].strip()
-                self.goto[label] = (z, w)
-                print(f"Label {label} found at ({z}, {w})")
-            
-            if line.split()[0] in self.EX or line.startswith(":"):
-                # Advance position
-                result = self.advance_position(w, z, mod, command_surface)
-                w, z, mod, orientation, wrap_pos = result
-                if wrap_pos:
-                    w+=mod
-            else:
-                print(f"Warning: Unknown command '{line}'")
+        self.layout = layout.SerpentineLayout(1, 5, command_surface.cols, skip=setup_size)
+        self.goto = self.layout.label_positions(script)
+        if self.listeners or log.isEnabledFor(logging.DEBUG):
+            for label, (z, w) in self.goto.items():
+                log.debug("Label %s found at (%s, %s)", label, z, w)
+                if self.listeners:
+                    self.notify("label", label=label, y=z, x=w)
 
     def compile_line(self, line, command_surface, x, y, chained, orientation, line_number=None):
         """Compile a single line of assembly code."""
-        #match line.split(" ")[0]
-        if line.startswith("ADD"):
-            parts = line.split()
-            if parts[2].startswith("#"):
-                parts[2] = parts[2].split("#")[1]
-                command_surface[y][x] = component.CommandBlock(f"/scoreboard players add REG {parts[1].replace(',', '')} {parts[2].replace(',', '')}", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            else:
-                command_surface[y][x] = component.CommandBlock(f"/scoreboard players operation REG {parts[1].replace(',', '')} += REG {parts[2].replace(',', '')}", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            print(f"Processed ADD: {parts[1].replace(',', '')} + {parts[2].replace(',', '')}")
-        
-        elif line.startswith("SUB"):
-            parts = line.split()
-            if parts[2].startswith("#"):
-                parts[2] = parts[2].split("#")[1]
-                command_surface[y][x] = component.CommandBlock(f"/scoreboard players remove REG {parts[1].replace(',', '')} {parts[2].replace(',', '')}", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            else:
-                command_surface[y][x] = component.CommandBlock(f"/scoreboard players operation REG {parts[1].replace(',', '')} -= REG {parts[2].replace(',', '')}", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            print(f"Processed SUB: {parts[1].replace(',', '')} - {parts[2].replace(',', '')}")
-        
-        elif line.startswith("MUL"):
-            parts = line.split()
-            if parts[2].startswith("#"):
-                raise ValueError("MUL command does not support immediate values")
-            else:
-                command_surface[y][x] = component.CommandBlock(f"/scoreboard players operation REG {parts[1].replace(',', '')} *= REG {parts[2].replace(',', '')}", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-                print(f"Processed MUL: {parts[1].replace(',', '')} * {parts[2].replace(',', '')}")
-        
-        elif line.startswith("SHOW"):
-            parts = line.split()
-            command_surface[y][x] = component.CommandBlock('/tellraw @a {"text":": ","color":"gold","extra":[{"score":{"name":"REG","objective":"'+parts[1].replace(',', '')+'"},"color":"aqua"}]}', "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            print(f"Processed SHOW: {parts[1].replace(',', '')}")
-        
-        elif line.startswith(":"):
-            label = line.split(":")[1].strip()
-            command_surface[y][x] = component.CommandBlock(f"setblock ~ ~1 ~ minecraft:air", "",orientation=orientation, source_line=line_number, source_code=line)
-            print(f"Label found: {label} at ({y}, {x})")
-        
-        elif line.startswith("GOTO"):
-            label = line.split()[1].strip().replace(":", "")
-            if label in self.goto:
-                target_y, target_x = self.goto[label]
-                command_surface[y][x] = component.CommandBlock(f"setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-                print(f"GOTO found: {label} at ({target_y}, {target_x})")
-            else:
-                raise ValueError(f"Error: GOTO label {label} not defined")
-        
-        elif line.startswith("SET"):
-            parts = line.split()
-            if parts[2].startswith("#"):
-                parts[2] = parts[2].split("#")[1]
-                command_surface[y][x] = component.CommandBlock(f"/scoreboard players set REG {parts[1].replace(',', '')} {parts[2].replace(',', '')}", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            else:
-                command_surface[y][x] = component.CommandBlock(f"/scoreboard players operation REG {parts[1].replace(',', '')} = REG {parts[2].replace(',', '')}", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
+        return self.compile_instruction(decode_line(line, line_number), command_surface, x, y, chained,
+                                        orientation, line_number)
 
-            print(f"Processed SET: {parts[1].replace(',', '')} = {parts[2].replace(',', '')}")
+    def compile_instruction(self, ins, command_surface, x, y, chained, orientation, line_number=None):
+        """Place the command block for one decoded instruction.
 
-        elif line.startswith("TAG"):
-            parts = line.split()
-            target_y, target_x = self.goto[parts[1].replace(":", "")]
-            command_surface[y][x] = component.CommandBlock(f"execute as @e[type=armor_stand,tag=temp_destination] run tp @s ~{target_y-y} ~1 ~{target_x-x}", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            print(f"TAG found: {parts[1].replace(':', '')} at ({target_y}, {target_x})")
-        
-        elif line.startswith("SLF"):
-            target_y, target_x = self.predict_pos(x,y,2,orientation,command_surface)
-            command_surface[y][x] = component.CommandBlock(f"execute as @e[type=armor_stand,tag=temp_origin] run tp @s ~{target_y-y} ~1 ~{target_x-x}", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-
-        elif line.startswith("CALL"):
-            command_surface[y][x] = component.CommandBlock(f"setblock ~{1-y} ~1 ~{1-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            self.temp = False
-
-        elif line.startswith("RET"):
-            command_surface[y][x] = component.CommandBlock(f"setblock ~{2-y} ~1 ~{0-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-        elif line.startswith("CMD"):
-            parts = line.split(" ",1)
-            command_surface[y][x] = component.CommandBlock(parts[1], "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            print(f"Processed CMD: {parts[1]}")
-        elif line.startswith("IF"):
-            parts = line.split()
-            self.last_parts = parts
-            op = parts[2]
-            target_y, target_x = self.goto[parts[4].replace(":", "")]
-            match op:
-                case ">":
-                    command_surface[y][x] = component.CommandBlock(f"execute if score REG {parts[1].replace(',', '')} > REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-                case "<":
-                    command_surface[y][x] = component.CommandBlock(f"execute if score REG {parts[1].replace(',', '')} < REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-                case "=":
-                    command_surface[y][x] = component.CommandBlock(f"execute if score REG {parts[1].replace(',', '')} = REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-                case "!=":
-                    command_surface[y][x] = component.CommandBlock(f"execute unless score REG {parts[1].replace(',', '')} = REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-                case "<=":
-                    command_surface[y][x] = component.CommandBlock(f"execute if score REG {parts[1].replace(',', '')} <= REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-                case ">=":
-                    command_surface[y][x] = component.CommandBlock(f"execute if score REG {parts[1].replace(',', '')} >= REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-                case _:
-                    raise ValueError(f"Unknown operator: {op}")
-            print(f"Processed IF: {parts[1].replace(',', '')} {op} {parts[3].replace(',', '')} GOTO {parts[4].replace(':', '')}")
-        
-        elif line.startswith("ELSE"):
-            target_y, target_x = self.predict_pos(x,y,1,orientation,command_surface)
-            parts = self.last_parts
-            op = parts[2]
-            if op == ">":
-                command_surface[y][x] = component.CommandBlock(f"execute unless score REG {parts[1].replace(',', '')} > REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            elif op == "<":
-                command_surface[y][x] = component.CommandBlock(f"execute unless score REG {parts[1].replace(',', '')} < REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            elif op == "=":
-                command_surface[y][x] = component.CommandBlock(f"execute unless score REG {parts[1].replace(',', '')} = REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            elif op == "!=":
-                command_surface[y][x] = component.CommandBlock(f"execute if score REG {parts[1].replace(',', '')} = REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            elif op == "<=":
-                command_surface[y][x] = component.CommandBlock(f"execute unless score REG {parts[1].replace(',', '')} <= REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            elif op == ">=":
-                command_surface[y][x] = component.CommandBlock(f"execute unless score REG {parts[1].replace(',', '')} >= REG {parts[3].replace(',', '')} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            self.temp = False
-        elif line.startswith("CLR"):
-            command_surface[y][x] = component.CommandBlock(f"setblock ~ ~1 ~ minecraft:air", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            print(f"Processed CLR at ({y}, {x})")
-        
-        elif line.startswith("SAY"):
-            parts = line.split()
-            if len(parts) > 1:
-                text = " ".join(parts[1:])
-                text = text.split("\"")[1]  # Ensure the text is properly formatted
-                text = text.replace("{","ùVAR:").replace("}","ù").split("ù")  # split the text to handle variables
-                command = "/tellraw @a ["
-                for part in text:
-                    if part.startswith("VAR:"):
-                        command += f'{{"score":{{"name":"REG","objective":"{part[4:]}"}},"color":"aqua"}},'
-                    else:
-                        command += f'{{"text":"{part}","color":"gold"}},'
-                command = command.rstrip(',') + ']'
-                command_surface[y][x] = component.CommandBlock(command, "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-                print(f"Processed SAY: {" ".join(parts[1:])}")
-            else:
-                raise ValueError("SAY command requires a message")
-        
-        elif line.startswith("DIV"):
-            parts = line.split()
-            if parts[2].startswith("#"):
-                raise ValueError("DIV command does not support immediate values")
-            else:
-                command_surface[y][x] = component.CommandBlock(f"/scoreboard players operation REG {parts[1].replace(',', '')} /= REG {parts[2].replace(',', '')}", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-                print(f"Processed DIV: {parts[1].replace(',', '')} / {parts[2].replace(',', '')}")
-        
-        elif line.startswith("VAR"):
-            parts = line.split()
-            if len(parts) != 2:
-                raise ValueError("VAR command requires a variable name")
-            var_name = parts[1].replace(",", "")
-            command_surface[y][x] = component.CommandBlock(f"/scoreboard objectives add {var_name} dummy", "" if not chained else "chain",orientation=orientation, source_line=line_number, source_code=line)
-            print(f"Processed VAR: {var_name}")
-        
-        else:
-            raise ValueError(f"Unknown command: {line}")
-        
+        Args:
+            ins: Instruction from asm_decoder.decode_line
+            command_surface: component.CommandSurface receiving the block
+            x: Column of the block
+            y: Row of the block
+            chained: False when the block must be an impulse block
+            orientation: Facing of the block
+            line_number: Source line recorded on the block
+
+        Returns:
+            bool: True once the block is placed
+        """
+        emitter = self.emitters.get(ins.op)
+        if emitter is None:
+            raise ValueError(f"Unknown command: {ins.text}")
+        command, message = emitter(ins, x, y)
+        block_type = "" if ins.op is Op.LABEL or not chained else "chain"
+        command_surface[y, x] = component.CommandBlock(command, block_type, orientation=orientation,
+                                                     source_line=line_number, source_code=ins.text)
+        if message is not None and log.isEnabledFor(logging.DEBUG):
+            log.debug(*message)
+        if self.listeners:
+            self.notify("block", y=y, x=x, command=command, type=block_type, orientation=orientation,
+                        line=line_number, source=ins.text)
         return True
-    
+
+    # Emitters return (command, message) for one instruction at (y, x), where
+    # message is None or logging arguments, only formatted when DEBUG is on
+
+    def emit_arithmetic(self, ins, x, y):
+        name, immediate, operation, symbol = ARITHMETIC_FORMS[ins.op]
+        a = operand_name(ins.a)
+        if ins.b[0] is Kind.IMM and immediate is not None and (ins.b[1] >= 0 or ins.op is Op.SET):
+            b = str(ins.b[1])
+            command = f"/scoreboard players {immediate} REG {a} {b}"
+        else:
+            b = operand_name(ins.b)
+            command = f"/scoreboard players operation REG {a} {operation} {score_holder(ins.b)}"
+        return command, ("Processed %s: %s %s %s", name, a, symbol, b)
+
+    emit_add = emit_sub = emit_mul = emit_div = emit_set = emit_arithmetic
+
+    def emit_show(self, ins, x, y):
+        name = operand_name(ins.a)
+        holder, objective = score_holder(ins.a).split(" ")
+        command = '/tellraw @a {"text":": ","color":"gold","extra":[{"score":{"name":"' + holder + '","objective":"' + objective + '"},"color":"aqua"}]}'
+        return command, ("Processed SHOW: %s", name)
+
+    def emit_say(self, ins, x, y):
+        parts = ins.text.split()
+        if len(parts) < 2:
+            raise ValueError("SAY command requires a message")
+        message = " ".join(parts[1:])
+        command = "/tellraw @a ["
+        for part in message.split("\"")[1].replace("{", "ùVAR:").replace("}", "ù").split("ù"):
+            if part.startswith("VAR:"):
+                command += f'{{"score":{{"name":"REG","objective":"{part[4:]}"}},"color":"aqua"}},'
+            else:
+                command += f'{{"text":"{part}","color":"gold"}},'
+        return command.rstrip(",") + "]", ("Processed SAY: %s", message)
+
+    def emit_label(self, ins, x, y):
+        return "setblock ~ ~1 ~ minecraft:air", ("Label found: %s at (%s, %s)", ins.label, y, x)
+
+    def jump(self, label, x, y, name):
+        """setblock offset (``~dy ~1 ~dx``) from (y, x) to the block of a label."""
+        if label not in self.goto:
+            raise ValueError(f"Error: {name} label {label} not defined")
+        target_y, target_x = self.goto[label]
+        return f"~{target_y-y} ~1 ~{target_x-x}", (target_y, target_x)
+
+    def emit_goto(self, ins, x, y):
+        offset, target = self.jump(ins.label, x, y, "GOTO")
+        return f"setblock {offset} minecraft:redstone_block", ("GOTO found: %s at %s", ins.label, target)
+
+    def emit_tag(self, ins, x, y):
+        offset, target = self.jump(ins.label, x, y, "TAG")
+        command = f"execute as @e[type=armor_stand,tag=temp_destination] run tp @s {offset}"
+        return command, ("TAG found: %s at %s", ins.label, target)
+
+    def emit_slf(self, ins, x, y):
+        # Return address: the block after the CALL that follows
+        target_y, target_x = self.predict_pos(x, y, 2, None, None)
+        return f"execute as @e[type=armor_stand,tag=temp_origin] run tp @s ~{target_y-y} ~1 ~{target_x-x}", None
+
+    def emit_call(self, ins, x, y):
+        # Trigger the push row; the next block is the impulse return point
+        return f"setblock ~{1-y} ~1 ~{1-x} minecraft:redstone_block", None
+
+    def emit_ret(self, ins, x, y):
+        # Trigger the pop row
+        return f"setblock ~{2-y} ~1 ~{0-x} minecraft:redstone_block", None
+
+    def emit_cmd(self, ins, x, y):
+        command = ins.text.lstrip().split(" ", 1)[1]
+        return command, ("Processed CMD: %s", command)
+
+    def condition(self, ins, negate=False):
+        """``execute if|unless score ...`` prefix testing an IF instruction."""
+        keyword, cmp = SCORE_COMPARE[ins.cmp]
+        if negate:
+            keyword = "unless" if keyword == "if" else "if"
+        return f"execute {keyword} score {score_holder(ins.a)} {cmp} {score_holder(ins.b)}"
+
+    def emit_if(self, ins, x, y):
+        offset, _ = self.jump(ins.label, x, y, "IF")
+        message = ("Processed IF: %s %s %s GOTO %s", operand_name(ins.a), ins.cmp, operand_name(ins.b), ins.label)
+        return f"{self.condition(ins)} run setblock {offset} minecraft:redstone_block", message
+
+    def emit_else(self, ins, x, y):
+        # Jump over the CLR when the IF condition is false; the next block is impulse
+        if self.last_if is None:
+            raise ValueError("ELSE without IF")
+        target_y, target_x = self.predict_pos(x, y, 1, None, None)
+        return f"{self.condition(self.last_if, negate=True)} run setblock ~{target_y-y} ~1 ~{target_x-x} minecraft:redstone_block", None
+
+    def emit_clr(self, ins, x, y):
+        return "setblock ~ ~1 ~ minecraft:air", ("Processed CLR at (%s, %s)", y, x)
+
+    def emit_var(self, ins, x, y):
+        if len(ins.text.split()) != 2:
+            raise ValueError("VAR command requires a variable name")
+        name = operand_name(ins.a)
+        return f"/scoreboard objectives add {name} dummy", ("Processed VAR: %s", name)
 
     def predict_pos(self, x, y, offset, orientation, command_surface):
         """
-        Predict the next position based on current coordinates and movement.
-        Uses advance_position method directly for consistency.
+        Predict the position of the block ``offset`` steps after (y, x).
         
         Args:
             x: Current x position
             y: Current y position
             offset: Number of steps to move forward
-            orientation: Current direction ('south' = moving right, 'north' = moving left)
-            command_surface: The 2D grid of command blocks
+            orientation: Current direction (implied by the layout, kept for callers)
+            command_surface: component.CommandSurface (not modified)
         
         Returns:
             tuple: (predicted_y, predicted_x)
         """
-        # Direction: 1 = moving right (east), -1 = moving left (west)
-        mod = 1 if orientation == "south" else -1
-        
-        print(f"Predicting from ({y}, {x}), offset={offset}, direction={'→' if mod == 1 else '←'}")
-        
-        # Use advance_position for each step to ensure exact consistency
-        for step in range(offset):
-            x, y, mod, orientation, wrap_pos = self.advance_position(x, y, mod, command_surface)
-            
-            if wrap_pos:
-                x+=mod
-                print(f"  Step {step + 1}: Wrapped to new line ({y}, {x}), new direction={'→' if mod == 1 else '←'}")
-            else:
-                print(f"  Step {step + 1}: Moved to ({y}, {x})")
-        
-        print(f"Final predicted position: ({y}, {x})")
+        y, x = self.layout.offset(y, x, offset)
+        log.debug("Final predicted position: (%s, %s)", y, x)
         return y, x
 
-    def compile_script(self, script, output_file, stack_size=15, regex_size=8, display=False):
-        """Main compilation function."""
-        print(f"Compiling script with {len(script)} lines...")
-        mod = 1
+    def compile_script(self, script, output_file, stack_size=15, regex_size=8, display=False, cache=None,
+                       export_format="schem", chunk_size=None, delta_origin=None, max_changed=0.5):
+        """Main compilation function.
 
-        # Setup memory and registers
-        command_surface, x, y = self.setup_memory(stack_size, regex_size)
+        With ``cache`` (a build_cache.BuildCache), a build of the same script
+        and options is copied from the cache instead of being compiled;
+        chunked exports (``chunk_size``) are not cached.
+        ``export_format`` and ``chunk_size`` are passed to
+        component.export_to_schematic.
+        With ``delta_origin`` (the world position of cell (0, 0)), only the
+        blocks changed since the last such build are exported, through
+        component.export_delta; its report is kept in self.delta_report.
+        Delta builds are not cached.
+        """
+        key = None
+        suffix = "." + export_format
+        if cache is not None and chunk_size is None and delta_origin is None:
+            key = cache.key("compile", script, stack_size, regex_size, self.stack_backend, export_format)
+            if cache.fetch(key, suffix, component.schematic_path(output_file, export_format)):
+                if display:
+                    data = cache.read(key, ".surface.json")
+                    if data is not None:
+                        component.display_command_block(component.surface_from_dict(json.loads(data)), script_lines=script)
+                return True
+        command_surface = self.build_surface(script, stack_size, regex_size)
+        
+        # Export and display
+        on_event = (lambda kind, data: self.notify(kind, **data)) if self.listeners else None
+        if delta_origin is not None:
+            self.delta_report = component.export_delta(command_surface, output_file, delta_origin, max_changed,
+                                                       on_event=on_event, export_format=export_format,
+                                                       chunk_size=chunk_size)
+            saved = self.delta_report is not None
+        else:
+            saved = component.export_to_schematic(command_surface, output_file, on_event=on_event,
+                                                  export_format=export_format, chunk_size=chunk_size)
+        if saved and key is not None:
+            cache.store(key, ".surface.json", data=json.dumps(component.surface_to_dict(command_surface)).encode())
+            cache.store(key, suffix, source=component.schematic_path(output_file, export_format))
+        if display:
+            component.display_command_block(command_surface, script_lines=script)
+        return saved
+
+    def build_surface(self, script, stack_size=15, regex_size=8):
+        """Compile the script into a command surface without exporting it."""
+        log.info("Compiling script with %d lines...", len(script))
+
+        lines = [line for line in script if layout.is_block_line(line)]
+
+        # Setup memory, registers and constants
+        command_surface, setup_size = self.setup_memory(stack_size, regex_size, constants_needed(lines))
         
         # First pass: find labels
-        self.find_labels(script, command_surface,x,y)
-        orientation = "south"  # Initial orientation   
+        self.find_labels(script, command_surface, setup_size)
+        rows = self.layout.rows_needed(len(lines))
+        command_surface.ensure_rows(rows)
+
         # Second pass: compile commands
         chained = True
-        self.temp = True
-        index = 0
+        self.last_if = None
         
-        for line in script:
-            if not line.strip():  # Skip empty lines
-                continue
-                
-            # try:
-            self.compile_line(line, command_surface, x, y, chained, orientation=orientation, line_number=index+1)
-            
-            # Advance position
-            result = self.advance_position(x, y, mod, command_surface)
-            x, y, mod, orientation, wrap_pos = result
+        # Identical lines decode to identical instructions, decode each once
+        decoded = {}
+        for index, (line, (y, x, orientation, turn)) in enumerate(zip(lines, self.layout.blocks(len(lines)))):
+            ins = decoded.get(line)
+            if ins is None:
+                ins = decoded[line] = decode_line(line)
+            self.compile_instruction(ins, command_surface, x, y, chained, orientation=orientation, line_number=index+1)
+            if ins.op is Op.IF:
+                self.last_if = ins
             
             # Handle rotation blocks at line wrap
-            if wrap_pos:
-                turn_x, turn_y = wrap_pos
-                # Place rotation block on previous line at turn position
-                command_surface[turn_y][turn_x] = component.CommandBlock("", orientation="east")
-                # Place directional block on new line at same x position
-                command_surface[y][turn_x] = component.CommandBlock("", orientation=orientation)
-                # Now advance x by one step in the new direction
-                print(f"Line wrap at y={y}, turn_x={turn_x}")
-                x += mod
-
-            # Update chaining state
-            if not chained:
-                chained = True
-                print(f"Chained set to True at line {index}")
-            if not self.temp:
-                self.temp = True
-                chained = False
-                    
-            # except Exception as e:
-            #     print(f"Error compiling line {index + 1}: '{line}' - {e}")
-            #     print(x,y,a,b)
-            #     sys.exit(1)
-                
-            index += 1
-        
-        # Export and display
-        component.export_to_schematic(command_surface, output_file)
-        if display:
-            component.display_command_block(command_surface, script_lines=script)
-        
-        print(f"Compilation complete. Output saved to: {output_file}")
+            if turn:
+                self.place_turn(command_surface, turn)
+
+            # The block after a CALL or ELSE is an impulse block
+            chained = ins.op not in IMPULSE_NEXT
+
+        if self.listeners:
+            self.notify("done", lines=len(lines), rows=command_surface.rows)
+        return command_surface
 
 def main():
     parser = argparse.ArgumentParser(
@@ -371,6 +406,9 @@ Examples:
   %(prog)s input.asm -o output.schem           # Specify output file
   %(prog)s input.asm -s 20 -r 16              # Custom stack and register sizes
   %(prog)s input.asm --display                # Show command blocks after compilation
+  %(prog)s input.asm -O                       # Optimize (peephole + dataflow) before compiling
+  %(prog)s input.asm --stack storage          # Constant-time CALL/RET
+  %(prog)s input.asm --backend datapack -o pack  # Datapack folder pack/ instead of a schematic
         """
     )
     
@@ -382,12 +420,37 @@ Examples:
                        help="Stack size for memory setup (default: 15)")
     parser.add_argument("-r", "--register-size", type=int, default=8,
                        help="Number of registers to create (default: 8)")
+    parser.add_argument("--backend", choices=("schematic", "datapack"), default="schematic",
+                       help="Emit a command block schematic (default) or a datapack folder named after --output")
+    parser.add_argument("--format", choices=component.EXPORT_FORMATS, default="schem",
+                       help="Sponge schematic for WorldEdit (schem, default) or vanilla structure (nbt)")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                       help="Split the grid into pieces of at most N x N blocks with a <output>.chunks.json manifest "
+                            f"(structures need N <= {schem_writer.STRUCTURE_MAX_SIZE})")
+    parser.add_argument("--delta", type=int, nargs=3, metavar=("X", "Y", "Z"), default=None,
+                       help="Export only the blocks changed since the last --delta build, as setblock commands for "
+                            "the grid placed with its first block at X Y Z (<output>.delta.mcfunction)")
+    parser.add_argument("--delta-threshold", type=float, default=0.5,
+                       help="Fraction of changed blocks above which --delta does a full export (default: 0.5)")
+    parser.add_argument("--namespace", default="asm",
+                       help="Datapack namespace; run the program with /function <namespace>:main (default: asm)")
+    parser.add_argument("--stack", choices=component.STACK_BACKENDS, default="pile",
+                       help="Call stack: one armor stand per slot (pile, default) or command storage with "
+                            "constant-time CALL/RET (storage)")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                       help="Run the peephole and dataflow optimizers before compiling and report the blocks saved")
+    parser.add_argument("--cache-dir", default=build_cache.DEFAULT_DIRECTORY,
+                       help="Build cache directory (default: $ASM_CACHE_DIR or ~/.cache/asm-mc)")
+    parser.add_argument("--no-cache", action="store_true",
+                       help="Always compile, without reading or filling the build cache")
     parser.add_argument("--display", action="store_true",
                        help="Display command blocks after compilation")
-    parser.add_argument("-v", "--verbose", action="store_true",
-                       help="Enable verbose output")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                       help="Show progress (-v) or every compiled line (-vv)")
     
     args = parser.parse_args()
+    logging.basicConfig(format="%(message)s",
+                        level=logging.DEBUG if args.verbose > 1 else logging.INFO if args.verbose else logging.WARNING)
     
     # Validate input file
     if not os.path.exists(args.input):
@@ -404,8 +467,12 @@ Examples:
             sys.exit(1)
     
     # Initialize compiler and run
-    compiler = AssemblerCompiler()
+    compiler = AssemblerCompiler(stack_backend=args.stack)
     script = compiler.read_script(args.input)
+    if args.optimize:
+        optimizer = dataflow.Optimizer()
+        script = optimizer.optimize(script)
+        print(optimizer.report())
     
     if args.verbose:
         print(f"Input file: {args.input}")
@@ -414,14 +481,34 @@ Examples:
         print(f"Register size: {args.register_size}")
         print(f"Script lines: {len(script)}")
     
+    if args.backend == "datapack":
+        output_dir = datapack.export_datapack(script, os.path.splitext(args.output)[0], namespace=args.namespace,
+                                              stack_size=args.stack_size, regex_size=args.register_size)
+        print(f"Compilation complete. Datapack saved to: {output_dir}")
+        return
+
     # try:
-    compiler.compile_script(
+    saved = compiler.compile_script(
         script, 
         args.output, 
         stack_size=args.stack_size, 
         regex_size=args.register_size,
-        display=args.display
+        display=args.display,
+        cache=None if args.no_cache else build_cache.BuildCache(args.cache_dir),
+        export_format=args.format,
+        chunk_size=args.chunk_size,
+        delta_origin=args.delta,
+        max_changed=args.delta_threshold
     )
+    if not saved:
+        sys.exit(1)
+    if args.delta:
+        report = compiler.delta_report
+        print(f"{report['mode'].capitalize()} export: {report['changed']} changed, {report['added']} added, "
+              f"{report['removed']} removed blocks")
+        print(f"Compilation complete. Output saved to: {report['path']}")
+        return
+    print(f"Compilation complete. Output saved to: {component.export_path(args.output, args.format, args.chunk_size)}")
     # except KeyboardInterrupt:
     #     print("\nCompilation interrupted by user.")
     #     sys.exit(1)
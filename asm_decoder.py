@@ -0,0 +1,171 @@
+from enum import IntEnum
+
+
+class Op(IntEnum):
+    NOP = 0
+    LABEL = 1
+    ADD = 2
+    SUB = 3
+    MUL = 4
+    DIV = 5
+    SET = 6
+    SAY = 7
+    SHOW = 8
+    GOTO = 9
+    TAG = 10
+    SLF = 11
+    CALL = 12
+    RET = 13
+    IF = 14
+    ELSE = 15
+    CLR = 16
+    VAR = 17
+    CMD = 18
+    UNKNOWN = 19
+
+
+class Kind(IntEnum):
+    REG = 0
+    VAR = 1
+    IMM = 2
+
+
+OPCODES = {op.name: op for op in Op if op not in (Op.NOP, Op.LABEL, Op.UNKNOWN)}
+ARITHMETIC = (Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.SET)
+COMPARISONS = ("=", "!=", "<", "<=", ">", ">=")
+
+
+class DecodeError(ValueError):
+    """A line that is not a well-formed instruction; ``index`` is its line index."""
+    def __init__(self, message, index):
+        super().__init__(message)
+        self.index = index
+
+
+class Instruction:
+    """A single decoded line of assembly.
+
+    Operands are ``(Kind, value)`` tuples where ``value`` is the register or
+    variable name, or the already parsed integer for immediates. ``target`` is
+    the index of the label line referenced by ``label`` (None when undefined).
+    ``sa``, ``sb``, ``slot_parts`` and the SAY ``template`` are filled in when
+    an emulator links the program against its slot table.
+    """
+    __slots__ = ("op", "a", "b", "cmp", "label", "target", "parts", "text", "index", "error",
+                 "sa", "sb", "slot_parts", "template")
+
+    def __init__(self, op, text="", index=None, a=None, b=None, cmp=None, label=None, parts=None):
+        self.op = op
+        self.a = a
+        self.b = b
+        self.cmp = cmp
+        self.label = label
+        self.target = None
+        self.parts = parts
+        self.text = text
+        self.index = index
+        self.error = None
+        self.sa = None
+        self.sb = None
+        self.slot_parts = None
+        self.template = None
+
+    def __repr__(self):
+        return f"Instruction({self.op.name}, {self.text!r})"
+
+
+def parse_operand(token):
+    """Classify an operand token the same way the emulator always has."""
+    token = token.replace(",", "")
+    if token.startswith("#"):
+        return (Kind.IMM, int(token.replace("#", "")))
+    if token.startswith("R"):
+        return (Kind.REG, token)
+    return (Kind.VAR, token)
+
+
+def parse_say(line):
+    """Split a SAY message into ``(is_name, text)`` parts."""
+    text = line.split('"')[1]
+    text = text.replace("{", "ùVAR:").replace("}", "ù").split("ù")
+    parts = []
+    for part in text:
+        if part.startswith("VAR:"):
+            parts.append((True, part[len("VAR:"):]))
+        elif part:
+            parts.append((False, part))
+    return parts
+
+
+def decode_line(line, index=None):
+    """Decode one line of assembly into an Instruction (no label resolution)."""
+    stripped = line.strip()
+    if not stripped:
+        return Instruction(Op.NOP, line, index)
+    if stripped.startswith(":"):
+        return Instruction(Op.LABEL, line, index, label=stripped.split(":")[1].strip())
+
+    name = stripped.split(" ")[0]
+    op = OPCODES.get(name)
+    if op is None:
+        return Instruction(Op.UNKNOWN, line, index)
+    parts = stripped.split()
+
+    if op in ARITHMETIC:
+        _, dst, src = parts
+        return Instruction(op, line, index, a=parse_operand(dst), b=parse_operand(src))
+    if op is Op.SAY:
+        return Instruction(op, line, index, parts=parse_say(line))
+    if op is Op.SHOW or op is Op.VAR:
+        return Instruction(op, line, index, a=parse_operand(parts[1]))
+    if op is Op.GOTO or op is Op.TAG:
+        return Instruction(op, line, index, label=parts[1].replace(":", ""))
+    if op is Op.IF:
+        _, left, cmp, right, label = stripped.split(" ", 4)
+        if cmp not in COMPARISONS:
+            raise ValueError(f"Unknown operator: {cmp}")
+        return Instruction(op, line, index, a=parse_operand(left), b=parse_operand(right),
+                           cmp=cmp, label=label.replace(":", ""))
+    return Instruction(op, line, index)
+
+
+def find_labels(program):
+    """Map every label name to the index of its defining line."""
+    labels = {}
+    for ins in program:
+        if ins.op is Op.LABEL:
+            labels[ins.label] = ins.index
+    return labels
+
+
+def decode_program(script):
+    """Decode a whole script and resolve label targets.
+
+    Args:
+        script: Source text or a list of lines
+
+    Returns:
+        list: One Instruction per source line, so indices match line numbers
+
+    Raises:
+        DecodeError: for the first malformed line
+    """
+    if isinstance(script, str):
+        script = script.splitlines()
+    program = []
+    for i, line in enumerate(script):
+        try:
+            program.append(decode_line(line, i))
+        except (ValueError, IndexError) as e:
+            raise DecodeError(f"Malformed instruction: {line.strip()} ({e})", i) from e
+    labels = find_labels(program)
+    for i, ins in enumerate(program):
+        if ins.label is not None and ins.op is not Op.LABEL:
+            ins.target = labels.get(ins.label)
+        if ins.op is Op.IF:
+            following = [program[j].op if j < len(program) else None for j in (i + 1, i + 2)]
+            if following[0] is not Op.ELSE:
+                ins.error = "ELSE not found after IF"
+            elif following[1] is not Op.CLR:
+                ins.error = "CLR not found after ELSE"
+    return program
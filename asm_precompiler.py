@@ -1,9 +1,58 @@
 import argparse
+import json
+import logging
 import os
+import build_cache
 import emulator
+from events import EventSource
 
-class Precompiler:
-    def __init__(self, register_count=10):
+log = logging.getLogger(__name__)
+
+class MappedText:
+    """Generated text that remembers where each of its lines came from.
+
+    ``origins`` holds one entry per ``text.split("\\n")`` segment, either a
+    ``(source_path, line_number)`` tuple or None for generated lines.
+    """
+    def __init__(self, text="", origin=None):
+        self.text = text
+        self.origins = [origin] * (text.count("\n") + 1)
+
+    def __iadd__(self, other):
+        if not isinstance(other, MappedText):
+            other = MappedText(other)
+        if not self.text or self.text.endswith("\n"):
+            self.origins[-1] = other.origins[0]
+        self.origins.extend(other.origins[1:])
+        self.text += other.text
+        return self
+
+    def __add__(self, other):
+        result = MappedText()
+        result += self
+        result += other
+        return result
+
+    def strip(self):
+        segments = self.text.split("\n")
+        start, end = 0, len(segments)
+        while start < end and not segments[start].strip():
+            start += 1
+        while end > start and not segments[end - 1].strip():
+            end -= 1
+        result = MappedText(self.text.strip())
+        result.origins = self.origins[start:end] or [None]
+        return result
+
+class Precompiler(EventSource):
+    """Expands .sasm into .asm.
+
+    Subscribers (see events.EventSource) receive an "import" event per
+    imported module and a "precompiled" event per written file.
+    """
+    def __init__(self, register_count=10, cache=None):
+        super().__init__()
+        self.cache = cache  # build_cache.BuildCache, or None
         self.float_factory = 10000  # Factor to convert float to int representation its digits n°4 after decimal point
         self.register_count = register_count
         self.sys_var = {
@@ -14,13 +63,50 @@ class Precompiler:
                     }
         self.sys_modules = ["SCREEN"]
         self.var = [*self.sys_var.keys()]
-        self.library_script = ""
+        self.library_script = MappedText()
+        self.source_map = []
+
+    def module_path(self, input_path, module):
+        """File an ``IMPORT module`` line in input_path resolves to, or None."""
+        path = os.path.join(os.path.dirname(os.path.abspath(input_path)), module+".sasm")
+        if os.path.exists(path):
+            return path
+        if module in self.sys_modules:
+            return os.path.join(os.path.dirname(os.path.abspath(__file__)), "sys_modules", module+".sasm")
+        return None
+
+    def dependencies(self, input_path, seen=None):
+        """(path, content hash) of input_path and every module it imports, recursively."""
+        seen = set() if seen is None else seen
+        seen.add(input_path)
+        result = [(input_path, build_cache.file_digest(input_path))]
+        with open(input_path, "r") as f:
+            for line in f:
+                line = line.replace("  ","").replace("   ","").strip()
+                if line.startswith("IMPORT"):
+                    path = self.module_path(input_path, line.split(" ", 1)[1])
+                    if path is not None and path not in seen:
+                        result += self.dependencies(path, seen)
+        return result
 
     def precompile(self, input_path, output_path,script_prefix=""):
+        # Only whole builds are cached: nested imports share library_script
+        key = None
+        if self.cache is not None and not script_prefix and not self.library_script.text:
+            key = self.cache.key("precompile", self.register_count, self.dependencies(input_path))
+            source_map = self.cache.read(key, ".map.json")
+            if source_map is not None and self.cache.fetch(key, ".asm", output_path):
+                with open(output_path, "r") as f:
+                    text = f.read()
+                self._last_output = MappedText(text)
+                self._last_output.origins = [tuple(origin) if origin else None for origin in json.loads(source_map)]
+                self.source_map = self._last_output.origins
+                return text
         with open(input_path, "r") as f:
             script = f.read().splitlines()
-        precompile_script = self._init_var()
-        for line in script:
+        precompile_script = MappedText(self._init_var())
+        for line_number, line in enumerate(script, 1):
+            origin = (input_path, line_number)
             line = line.replace("  ","").replace("   ","").strip()
             # Organize handlers in a dictionary for readability
             def handle_comment_or_empty(line,*kwargs):
@@ -56,20 +142,26 @@ class Precompiler:
                 if not os.path.exists(out_path_temp):
                     os.makedirs(out_path_temp)
                 out_path_temp = os.path.join(out_path_temp, module+".asm")
-                print(f"Importing module: {module} from path: {path}")
                 if os.path.exists(path):
-                    imported_script = f":{script_prefix}{module}_IMPORT\n"
-                    imported_script += self.precompile(path, out_path_temp, script_prefix=script_prefix+module+".")
+                    log.info("Importing module: %s from path: %s", module, path)
+                    if self.listeners:
+                        self.notify("import", module=module, path=path, system=False)
+                    imported_script = MappedText(f":{script_prefix}{module}_IMPORT\n", origin)
+                    self.precompile(path, out_path_temp, script_prefix=script_prefix+module+".")
+                    imported_script += self._last_output
                     self.library_script += imported_script+"\n"
                     res = handle_call(f"CALL :{script_prefix}{module}_IMPORT")
                     return res
                 elif module in self.sys_modules:
-                    print(f"Importing system module: {module}")
                     #get current path of the python file
                     current_dir = os.path.dirname(os.path.abspath(__file__))
                     lib_path = os.path.join(current_dir, "sys_modules", module+".sasm")
-                    imported_script = f":{script_prefix}{module}_IMPORT\n"
-                    imported_script += self.precompile(lib_path, out_path_temp, script_prefix=script_prefix+module+".")
+                    log.info("Importing system module: %s", module)
+                    if self.listeners:
+                        self.notify("import", module=module, path=lib_path, system=True)
+                    imported_script = MappedText(f":{script_prefix}{module}_IMPORT\n", origin)
+                    self.precompile(lib_path, out_path_temp, script_prefix=script_prefix+module+".")
+                    imported_script += self._last_output
                     self.library_script += imported_script+"\n"
                     res = handle_call(f"CALL :{script_prefix}{module}_IMPORT")
                     return res
@@ -118,9 +210,9 @@ class Precompiler:
                     self.var.append(var)
                 if value.startswith("#"):
                     float_value = int(float(value.lstrip("#")) * self.float_factory)
-                    return f"SET SYS.OPR.TEMP #{float_value}\nMUL {var} SYS.OPR.TEMP\nSET SYS.OPR.TEMP SYS.FLOAT_FACTORY\nDIV {var} SYS.OPR.TEMP\n"
+                    return f"MUL {var} #{float_value}\nDIV {var} #{self.float_factory}\n"
                 else:
-                    return f"MUL {var} {value}\nSET SYS.OPR.TEMP SYS.FLOAT_FACTORY\nDIV {var} SYS.OPR.TEMP\n"
+                    return f"MUL {var} {value}\nDIV {var} #{self.float_factory}\n"
             
             def handle_fdiv(line,*kwargs):
                 _, var, value = line.split(" ", 2)
@@ -130,9 +222,9 @@ class Precompiler:
                     self.var.append(var)
                 if value.startswith("#"):
                     float_value = int(float(value.lstrip("#")) * self.float_factory)
-                    return f"SET SYS.OPR.TEMP SYS.FLOAT_FACTORY\nMUL {var} SYS.OPR.TEMP\nSET SYS.OPR.TEMP #{float_value}\nDIV {var} SYS.OPR.TEMP\n"
+                    return f"MUL {var} #{self.float_factory}\nDIV {var} #{float_value}\n"
                 else:
-                    return f"SET SYS.OPR.TEMP SYS.FLOAT_FACTORY\nMUL {var} SYS.OPR.TEMP\nDIV {var} {value}\n"
+                    return f"MUL {var} #{self.float_factory}\nDIV {var} {value}\n"
             
             def handle_fshow(line,*kwargs):
                 _, message = line.split(" ", 1)
@@ -142,9 +234,9 @@ class Precompiler:
                     var_name, rest = var.split("}", 1)
                     if var_name in self.var:
                         # Extract integer part: var / 10000
-                        float_int_part = f"SET SYS.OPR.IP {var_name}\nSET SYS.OPR.TEMP SYS.FLOAT_FACTORY\nDIV SYS.OPR.IP SYS.OPR.TEMP\n"
+                        float_int_part = f"SET SYS.OPR.IP {var_name}\nDIV SYS.OPR.IP #{self.float_factory}\n"
                         # Calculate what integer part represents: IP * 10000
-                        float_temp_calc = f"SET SYS.OPR.TEMP SYS.OPR.IP\nSET SYS.OPR.FP SYS.FLOAT_FACTORY\nMUL SYS.OPR.TEMP SYS.OPR.FP\n"
+                        float_temp_calc = f"SET SYS.OPR.TEMP SYS.OPR.IP\nMUL SYS.OPR.TEMP #{self.float_factory}\n"
                         # Extract fractional part: var - (IP * 10000)
                         float_frac_part = f"SET SYS.OPR.FP {var_name}\nSUB SYS.OPR.FP SYS.OPR.TEMP\n"
                         
@@ -173,20 +265,33 @@ class Precompiler:
             }
 
             if line.startswith("--") or not line:
-                precompile_script += handle_comment_or_empty(line)
+                precompile_script += MappedText(handle_comment_or_empty(line), origin)
             else:
                 for prefix, handler in prefix_handlers.items():
                     if line.startswith(prefix):
-                        precompile_script += handler(line)
+                        precompile_script += MappedText(handler(line), origin)
                         break
                 else:
-                    precompile_script += handle_default(line)
+                    precompile_script += MappedText(handle_default(line), origin)
         # remove trailing newlines
         precompile_script = precompile_script.strip() + "\n" + self.library_script.strip()
 
         with open(output_path, "w") as f:
-            f.write(precompile_script)
-        return precompile_script
+            f.write(precompile_script.text)
+        self._last_output = precompile_script
+        self.source_map = precompile_script.origins
+        log.info("Precompiled %s -> %s (%d lines)", input_path, output_path, len(self.source_map))
+        if self.listeners:
+            self.notify("precompiled", input=input_path, output=output_path, lines=len(self.source_map))
+        if key is not None:
+            self.cache.store(key, ".map.json", data=json.dumps(self.source_map).encode())
+            self.cache.store(key, ".asm", source=output_path)
+        return precompile_script.text
+
+    def write_source_map(self, path):
+        """Save the .asm line -> .sasm line map of the last precompile as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.source_map, f)
     def _init_var(self):
         precompile_script = ""
         for var in self.sys_var.keys():
@@ -202,14 +307,25 @@ def main():
     parser.add_argument("--output", required=True, help="Output .asm file")
     parser.add_argument("--registers", type=int, default=10, help="Number of registers for emulator")
     parser.add_argument("--emulate", action="store_true", help="Run emulator after precompiling")
+    parser.add_argument("--source-map", help="Write the .asm -> .sasm line map to this JSON file")
+    parser.add_argument("--profile", choices=["text", "json", "collapsed"], help="Profile the emulated run")
+    parser.add_argument("--profile-output", default="-", help="Profile report file (default: stdout)")
+    parser.add_argument("--cache-dir", default=build_cache.DEFAULT_DIRECTORY, help="Build cache directory (default: $ASM_CACHE_DIR or ~/.cache/asm-mc)")
+    parser.add_argument("--no-cache", action="store_true", help="Always precompile, without reading or filling the build cache")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show imported modules and written files")
     args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO if args.verbose else logging.WARNING)
 
-    precompiler = Precompiler(args.registers)
+    precompiler = Precompiler(args.registers, cache=None if args.no_cache else build_cache.BuildCache(args.cache_dir))
     precompiled_script = precompiler.precompile(args.input, args.output)
+    if args.source_map:
+        precompiler.write_source_map(args.source_map)
 
     if args.emulate:
-        emu = emulator.Emulator(args.registers)
+        emu = emulator.Emulator(args.registers, profile=bool(args.profile), source_map=precompiler.source_map)
         emu.execute_script(precompiled_script)
+        if args.profile:
+            emu.profiler.save(args.profile_output, args.profile)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
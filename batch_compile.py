@@ -0,0 +1,161 @@
+import argparse
+import concurrent.futures
+import glob
+import json
+import logging
+import os
+import sys
+import time
+import asm_compiler
+import build_cache
+import dataflow
+from asm_precompiler import Precompiler
+
+log = logging.getLogger(__name__)
+
+def expand_inputs(patterns=(), manifest=None):
+    """Programs to build, as (input, options) pairs in a stable order.
+
+    ``patterns`` are globs (``**`` allowed). ``manifest`` is a JSON file
+    holding a list whose entries are either globs or objects with an
+    ``input`` glob and per-program ``stack_size`` / ``register_size`` /
+    ``registers`` / ``optimize`` overrides.
+    """
+    entries = [(pattern, {}) for pattern in patterns]
+    if manifest is not None:
+        with open(manifest, "r") as f:
+            listed = json.load(f)
+        base = os.path.dirname(os.path.abspath(manifest))
+        for entry in listed:
+            if isinstance(entry, str):
+                entry = {"input": entry}
+            options = {key: value for key, value in entry.items() if key != "input"}
+            entries.append((os.path.join(base, entry["input"]), options))
+    programs = {}
+    for pattern, options in entries:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            raise ValueError(f"No programs match {pattern}")
+        for path in matches:
+            programs.setdefault(path, options)
+    return list(programs.items())
+
+def plan_jobs(programs, output_dir, stack_size=15, register_size=8, registers=10, cache_dir=None, optimize=False):
+    """One job tuple per program; outputs are ``<output_dir>/<stem>.schem``."""
+    jobs = []
+    outputs = {}
+    for path, options in programs:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if stem in outputs:
+            raise ValueError(f"{path} and {outputs[stem]} would both be written to {stem}.schem")
+        outputs[stem] = path
+        jobs.append((path, os.path.join(output_dir, stem + ".schem"),
+                     options.get("stack_size", stack_size), options.get("register_size", register_size),
+                     options.get("registers", registers), cache_dir, options.get("optimize", optimize)))
+    return jobs
+
+def build_program(job):
+    """Precompile (for .sasm), compile and export one program.
+
+    Runs in a worker process with fresh Precompiler and AssemblerCompiler
+    instances, and reports failures in the result instead of raising.
+    """
+    input_path, output_path, stack_size, register_size, registers, cache_dir, optimize = job
+    started = time.perf_counter()
+    result = {"input": input_path, "output": output_path, "ok": False, "lines": 0, "saved": 0, "error": None}
+    try:
+        cache = build_cache.BuildCache(cache_dir) if cache_dir is not None else None
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        if input_path.endswith(".sasm"):
+            asm_path = os.path.splitext(output_path)[0] + ".asm"
+            script = Precompiler(registers, cache=cache).precompile(input_path, asm_path).splitlines()
+        else:
+            with open(input_path, "r") as f:
+                script = f.read().splitlines()
+        if optimize:
+            optimizer = dataflow.Optimizer()
+            script = optimizer.optimize(script)
+            result["saved"] = optimizer.before - optimizer.after
+        result["lines"] = sum(1 for line in script if line.strip())
+        result["ok"] = asm_compiler.AssemblerCompiler().compile_script(
+            script, output_path, stack_size=stack_size, regex_size=register_size, cache=cache)
+        if not result["ok"]:
+            result["error"] = "Schematic export failed"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+def compile_batch(jobs, workers=None):
+    """Run build_program over ``jobs`` in a process pool, results in job order.
+
+    ``workers`` defaults to the number of cores; 1 builds in this process.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) <= 1:
+        return [build_program(job) for job in jobs]
+    results = [None] * len(jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        futures = {pool.submit(build_program, job): index for index, job in enumerate(jobs)}
+        for future in concurrent.futures.as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                # The worker process itself died
+                results[index] = {"input": jobs[index][0], "output": jobs[index][1], "ok": False, "lines": 0,
+                                  "saved": 0, "seconds": 0.0, "error": f"{type(e).__name__}: {e}"}
+            log.info("%s %s", "built" if results[index]["ok"] else "FAILED", jobs[index][0])
+    return results
+
+def format_summary(results, elapsed=None):
+    """Plain-text table of the batch results."""
+    width = max([len("Program")] + [len(result["input"]) for result in results])
+    lines = [f"{'Program':<{width}}  Status  {'Lines':>7}  {'Saved':>5}  {'Time':>8}",
+             f"{'-' * width}  ------  -------  -----  --------"]
+    for result in results:
+        status = "ok" if result["ok"] else "FAILED"
+        lines.append(f"{result['input']:<{width}}  {status:<6}  {result['lines']:>7}  {result['saved']:>5}  {result['seconds']:>7.2f}s")
+        if result["error"]:
+            lines.append(f"{'':<{width}}  {result['error']}")
+    failed = sum(1 for result in results if not result["ok"])
+    total = f"{len(results)} programs, {len(results) - failed} built, {failed} failed"
+    if elapsed is not None:
+        total += f" in {elapsed:.2f}s"
+    lines.append(total)
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile many .asm/.sasm programs in parallel")
+    parser.add_argument("inputs", nargs="*", help="Programs or globs, e.g. 'programs/**/*.sasm'")
+    parser.add_argument("-m", "--manifest", help="JSON list of programs (globs or {input, stack_size, register_size, registers})")
+    parser.add_argument("-o", "--output-dir", default="build", help="Directory for the .schem files (default: build)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes (default: number of cores)")
+    parser.add_argument("-s", "--stack-size", type=int, default=15, help="Stack size for memory setup (default: 15)")
+    parser.add_argument("-r", "--register-size", type=int, default=8, help="Number of registers to create (default: 8)")
+    parser.add_argument("--registers", type=int, default=10, help="Registers for the precompiler (default: 10)")
+    parser.add_argument("-O", "--optimize", action="store_true", help="Run the peephole and dataflow optimizers on every program")
+    parser.add_argument("--cache-dir", default=build_cache.DEFAULT_DIRECTORY, help="Build cache directory")
+    parser.add_argument("--no-cache", action="store_true", help="Always build, without reading or filling the build cache")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Report each program as it finishes")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+
+    if not args.inputs and not args.manifest:
+        parser.error("give input globs or --manifest")
+    try:
+        programs = expand_inputs(args.inputs, args.manifest)
+        jobs = plan_jobs(programs, args.output_dir, args.stack_size, args.register_size, args.registers,
+                         cache_dir=None if args.no_cache else args.cache_dir, optimize=args.optimize)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    started = time.perf_counter()
+    results = compile_batch(jobs, args.jobs)
+    print(format_summary(results, time.perf_counter() - started))
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+import argparse
+import numpy as np
+from asm_decoder import Op
+from emulator import Emulator, TICKS, UNSET
+
+# Per-lane status of a slot, mirrors UNSET / None / value in Emulator
+UNSET_STATE = 0
+DECLARED = 1
+DEFINED = 2
+# Python type of a readable slot in each state, for Emulator's TypeError messages
+TYPE_NAMES = {DECLARED: "NoneType", DEFINED: "int"}
+
+COMPARE = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+class BatchEmulator:
+    """Run one program over many inputs at once.
+
+    Every lane has its own program counter, call stack and SAY output, while
+    registers and variables are stored as an int32 array of shape
+    (lanes, slots) so arithmetic wraps exactly like the scoreboard. Lanes run
+    in lockstep: each step executes the instruction at the lowest pending
+    program counter for every lane waiting there, so lanes that diverge on an
+    IF/GOTO are masked out until they meet again.
+
+    Lane errors read like Emulator's RunResult.error. A lane that runs
+    ``max_instructions`` instructions, or uses ``max_ticks`` ticks, stops
+    with its ``exhausted`` state set, so a runaway lane cannot hold up the
+    others.
+    """
+    def __init__(self, reg_size, lanes, stack_depth=16, max_instructions=None, max_ticks=None):
+        self.lanes = lanes
+        self.linker = Emulator(reg_size)
+        self.program = []
+        self.labels = {}
+        self.stack_depth = stack_depth
+        self.values = None
+        self.status = None
+        self.pcs = np.zeros(lanes, dtype=np.int64)
+        self.ticks = np.zeros(lanes, dtype=np.int64)
+        self.done = np.zeros(lanes, dtype=bool)
+        self.targets = np.full(lanes, -1, dtype=np.int64)
+        self.stack = np.zeros((lanes, stack_depth), dtype=np.int64)
+        self.sp = np.zeros(lanes, dtype=np.int64)
+        self.outputs = [[] for _ in range(lanes)]
+        self.errors = [None] * lanes
+        self.max_instructions = max_instructions
+        self.max_ticks = max_ticks
+        self.instructions = np.zeros(lanes, dtype=np.int64)
+        self.exhausted = [None] * lanes
+        self._defined = set()
+        self._handlers = [None] * len(Op)
+        for op in Op:
+            self._handlers[op] = getattr(self, f"handle_{op.name.lower()}")
+
+    def load_program(self, script):
+        """Decode and link the script with the scalar emulator's slot table."""
+        self.linker.load_program(script)
+        self.program = self.linker.program
+        self.labels = self.linker.labels
+        slots = self.linker.slots
+        self.values = np.zeros((self.lanes, len(slots)), dtype=np.int32)
+        self.status = np.full((self.lanes, len(slots)), UNSET_STATE, dtype=np.int8)
+        for slot, value in enumerate(slots):
+            if value is not UNSET and value is not None:
+                self.values[:, slot] = value
+                self.status[:, slot] = DEFINED
+                self._defined.add(slot)
+
+    def set_input(self, name, values):
+        """Set a register or variable in every lane (scalar or one value per lane)."""
+        slot = self.linker.slot(name)
+        if slot >= self.values.shape[1]:
+            grow = slot + 1 - self.values.shape[1]
+            self.values = np.pad(self.values, ((0, 0), (0, grow)))
+            self.status = np.pad(self.status, ((0, 0), (0, grow)))
+        self.values[:, slot] = np.asarray(values, dtype=np.int64).astype(np.int32)
+        self.status[:, slot] = DEFINED
+        self._defined.add(slot)
+
+    def execute_script(self, script, inputs=None):
+        inputs = inputs or {}
+        # Inputs count as defined when the program is linked
+        for name in inputs:
+            self.linker.slot(name, 0)
+        self.load_program(script)
+        for name, values in inputs.items():
+            self.set_input(name, values)
+        self.run()
+
+    def run(self):
+        program = self.program
+        handlers = self._handlers
+        size = len(program)
+        pcs = self.pcs
+        with np.errstate(over="ignore", divide="ignore"):
+            while True:
+                pending = ~self.done
+                if not pending.any():
+                    break
+                if self.max_instructions is not None and self.exhaust(pending, self.instructions,
+                                                                       self.max_instructions, "instructions"):
+                    continue
+                if self.max_ticks is not None and self.exhaust(pending, self.ticks, self.max_ticks, "ticks"):
+                    continue
+                pc = int(pcs[pending].min())
+                if pc >= size:
+                    self.done[pending & (pcs >= size)] = True
+                    continue
+                lanes = np.flatnonzero(pending & (pcs == pc))
+                if len(lanes) == self.lanes:
+                    lanes = slice(None)
+                self.instructions[lanes] += 1
+                handlers[program[pc].op](program[pc], lanes, pc)
+
+    def exhaust(self, pending, used, budget, name):
+        """Stop the pending lanes that have used up ``budget``; whether there were any."""
+        over = np.flatnonzero(pending & (used >= budget))
+        for lane in over:
+            self.exhausted[lane] = name
+        self.done[over] = True
+        return len(over) > 0
+
+    def fail(self, lanes, message):
+        for lane in np.arange(self.lanes)[lanes]:
+            self.errors[lane] = message
+        self.done[lanes] = True
+
+    def _write(self, lanes, slot, value):
+        self.values[lanes, slot] = value
+        if slot not in self._defined:
+            self.status[lanes, slot] = DEFINED
+            if (self.status[:, slot] == DEFINED).all():
+                self._defined.add(slot)
+
+    def _operand_lanes(self, ins, lanes, message=None):
+        """Lanes where the operands ``ins`` reads can be used; the others fail like Emulator.
+
+        A lane reading an unset slot fails with a KeyError naming it. With
+        ``message``, a lane reading a declared (None) slot fails with that
+        TypeError message, formatted with the Python type names of the
+        operands; without it, None operands are allowed.
+        """
+        reads = [(ins.b, ins.sb)] if ins.op is Op.SET else [(ins.a, ins.sa)] if ins.op is Op.SHOW \
+            else [(ins.a, ins.sa), (ins.b, ins.sb)]
+        if all(slot in self._defined for _, slot in reads):
+            return lanes
+        lanes = np.arange(self.lanes)[lanes]
+        states = [self.status[lanes, slot] for _, slot in reads]
+        failed = np.zeros(len(lanes), dtype=bool)
+        for (operand, _), state in zip(reads, states):
+            unset = (state == UNSET_STATE) & ~failed
+            for lane in lanes[unset]:
+                self.errors[lane] = f"KeyError: {operand[1]!r}"
+            failed |= unset
+        if message is not None:
+            declared = ~failed & np.any([state == DECLARED for state in states], axis=0)
+            for lane, *types in zip(lanes[declared], *(state[declared] for state in states)):
+                self.errors[lane] = "TypeError: " + message.format(*(TYPE_NAMES[t] for t in types))
+            failed |= declared
+        self.done[lanes[failed]] = True
+        return lanes[~failed]
+
+    def handle_add(self, ins, lanes, pc):
+        lanes = self._operand_lanes(ins, lanes, "unsupported operand type(s) for +: '{}' and '{}'")
+        values = self.values
+        values[lanes, ins.sa] += values[lanes, ins.sb]
+        self.pcs[lanes] = pc + 1
+    def handle_sub(self, ins, lanes, pc):
+        lanes = self._operand_lanes(ins, lanes, "unsupported operand type(s) for -: '{}' and '{}'")
+        values = self.values
+        values[lanes, ins.sa] -= values[lanes, ins.sb]
+        self.pcs[lanes] = pc + 1
+    def handle_mul(self, ins, lanes, pc):
+        lanes = self._operand_lanes(ins, lanes, "unsupported operand type(s) for *: '{}' and '{}'")
+        values = self.values
+        values[lanes, ins.sa] *= values[lanes, ins.sb]
+        self.pcs[lanes] = pc + 1
+    def handle_div(self, ins, lanes, pc):
+        lanes = self._operand_lanes(ins, lanes, "unsupported operand type(s) for //: '{}' and '{}'")
+        values = self.values
+        divisor = values[lanes, ins.sb]
+        zero = divisor == 0
+        if zero.any():
+            self.fail(np.arange(self.lanes)[lanes][zero], "ZeroDivisionError: integer division or modulo by zero")
+            lanes = np.arange(self.lanes)[lanes][~zero]
+            divisor = divisor[~zero]
+        values[lanes, ins.sa] //= divisor
+        self.pcs[lanes] = pc + 1
+    def handle_set(self, ins, lanes, pc):
+        lanes = self._operand_lanes(ins, lanes)
+        if ins.sb in self._defined:
+            self._write(lanes, ins.sa, self.values[lanes, ins.sb])
+        else:
+            # Copies a declared state along with the value
+            self.values[lanes, ins.sa] = self.values[lanes, ins.sb]
+            self.status[lanes, ins.sa] = self.status[lanes, ins.sb]
+            if (self.status[:, ins.sa] == DEFINED).all():
+                self._defined.add(ins.sa)
+            else:
+                self._defined.discard(ins.sa)
+        self.pcs[lanes] = pc + 1
+
+    def format_say(self, ins, lane):
+        final_text = ""
+        for slot, text in ins.slot_parts:
+            if slot is None:
+                final_text += text
+            elif self.status[lane, slot] == UNSET_STATE:
+                final_text += f"ERROR NOT FOUND {text}"
+            elif self.status[lane, slot] == DECLARED:
+                final_text += "None"
+            else:
+                final_text += str(self.values[lane, slot])
+        return final_text
+
+    def handle_say(self, ins, lanes, pc):
+        for lane in np.arange(self.lanes)[lanes]:
+            self.outputs[lane].append(self.format_say(ins, lane))
+        self.pcs[lanes] = pc + 1
+    def handle_show(self, ins, lanes, pc):
+        lanes = self._operand_lanes(ins, lanes)
+        for lane in np.arange(self.lanes)[lanes]:
+            value = self.values[lane, ins.sa] if self.status[lane, ins.sa] == DEFINED else "None"
+            self.outputs[lane].append(f": {value}")
+        self.pcs[lanes] = pc + 1
+    def handle_goto(self, ins, lanes, pc):
+        self.ticks[lanes] += TICKS[Op.GOTO]
+        if ins.target is None:
+            self.fail(lanes, "Label not found")
+        else:
+            self.pcs[lanes] = ins.target + 1
+    def handle_tag(self, ins, lanes, pc):
+        self.targets[lanes] = self.labels.get(ins.label, -1)
+        self.pcs[lanes] = pc + 1
+    def handle_slf(self, ins, lanes, pc):
+        sp = self.sp[lanes]
+        if sp.max() >= self.stack.shape[1]:
+            self.stack = np.pad(self.stack, ((0, 0), (0, self.stack.shape[1])))
+        self.stack[np.arange(self.lanes)[lanes], sp] = pc + 2
+        self.sp[lanes] = sp + 1
+        self.pcs[lanes] = pc + 1
+    def handle_call(self, ins, lanes, pc):
+        self.ticks[lanes] += TICKS[Op.CALL]
+        lanes = np.arange(self.lanes)[lanes]
+        targets = self.targets[lanes]
+        missing = targets < 0
+        if missing.any():
+            self.fail(lanes[missing], f"Label not found on line :\n{ins.text}")
+        self.pcs[lanes[~missing]] = targets[~missing] + 1
+    def handle_ret(self, ins, lanes, pc):
+        self.ticks[lanes] += TICKS[Op.RET]
+        lanes = np.arange(self.lanes)[lanes]
+        sp = self.sp[lanes]
+        empty = sp == 0
+        if empty.any():
+            self.fail(lanes[empty], "Stack is empty")
+            lanes, sp = lanes[~empty], sp[~empty]
+        self.sp[lanes] = sp - 1
+        self.pcs[lanes] = self.stack[lanes, sp - 1]
+    def handle_if(self, ins, lanes, pc):
+        self.ticks[lanes] += TICKS[Op.IF]
+        if ins.error:
+            self.fail(lanes, ins.error)
+            return
+        values = self.values
+        if ins.sa not in self._defined or ins.sb not in self._defined:
+            if ins.cmp == "=" or ins.cmp == "!=":
+                lanes = self._operand_lanes(ins, lanes)
+                a, b = self.status[lanes, ins.sa], self.status[lanes, ins.sb]
+                res = COMPARE[ins.cmp](values[lanes, ins.sa], values[lanes, ins.sb])
+                # None only equals itself
+                res = np.where((a == DECLARED) | (b == DECLARED), (a == b) == (ins.cmp == "="), res)
+            else:
+                lanes = self._operand_lanes(ins, lanes, f"'{ins.cmp}' not supported between instances of '{{}}' and '{{}}'")
+                res = COMPARE[ins.cmp](values[lanes, ins.sa], values[lanes, ins.sb])
+        else:
+            res = COMPARE[ins.cmp](values[lanes, ins.sa], values[lanes, ins.sb])
+        if ins.target is None:
+            if res.any():
+                self.fail(np.arange(self.lanes)[lanes][res], f"Label not found: {ins.label} in IF line {pc}")
+            lanes = np.arange(self.lanes)[lanes][~res]
+            self.pcs[lanes] = pc + 3
+        else:
+            self.pcs[lanes] = np.where(res, ins.target + 1, pc + 3)
+    def handle_var(self, ins, lanes, pc):
+        self.values[lanes, ins.sa] = 0
+        self.status[lanes, ins.sa] = DECLARED
+        self._defined.discard(ins.sa)
+        self.pcs[lanes] = pc + 1
+    def handle_nop(self, ins, lanes, pc):
+        self.pcs[lanes] = pc + 1
+    handle_cmd = handle_nop
+    handle_else = handle_nop
+    handle_clr = handle_nop
+    def handle_label(self, ins, lanes, pc):
+        # Falling through into a label ends the program
+        self.done[lanes] = True
+    def handle_unknown(self, ins, lanes, pc):
+        self.fail(lanes, f"Unknown command: {ins.text} at line {pc}")
+
+    def lane_state(self, lane):
+        """State of one lane in the same shape as Emulator.get_state()."""
+        registers = {}
+        variables = {}
+        for table, view in ((self.linker.register_slots, registers), (self.linker.variable_slots, variables)):
+            for name, slot in table.items():
+                if slot >= self.values.shape[1]:
+                    continue
+                status = self.status[lane, slot]
+                if status == DEFINED:
+                    view[name] = int(self.values[lane, slot])
+                elif status == DECLARED:
+                    view[name] = None
+        return {
+            'line': int(self.pcs[lane]),
+            'registers': registers,
+            'variables': variables,
+            'stack': [int(v) for v in self.stack[lane, :self.sp[lane]]],
+            'ticks': int(self.ticks[lane]),
+            'instructions': int(self.instructions[lane]),
+            'output': list(self.outputs[lane]),
+            'error': self.errors[lane],
+            'exhausted': self.exhausted[lane],
+        }
+
+    def results(self):
+        return [self.lane_state(lane) for lane in range(self.lanes)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch Assembly Emulator")
+    parser.add_argument("--input", required=True, help="Input .asm file")
+    parser.add_argument("--registers", type=int, default=8, help="Number of registers")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=START:STOP",
+                        help="Sweep a register or variable over a range, one lane per value")
+    parser.add_argument("--max-instructions", type=int, help="Stop a lane after executing this many instructions")
+    parser.add_argument("--max-ticks", type=int, help="Stop a lane once it has used this many game ticks")
+    args = parser.parse_args()
+
+    sweeps = {}
+    for item in args.set:
+        name, span = item.split("=", 1)
+        start, stop = (int(v) for v in span.split(":"))
+        sweeps[name] = np.arange(start, stop)
+    grids = np.meshgrid(*sweeps.values(), indexing="ij") if sweeps else []
+    inputs = {name: grid.ravel() for name, grid in zip(sweeps, grids)}
+    lanes = len(grids[0].ravel()) if grids else 1
+
+    with open(args.input, "r") as f:
+        script = f.read()
+    batch = BatchEmulator(args.registers, lanes, max_instructions=args.max_instructions, max_ticks=args.max_ticks)
+    batch.execute_script(script, inputs)
+    for lane, state in enumerate(batch.results()):
+        label = ", ".join(f"{name}={int(values[lane])}" for name, values in inputs.items())
+        print(f"[{label}] ticks={state['ticks']}" + (f" error={state['error']}" if state['error'] else "")
+              + (f" exhausted={state['exhausted']}" if state['exhausted'] else ""))
+        for text in state['output']:
+            print(f"    {text}")
+
+if __name__ == "__main__":
+    main()
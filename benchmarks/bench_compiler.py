@@ -0,0 +1,74 @@
+"""Lines/second of AssemblerCompiler.build_surface on a generated program.
+
+Usage: python benchmarks/bench_compiler.py [--lines N] [--repeat N]
+"""
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from asm_compiler import AssemblerCompiler  # noqa: E402
+
+# One function body per label, using every instruction the compiler knows
+BODY = [
+    "ADD R0 #1",
+    "SUB R1 #2",
+    "ADD R2 R3",
+    "SUB R2 R1",
+    "MUL R2 R3",
+    "DIV R2 R4",
+    "SET R5 #7",
+    "SET R6 R5",
+    "VAR counter",
+    "SHOW R0",
+    'SAY "value {{R0}} of {{R1}}"',
+    "CMD say hello",
+    "TAG :FUNC_{next}",
+    "SLF",
+    "CALL",
+    "IF R0 < R1 :FUNC_{index}",
+    "ELSE",
+    "CLR",
+    "IF R2 != R3 :FUNC_{next}",
+    "ELSE",
+    "CLR",
+    "GOTO :FUNC_{next}",
+    "RET",
+]
+
+
+def generate(lines):
+    """A program of about ``lines`` lines made of repeated labelled blocks."""
+    blocks = max(1, lines // (len(BODY) + 1))
+    script = []
+    for index in range(blocks):
+        script.append(f":FUNC_{index}")
+        following = (index + 1) % blocks
+        script += [line.format(index=index, next=following) for line in BODY]
+    return script
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compiler throughput benchmark")
+    parser.add_argument("--lines", type=int, default=50000, help="Size of the generated program")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement (best is kept)")
+    args = parser.parse_args()
+
+    script = generate(args.lines)
+    best = None
+    with open(os.devnull, "w") as devnull:
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(devnull):
+                AssemblerCompiler().build_surface(script)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    print(f"build_surface: {len(script)} lines in {best:.3f}s -> {len(script) / best:,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
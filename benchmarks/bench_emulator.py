@@ -0,0 +1,84 @@
+"""Instructions/second of the emulator on a scaled-up test_asm/exponential.asm.
+
+The text baseline decodes the source line on every step, as the
+emulator did before programs were decoded once up front, so the
+speedup of the decoder can be measured from the tree.
+
+Usage: python benchmarks/bench_emulator.py [--iterations N] [--repeat N]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from asm_decoder import decode_line  # noqa: E402
+from emulator import Emulator  # noqa: E402
+from debugger import Debugger  # noqa: E402
+
+
+def scaled_exponential(iterations):
+    """exponential.asm with a base of 1 so the loop can run for as long as we like."""
+    with open(os.path.join(ROOT, "test_asm", "exponential.asm"), "r") as f:
+        script = f.read()
+    return script.replace("SET R0, #3", "SET R0, #1").replace("SET R1, #10", f"SET R1, #{iterations}")
+
+
+def count_instructions(script):
+    debugger = Debugger(8)
+    debugger.load_script(script)
+    count = 0
+    while debugger.step():
+        count += 1
+    return count
+
+
+def run_text_baseline(script):
+    """Run ``script`` decoding each line's text and looking up its label as it executes."""
+    emu = Emulator(8)
+    emu.load_program(script)
+    lines = emu.script
+    while not emu.end and emu.line < len(lines):
+        ins = decode_line(lines[emu.line], emu.line)
+        if ins.label is not None:
+            ins.target = emu.labels.get(ins.label)
+        emu.execute_line(emu.link(ins))
+
+
+def best_time(run, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulator throughput benchmark")
+    parser.add_argument("--iterations", type=int, default=200000, help="POWER_LOOP iterations")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement (best is kept)")
+    args = parser.parse_args()
+
+    script = scaled_exponential(args.iterations)
+    with contextlib.redirect_stdout(io.StringIO()):
+        count = count_instructions(script)
+
+    baseline = best_time(lambda: run_text_baseline(script), args.repeat)
+    print(f"text:        {count} instructions in {baseline:.3f}s -> {count / baseline:,.0f} instructions/s")
+    interpreted = best_time(lambda: Emulator(8).execute_script(script), args.repeat)
+    print(f"interpreted: {count} instructions in {interpreted:.3f}s -> {count / interpreted:,.0f} instructions/s")
+    compiled = best_time(lambda: Emulator(8, compiled=True).execute_script(script), args.repeat)
+    print(f"compiled:    {count} instructions in {compiled:.3f}s -> {count / compiled:,.0f} instructions/s")
+    print(f"speedup:     interpreted {baseline / interpreted:.2f}x, compiled {baseline / compiled:.2f}x over text, "
+          f"compiled {interpreted / compiled:.2f}x over interpreted")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Seconds and peak memory of export_to_schematic against the former mcschematic path.
+
+Usage: python benchmarks/bench_export.py [--lines N] [--repeat N]
+"""
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+import component  # noqa: E402
+from asm_compiler import AssemblerCompiler  # noqa: E402
+from bench_compiler import generate  # noqa: E402
+
+def measure(export, surface, path, repeat):
+    """Best time over ``repeat`` runs, then the peak traced memory of one more."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        export(surface, path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    export(surface, path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Schematic export benchmark")
+    parser.add_argument("--lines", type=int, default=50000, help="Size of the generated program")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement (best is kept)")
+    args = parser.parse_args()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        surface = AssemblerCompiler().build_surface(generate(args.lines))
+    blocks = sum(1 for _ in surface.blocks())
+    with tempfile.TemporaryDirectory() as directory:
+        for name, export in (("mcschematic", component.export_with_mcschematic),
+                             ("schem_writer", component.export_to_schematic)):
+            path = os.path.join(directory, name + ".schem")
+            best, peak = measure(export, surface, path, args.repeat)
+            print(f"{name}: {blocks} blocks in {best:.3f}s -> {blocks / best:,.0f} blocks/s, "
+                  f"peak {peak / 2**20:.1f} MiB, {os.path.getsize(path):,} bytes")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DIRECTORY = os.environ.get("ASM_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "asm-mc"))
+DEFAULT_MAX_BYTES = int(os.environ.get("ASM_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+# Sources whose code decides what the toolchain outputs
+TOOL_SOURCES = ("asm_precompiler.py", "asm_compiler.py", "asm_decoder.py", "layout.py", "component.py",
+                "schem_writer.py")
+_tool_version = None
+# Bytes in each cache directory as last counted by this process, plus what it
+# has stored since; other processes sharing the directory are only seen when
+# it is counted again
+_sizes = {}
+
+def tool_version():
+    """Hash of the toolchain sources, so changing the tools invalidates the cache."""
+    global _tool_version
+    if _tool_version is None:
+        digest = hashlib.sha256()
+        root = os.path.dirname(os.path.abspath(__file__))
+        for name in TOOL_SOURCES:
+            with open(os.path.join(root, name), "rb") as f:
+                digest.update(f.read())
+        _tool_version = digest.hexdigest()
+    return _tool_version
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class BuildCache:
+    """Content-addressed cache of build outputs on disk.
+
+    Each entry is one or more files ``<key><suffix>`` in ``directory``,
+    where the key hashes the tool version and everything the output depends
+    on. Reading an entry refreshes its modification time, and once the
+    directory grows past ``max_bytes`` the least recently used entries are
+    deleted. Several processes may share a directory: a file another one
+    evicts in the meantime is treated as a miss.
+    """
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, *parts):
+        digest = hashlib.sha256(tool_version().encode())
+        for part in parts:
+            digest.update(b"\0" + repr(part).encode())
+        return digest.hexdigest()
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _touch(self, path):
+        # An entry's last use is that of its most recently used file
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def fetch(self, key, suffix, destination):
+        """Copy a cached file to ``destination``; False on a miss."""
+        source = self.path(key, suffix)
+        if not os.path.exists(source):
+            return False
+        directory = os.path.dirname(destination)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            shutil.copyfile(source, destination)
+        except FileNotFoundError:
+            return False
+        self._touch(source)
+        log.info("Build cache hit: %s", destination)
+        return True
+
+    def read(self, key, suffix):
+        """Contents of a cached file as bytes, or None on a miss."""
+        path = self.path(key, suffix)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self._touch(path)
+        return data
+
+    def store(self, key, suffix, source=None, data=None):
+        """Add a file (copied from ``source``, or ``data`` bytes) to the cache."""
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as f:
+            if source is not None:
+                with open(source, "rb") as original:
+                    shutil.copyfileobj(original, f)
+            else:
+                f.write(data)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, self.path(key, suffix))
+        if self.directory not in _sizes:
+            _sizes[self.directory] = sum(size for used, size, paths in self.entries())
+        else:
+            _sizes[self.directory] += size
+        if _sizes[self.directory] > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """(last use, size, [paths]) per key, oldest first."""
+        groups = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            used, size, paths = groups.get(name[:64], (0, 0, []))
+            groups[name[:64]] = (max(used, stat.st_mtime), size + stat.st_size, paths + [path])
+        return sorted(groups.values())
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        entries = self.entries()
+        total = sum(size for used, size, paths in entries)
+        for used, size, paths in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(paths)
+            total -= size
+            log.info("Evicted %s from the build cache", os.path.basename(paths[0])[:64])
+        _sizes[self.directory] = total
+
+    def _remove(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for used, size, paths in self.entries():
+            self._remove(paths)
+        _sizes[self.directory] = 0
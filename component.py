@@ -3,22 +3,83 @@ import numpy as np
 from matplotlib.patches import Rectangle, FancyArrowPatch
 from mcschematic import MCSchematic
 import mcschematic
+import json
+import logging
+import os
 import re
+import schem_writer
+import sys
 import tkinter as tk
 from tkinter import ttk, scrolledtext
 
+log = logging.getLogger(__name__)
+
+# Call stack implementations memory_setup can build (see storage_memory_setup)
+STACK_BACKENDS = ("pile", "storage")
+STACK_STORAGE = "asm:stack"
+# File formats export_to_schematic writes: Sponge schematic or vanilla structure
+EXPORT_FORMATS = ("schem", "nbt")
+
 class CommandBlock:
+    # Large programs hold one of these per instruction: no per-instance
+    # __dict__, and repeated commands and source lines share one string
+    __slots__ = ("command", "type", "orientation", "source_line", "source_code")
+
     def __init__(self, command, command_type="chain", orientation="south", source_line=None, source_code=""):
-        self.command = command
+        self.command = sys.intern(command)
         self.type = command_type
         self.orientation = orientation  # e.g., "south", "north", etc.
         self.source_line = source_line  # Line number in assembly code
-        self.source_code = source_code  # Original assembly code
+        self.source_code = sys.intern(source_code)  # Original assembly code
+
+class CommandSurface:
+    """Grid of command blocks ``cols`` wide, indexed as ``surface[y, x]``.
+
+    Cells are kept in one flat row-major list, so an empty cell costs a
+    single pointer and rows need no list of their own. The compiler,
+    export_to_schematic, the viewer and the grid simulator all go through
+    this API.
+    """
+    __slots__ = ("rows", "cols", "cells")
+
+    def __init__(self, rows, cols=40):
+        self.rows = rows
+        self.cols = cols
+        self.cells = [None] * (rows * cols)
+
+    def __getitem__(self, position):
+        y, x = position
+        if not 0 <= x < self.cols or y < 0:
+            raise IndexError(f"No cell at {position}")
+        return self.cells[y * self.cols + x]
+
+    def __setitem__(self, position, block):
+        y, x = position
+        if not 0 <= x < self.cols or y < 0:
+            raise IndexError(f"No cell at {position}")
+        self.cells[y * self.cols + x] = block
+
+    def add_line(self):
+        self.ensure_rows(self.rows + 1)
+
+    def ensure_rows(self, rows):
+        """Grow the surface to at least ``rows`` rows."""
+        if rows > self.rows:
+            self.cells.extend([None] * ((rows - self.rows) * self.cols))
+            self.rows = rows
+
+    def blocks(self):
+        """Yield ``(y, x, block)`` for every occupied cell, row by row."""
+        cols = self.cols
+        for index, block in enumerate(self.cells):
+            if block is not None:
+                y, x = divmod(index, cols)
+                yield y, x, block
 
 def display_command_block_tk(command_block_matrix, script_lines=None):
     """Display command blocks in a Tkinter window with interactive features."""
-    rows = len(command_block_matrix)
-    cols = len(command_block_matrix[0])
+    rows = command_block_matrix.rows
+    cols = command_block_matrix.cols
     
     # Create main window
     root = tk.Tk()
@@ -103,46 +164,42 @@ def display_command_block_tk(command_block_matrix, script_lines=None):
         arrow_items.clear()
         
         # Draw grid and blocks
-        for i in range(rows):
-            for j in range(cols):
-                # Reverse x-coordinate (mirror horizontally)
-                x1 = (cols - 1 - j) * block_size
-                y1 = i * block_size
-                x2 = x1 + block_size
-                y2 = y1 + block_size
-                
-                if command_block_matrix[i][j] is not None:
-                    cb = command_block_matrix[i][j]
+        for i, j, cb in command_block_matrix.blocks():
+            # Reverse x-coordinate (mirror horizontally)
+            x1 = (cols - 1 - j) * block_size
+            y1 = i * block_size
+            x2 = x1 + block_size
+            y2 = y1 + block_size
                     
-                    # Determine color based on type
-                    if cb.type == "":
-                        color = '#8B4513'  # Brown for impulse
-                    else:
-                        color = '#4CAF50'  # Green for chain
+            # Determine color based on type
+            if cb.type == "":
+                color = '#8B4513'  # Brown for impulse
+            else:
+                color = '#4CAF50'  # Green for chain
                     
-                    # Draw block
-                    rect = canvas.create_rectangle(x1, y1, x2, y2, 
-                                                  fill=color, outline='black', 
-                                                  width=2, tags=f"block_{i}_{j}")
+            # Draw block
+            rect = canvas.create_rectangle(x1, y1, x2, y2, 
+                                          fill=color, outline='black', 
+                                          width=2, tags=f"block_{i}_{j}")
                     
-                    # Add text
-                    if cb.command:
-                        first_word = cb.command.split()[0].replace('/', '')[:6]
-                    else:
-                        # Show arrow based on orientation
-                        arrow_map = {
-                            "east": "↓",
-                            "south": "←",
-                            "north": "→",
-                        }
-                        first_word = arrow_map.get(cb.orientation, "→")
+            # Add text
+            if cb.command:
+                first_word = cb.command.split()[0].replace('/', '')[:6]
+            else:
+                # Show arrow based on orientation
+                arrow_map = {
+                    "east": "↓",
+                    "south": "←",
+                    "north": "→",
+                }
+                first_word = arrow_map.get(cb.orientation, "→")
                     
-                    text = canvas.create_text((x1+x2)/2, (y1+y2)/2, 
-                                             text=first_word, 
-                                             fill='white', font=('Arial', 8, 'bold'),
-                                             tags=f"block_{i}_{j}")
+            text = canvas.create_text((x1+x2)/2, (y1+y2)/2, 
+                                     text=first_word, 
+                                     fill='white', font=('Arial', 8, 'bold'),
+                                     tags=f"block_{i}_{j}")
                     
-                    block_items[(i, j)] = (rect, text)
+            block_items[(i, j)] = (rect, text)
         
         # Draw arrows
         draw_arrows()
@@ -152,49 +209,46 @@ def display_command_block_tk(command_block_matrix, script_lines=None):
     
     def draw_arrows():
         """Draw arrows for GOTO, CALL, RET, IF commands."""
-        for i in range(rows):
-            for j in range(cols):
-                if command_block_matrix[i][j] is not None:
-                    cb = command_block_matrix[i][j]
-                    command = cb.command
+        for i, j, cb in command_block_matrix.blocks():
+            command = cb.command
                     
-                    if "setblock" in command and "redstone_block" in command:
-                        match = re.search(r'setblock ~(-?\d+) ~\d+ ~(-?\d+)', command)
-                        if match:
-                            rel_y = int(match.group(1))
-                            rel_x = int(match.group(2))
+            if "setblock" in command and "redstone_block" in command:
+                match = re.search(r'setblock ~(-?\d+) ~\d+ ~(-?\d+)', command)
+                if match:
+                    rel_y = int(match.group(1))
+                    rel_x = int(match.group(2))
                             
-                            target_i = i + rel_y
-                            target_j = j + rel_x
+                    target_i = i + rel_y
+                    target_j = j + rel_x
                             
-                            # Check if target is a chain command block (abnormal)
-                            is_abnormal = False
-                            if (0 <= target_i < rows and 0 <= target_j < cols and 
-                                command_block_matrix[target_i][target_j] is not None):
-                                target_cb = command_block_matrix[target_i][target_j]
-                                if target_cb.type == "chain":
-                                    is_abnormal = True
+                    # Check if target is a chain command block (abnormal)
+                    is_abnormal = False
+                    if (0 <= target_i < rows and 0 <= target_j < cols and 
+                        command_block_matrix[target_i, target_j] is not None):
+                        target_cb = command_block_matrix[target_i, target_j]
+                        if target_cb.type == "chain":
+                            is_abnormal = True
                             
-                            # Color: red if pointing to chain (abnormal), otherwise match source block
-                            if is_abnormal:
-                                color = '#FF0000'  # Red for abnormal flow (pointing to chain)
-                            elif cb.type == "":
-                                color = '#8B4513'  # Brown for impulse
-                            else:
-                                color = '#00CED1'  # Cyan/turquoise for chain
+                    # Color: red if pointing to chain (abnormal), otherwise match source block
+                    if is_abnormal:
+                        color = '#FF0000'  # Red for abnormal flow (pointing to chain)
+                    elif cb.type == "":
+                        color = '#8B4513'  # Brown for impulse
+                    else:
+                        color = '#00CED1'  # Cyan/turquoise for chain
                             
-                            # Calculate arrow coordinates (reversed x)
-                            x1 = (cols - 1 - j) * block_size + block_size/2
-                            y1 = i * block_size + block_size/2
-                            x2 = (cols - 1 - target_j) * block_size + block_size/2
-                            y2 = target_i * block_size + block_size/2
+                    # Calculate arrow coordinates (reversed x)
+                    x1 = (cols - 1 - j) * block_size + block_size/2
+                    y1 = i * block_size + block_size/2
+                    x2 = (cols - 1 - target_j) * block_size + block_size/2
+                    y2 = target_i * block_size + block_size/2
                             
-                            # Draw arrow in foreground
-                            arrow = canvas.create_line(x1, y1, x2, y2, 
-                                                      arrow=tk.LAST, fill=color,
-                                                      width=2, tags="arrow")
-                            arrow_items.append(arrow)
-                            canvas.tag_raise(arrow)  # Bring arrows to front
+                    # Draw arrow in foreground
+                    arrow = canvas.create_line(x1, y1, x2, y2, 
+                                              arrow=tk.LAST, fill=color,
+                                              width=2, tags="arrow")
+                    arrow_items.append(arrow)
+                    canvas.tag_raise(arrow)  # Bring arrows to front
     
     def on_block_click(event):
         """Handle click on command block."""
@@ -206,8 +260,8 @@ def display_command_block_tk(command_block_matrix, script_lines=None):
         j = cols - 1 - int(x // block_size)
         i = int(y // block_size)
         
-        if 0 <= i < rows and 0 <= j < cols and command_block_matrix[i][j] is not None:
-            cb = command_block_matrix[i][j]
+        if 0 <= i < rows and 0 <= j < cols and command_block_matrix[i, j] is not None:
+            cb = command_block_matrix[i, j]
             
             # Update info label
             info_text = f"Position: ({i}, {j})"
@@ -253,24 +307,21 @@ def display_command_block_tk(command_block_matrix, script_lines=None):
         # Highlight corresponding blocks
         clear_highlights()
         count = 0
-        for i in range(rows):
-            for j in range(cols):
-                if command_block_matrix[i][j] is not None:
-                    cb = command_block_matrix[i][j]
-                    if cb.source_line == line_num:
-                        # Reversed x-coordinate
-                        x1 = (cols - 1 - j) * block_size
-                        y1 = i * block_size
-                        x2 = x1 + block_size
-                        y2 = y1 + block_size
-                        highlight = canvas.create_rectangle(x1, y1, x2, y2, 
-                                                           outline='cyan', 
-                                                           fill='cyan',
-                                                           stipple='gray50',
-                                                           width=3,
-                                                           tags="highlight")
-                        highlighted_items.append(highlight)
-                        count += 1
+        for i, j, cb in command_block_matrix.blocks():
+            if cb.source_line == line_num:
+                # Reversed x-coordinate
+                x1 = (cols - 1 - j) * block_size
+                y1 = i * block_size
+                x2 = x1 + block_size
+                y2 = y1 + block_size
+                highlight = canvas.create_rectangle(x1, y1, x2, y2, 
+                                                   outline='cyan', 
+                                                   fill='cyan',
+                                                   stipple='gray50',
+                                                   width=3,
+                                                   tags="highlight")
+                highlighted_items.append(highlight)
+                count += 1
         
         if count > 0:
             info_label.config(text=f"Assembly Line {line_num}: {script_lines[line_num-1].strip()} → {count} block(s)")
@@ -319,100 +370,332 @@ def display_command_block(command_block_matrix, script_lines=None):
 
 def add_line(command_surface):
     '''Adds a line to the command surface.'''
-    command_surface.append([None for _ in range(len(command_surface[0]))])
+    command_surface.add_line()
 
 
-def memory_setup(stack_size=3):
-    '''Sets up the command surface in memory.'''
+def memory_setup(stack_size=3, backend="pile"):
+    '''Sets up the command surface in memory.
+
+    The "pile" stack keeps each return address in its own armor stand, so a
+    push or pop runs stack_size commands; "storage" is storage_memory_setup.
+    '''
+    if backend == "storage":
+        return storage_memory_setup(stack_size)
+    if backend != "pile":
+        raise ValueError(f"Unknown stack backend: {backend}")
     #### initialize regex
-    command_surface = [[None for _ in range(40)] for _ in range(6)]
+    command_surface = CommandSurface(6, 40)
     index = 0
-    command_surface[0][index]  = CommandBlock("say initializing regex ...", "")
-    command_surface[0][index+1]  = CommandBlock("/kill @e[type=armor_stand,tag=temp_origin]")
-    command_surface[0][index+2]  = CommandBlock("/kill @e[type=armor_stand,tag=temp_destination]")
+    command_surface[0, index] = CommandBlock("say initializing regex ...", "")
+    command_surface[0, index+1] = CommandBlock("/kill @e[type=armor_stand,tag=temp_origin]")
+    command_surface[0, index+2] = CommandBlock("/kill @e[type=armor_stand,tag=temp_destination]")
 
     index += 3
     for i in range(stack_size):
-        command_surface[0][i+index] = CommandBlock(f"/kill @e[type=armor_stand,tag=pile_{i}]")
+        command_surface[0, i+index] = CommandBlock(f"/kill @e[type=armor_stand,tag=pile_{i}]")
     index += stack_size
-    command_surface[0][index] = CommandBlock('/scoreboard objectives add pileIndex dummy "Index Pile"')
+    command_surface[0, index] = CommandBlock('/scoreboard objectives add pileIndex dummy "Index Pile"')
     index += 1
     for i in range(stack_size):
-        command_surface[0][index+i] = CommandBlock(f"/summon minecraft:armor_stand ~ ~ ~ {{Tags:[\"pile_{i}\"],NoGravity:1b}}")
+        command_surface[0, index+i] = CommandBlock(f"/summon minecraft:armor_stand ~ ~ ~ {{Tags:[\"pile_{i}\"],NoGravity:1b}}")
     index += stack_size-1
-    command_surface[0][index+1] = CommandBlock("/scoreboard players set #currentPileIndex pileIndex -1")
-    command_surface[0][index+2] = CommandBlock("""/tellraw @a {"text":"Index Pile: ","color":"gold","extra":[{"score":{"name":"#currentPileIndex","objective":"pileIndex"},"color":"aqua"}]}""")
-    command_surface[0][index+3] = CommandBlock("/summon minecraft:armor_stand ~ ~ ~ {Tags:[\"temp_origin\"],NoGravity:1b}")
-    command_surface[0][index+4] = CommandBlock("/summon minecraft:armor_stand ~ ~ ~ {Tags:[\"temp_destination\"],NoGravity:1b}")
+    command_surface[0, index+1] = CommandBlock("/scoreboard players set #currentPileIndex pileIndex -1")
+    command_surface[0, index+2] = CommandBlock("""/tellraw @a {"text":"Index Pile: ","color":"gold","extra":[{"score":{"name":"#currentPileIndex","objective":"pileIndex"},"color":"aqua"}]}""")
+    command_surface[0, index+3] = CommandBlock("/summon minecraft:armor_stand ~ ~ ~ {Tags:[\"temp_origin\"],NoGravity:1b}")
+    command_surface[0, index+4] = CommandBlock("/summon minecraft:armor_stand ~ ~ ~ {Tags:[\"temp_destination\"],NoGravity:1b}")
     index += 5
 
     #### initialize regex add pile
-    command_surface[1][1] = CommandBlock("setblock ~ ~1 ~ minecraft:air", "")
+    command_surface[1, 1] = CommandBlock("setblock ~ ~1 ~ minecraft:air", "")
     index = 2
-    command_surface[1][index] = CommandBlock("/scoreboard players add #currentPileIndex pileIndex 1")
+    command_surface[1, index] = CommandBlock("/scoreboard players add #currentPileIndex pileIndex 1")
     index += 1
     for i in range(stack_size):
-        command_surface[1][index+i] = CommandBlock(f"execute at @e[type=armor_stand,tag=temp_origin] if score #currentPileIndex pileIndex matches {i} run tp @e[type=armor_stand,tag=pile_{i}] ~ ~ ~")
+        command_surface[1, index+i] = CommandBlock(f"execute at @e[type=armor_stand,tag=temp_origin] if score #currentPileIndex pileIndex matches {i} run tp @e[type=armor_stand,tag=pile_{i}] ~ ~ ~")
     index += stack_size
-    command_surface[1][index] = CommandBlock("execute at @e[type=armor_stand,tag=temp_destination] run setblock ~ ~ ~ minecraft:redstone_block")
-    command_surface[1][index+1] = CommandBlock("execute at @e[type=armor_stand,tag=temp_destination] run setblock ~ ~ ~ minecraft:air")
-    #command_surface[1][index+2] = CommandBlock("/tellraw @a {\"text\":\"Index Pile: \",\"color\":\"gold\",\"extra\":[{\"score\":{\"name\":\"#currentPileIndex\",\"objective\":\"pileIndex\"},\"color\":\"aqua\"}]}")
+    command_surface[1, index] = CommandBlock("execute at @e[type=armor_stand,tag=temp_destination] run setblock ~ ~ ~ minecraft:redstone_block")
+    command_surface[1, index+1] = CommandBlock("execute at @e[type=armor_stand,tag=temp_destination] run setblock ~ ~ ~ minecraft:air")
+    #command_surface[1, index+2] = CommandBlock("/tellraw @a {\"text\":\"Index Pile: \",\"color\":\"gold\",\"extra\":[{\"score\":{\"name\":\"#currentPileIndex\",\"objective\":\"pileIndex\"},\"color\":\"aqua\"}]}")
     index += 3-1
 
     #### initialize regex remove pile
-    command_surface[2][0] = CommandBlock("setblock ~ ~1 ~ minecraft:air", "")
+    command_surface[2, 0] = CommandBlock("setblock ~ ~1 ~ minecraft:air", "")
     index = 1
     for i in range(stack_size):
-        command_surface[2][index+i] = CommandBlock(f"execute at @e[type=armor_stand,tag=pile_{i}] if score #currentPileIndex pileIndex matches {i} run tp @e[type=armor_stand,tag=temp_origin] ~ ~ ~")
+        command_surface[2, index+i] = CommandBlock(f"execute at @e[type=armor_stand,tag=pile_{i}] if score #currentPileIndex pileIndex matches {i} run tp @e[type=armor_stand,tag=temp_origin] ~ ~ ~")
     index += stack_size
-    command_surface[2][index] = CommandBlock("/scoreboard players remove #currentPileIndex pileIndex 1")
-    command_surface[2][index+1] = CommandBlock("execute at @e[type=armor_stand,tag=temp_origin] run setblock ~ ~ ~ minecraft:redstone_block")
-    command_surface[2][index+2] = CommandBlock("execute at @e[type=armor_stand,tag=temp_origin] run setblock ~ ~ ~ minecraft:air")
-    #command_surface[2][index+3] = CommandBlock("/tellraw @a {\"text\":\"Index Pile: \",\"color\":\"gold\",\"extra\":[{\"score\":{\"name\":\"#currentPileIndex\",\"objective\":\"pileIndex\"},\"color\":\"aqua\"}]}")
+    command_surface[2, index] = CommandBlock("/scoreboard players remove #currentPileIndex pileIndex 1")
+    command_surface[2, index+1] = CommandBlock("execute at @e[type=armor_stand,tag=temp_origin] run setblock ~ ~ ~ minecraft:redstone_block")
+    command_surface[2, index+2] = CommandBlock("execute at @e[type=armor_stand,tag=temp_origin] run setblock ~ ~ ~ minecraft:air")
+    #command_surface[2, index+3] = CommandBlock("/tellraw @a {\"text\":\"Index Pile: \",\"color\":\"gold\",\"extra\":[{\"score\":{\"name\":\"#currentPileIndex\",\"objective\":\"pileIndex\"},\"color\":\"aqua\"}]}")
     index += 4-1
     return command_surface
 
-def export_to_schematic(command_block_matrix, filename="command_blocks.schem"):
-    '''Converts the command block matrix to a WorldEdit schematic file using mcschematic.'''
-    rows = len(command_block_matrix)
-    cols = len(command_block_matrix[0])
-    
-    # Create a new schematic
-    schem = MCSchematic()
-    
-    # Fill the schematic with command blocks
-    for i in range(rows):
-        for j in range(cols):
-            if command_block_matrix[i][j] is not None:
-                command_block = command_block_matrix[i][j]
-                # Determine block type (first block is impulse, rest are chain)
-                if command_block.type == "":
-                    block_type = "minecraft:command_block"
-                    auto = 0
-                elif command_block.type == "chain":
-                    block_type = "minecraft:chain_command_block"
-                    auto = 1
-                
-                # Set command block at position with proper NBT data
-                command = command_block.command.replace("'", "\\'")
-                block_string = f"{block_type}[facing={command_block.orientation}]{{Command:'{command}',auto:{auto},UpdateLastExecution:0b}}"
-
-                schem.setBlock((i, 0, j), block_string)
-
-    # Save the schematic file
+def storage_memory_setup(stack_size=3):
+    '''Memory setup whose call stack lives in command storage.
+
+    A push appends the Pos of temp_origin to the STACK_STORAGE list and a
+    pop copies the last entry back and removes it, a fixed number of
+    commands whatever the depth. The push (row 1, column 1) and pop (row
+    2, column 0) entry points are where CALL and RET expect them.
+    #currentPileIndex still counts the depth, and calls deeper than
+    stack_size are not recorded, like on the pile.
+    '''
+    command_surface = CommandSurface(6, 40)
+    origin = "@e[type=armor_stand,tag=temp_origin,limit=1]"
+    in_stack = f"execute if score #currentPileIndex pileIndex matches 0..{stack_size-1} run"
+    setup = [
+        CommandBlock("say initializing regex ...", ""),
+        CommandBlock("/kill @e[type=armor_stand,tag=temp_origin]"),
+        CommandBlock("/kill @e[type=armor_stand,tag=temp_destination]"),
+        CommandBlock('/scoreboard objectives add pileIndex dummy "Index Pile"'),
+        CommandBlock("/scoreboard players set #currentPileIndex pileIndex -1"),
+        CommandBlock(f"/data modify storage {STACK_STORAGE} frames set value []"),
+        CommandBlock("/summon minecraft:armor_stand ~ ~ ~ {Tags:[\"temp_origin\"],NoGravity:1b}"),
+        CommandBlock("/summon minecraft:armor_stand ~ ~ ~ {Tags:[\"temp_destination\"],NoGravity:1b}"),
+    ]
+    push = [
+        CommandBlock("setblock ~ ~1 ~ minecraft:air", ""),
+        CommandBlock("/scoreboard players add #currentPileIndex pileIndex 1"),
+        CommandBlock(f"{in_stack} data modify storage {STACK_STORAGE} frames append from entity {origin} Pos"),
+        CommandBlock("execute at @e[type=armor_stand,tag=temp_destination] run setblock ~ ~ ~ minecraft:redstone_block"),
+        CommandBlock("execute at @e[type=armor_stand,tag=temp_destination] run setblock ~ ~ ~ minecraft:air"),
+    ]
+    pop = [
+        CommandBlock("setblock ~ ~1 ~ minecraft:air", ""),
+        CommandBlock(f"{in_stack} data modify entity {origin} Pos set from storage {STACK_STORAGE} frames[-1]"),
+        CommandBlock(f"{in_stack} data remove storage {STACK_STORAGE} frames[-1]"),
+        CommandBlock("/scoreboard players remove #currentPileIndex pileIndex 1"),
+        CommandBlock("execute at @e[type=armor_stand,tag=temp_origin] run setblock ~ ~ ~ minecraft:redstone_block"),
+        CommandBlock("execute at @e[type=armor_stand,tag=temp_origin] run setblock ~ ~ ~ minecraft:air"),
+    ]
+    for y, x, blocks in ((0, 0, setup), (1, 1, push), (2, 0, pop)):
+        for i, block in enumerate(blocks):
+            command_surface[y, x + i] = block
+    return command_surface
+
+def schematic_path(filename, export_format="schem"):
+    """Path export_to_schematic writes for ``filename`` (the format's extension is added if missing)."""
+    name = os.path.basename(filename)
+    for known in EXPORT_FORMATS:
+        if name.endswith("." + known):
+            name = name[:-len(known) - 1]
+            break
+    return os.path.join(os.path.dirname(filename), f"{name}.{export_format}")
+
+def export_path(filename, export_format="schem", chunk_size=None):
+    """The file export_to_schematic reports: the schematic, or the chunk manifest with ``chunk_size``."""
+    path = schematic_path(filename, export_format)
+    if chunk_size is None:
+        return path
+    return os.path.splitext(path)[0] + ".chunks.json"
+
+def surface_chunks(command_block_matrix, size):
+    """Yield ``(row, column, chunk)`` for every ``size`` x ``size`` piece of the matrix holding blocks.
+
+    A chunk is a CommandSurface whose cell (0, 0) is cell (row, column) of
+    the matrix; the last row and column of chunks may be smaller.
+    """
+    rows, cols = command_block_matrix.rows, command_block_matrix.cols
+    cells = command_block_matrix.cells
+    for row in range(0, rows, size):
+        for column in range(0, cols, size):
+            chunk = CommandSurface(min(size, rows - row), min(size, cols - column))
+            for y in range(chunk.rows):
+                start = (row + y) * cols + column
+                chunk.cells[y * chunk.cols:(y + 1) * chunk.cols] = cells[start:start + chunk.cols]
+            if any(block is not None for block in chunk.cells):
+                yield row, column, chunk
+
+def surface_to_dict(command_block_matrix):
+    """JSON-friendly form of a command block matrix, for the build cache."""
+    blocks = [[i, j, block.command, block.type, block.orientation, block.source_line, block.source_code]
+              for i, j, block in command_block_matrix.blocks()]
+    return {"rows": command_block_matrix.rows, "cols": command_block_matrix.cols, "blocks": blocks}
+
+def surface_from_dict(data):
+    """Inverse of surface_to_dict."""
+    matrix = CommandSurface(data["rows"], data["cols"])
+    for i, j, command, command_type, orientation, source_line, source_code in data["blocks"]:
+        matrix[i, j] = CommandBlock(command, command_type, orientation, source_line, source_code)
+    return matrix
+
+def export_to_schematic(command_block_matrix, filename="command_blocks.schem", on_event=None, version=2,
+                        export_format="schem", chunk_size=None):
+    '''Converts the command block matrix to a WorldEdit schematic file.
+
+    ``export_format`` is "schem" for a Sponge schematic (``version`` 2 or 3)
+    or "nbt" for a vanilla structure, both written by schem_writer.
+
+    With ``chunk_size``, the matrix is cut into pieces of at most
+    ``chunk_size`` x ``chunk_size`` blocks, saved as
+    ``<name>_<i>_<j>.<format>`` next to a manifest ``<name>.chunks.json``
+    that lists each file with its offset (x, y, z) from cell (0, 0).
+    Placed at their offsets, the pieces rebuild the grid, so relative
+    commands like the ``setblock ~dy ~1 ~dx`` of CALL and RET still reach
+    their targets across chunk boundaries. A schematic chunk carries its
+    offset as its WorldEdit offset: pasting every chunk from one spot
+    rebuilds the grid too.
+
+    on_event(kind, data) receives an "export_block" event per placed block
+    and a "saved" event with the path of export_path.
+    '''
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    if chunk_size is not None and chunk_size < 1:
+        raise ValueError(f"Chunk size must be positive: {chunk_size}")
+    path = schematic_path(filename, export_format)
+    if export_format == "nbt":
+        writer = schem_writer.StructureWriter()
+    else:
+        writer = schem_writer.SchematicWriter(version)
     try:
-        import os
-        # Extract path and filename from the filename argument
-        output_path = os.path.dirname(filename)
-        schem_name = os.path.basename(filename).replace(".schem", "")
-        
-        schem.save(outputFolderPath=output_path, schemName=schem_name, 
-                  version=mcschematic.Version.JE_1_18_2)
-        print(f"Schematic saved as {schem_name}.schem in {output_path}")
-        return True
+        if chunk_size is None:
+            writer.write(command_block_matrix, path, on_event)
+        else:
+            path = write_chunks(writer, command_block_matrix, path, export_format, chunk_size, on_event)
     except Exception as e:
-        print(f"Error saving schematic: {e}")
+        log.error("Error saving schematic: %s", e)
         return False
+    if on_event is not None:
+        on_event("saved", {"path": path})
+    return True
+
+def write_chunks(writer, command_block_matrix, path, export_format, chunk_size, on_event=None):
+    """Write the chunks of the matrix next to ``path`` and their manifest; returns the manifest path."""
+    base = os.path.splitext(path)[0]
+    chunks = []
+    for row, column, chunk in surface_chunks(command_block_matrix, chunk_size):
+        chunk_path = f"{base}_{row // chunk_size}_{column // chunk_size}.{export_format}"
+        if export_format == "nbt":
+            blocks = writer.write(chunk, chunk_path, on_event, origin=(row, column))
+        else:
+            # Uncropped, so the schematic's corner is the offset in the manifest
+            blocks = writer.write(chunk, chunk_path, on_event, origin=(row, column), crop=False)
+        chunks.append({"file": os.path.basename(chunk_path), "offset": [row, 0, column],
+                       "size": [chunk.rows, 1, chunk.cols], "blocks": blocks})
+    manifest = {"format": export_format, "chunk_size": chunk_size,
+                "size": [command_block_matrix.rows, 1, command_block_matrix.cols], "chunks": chunks}
+    manifest_path = base + ".chunks.json"
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    log.info("%d chunks saved with manifest %s", len(chunks), manifest_path)
+    return manifest_path
+
+def placed_path(filename):
+    """Record of the grid export_delta last exported for ``filename``."""
+    return os.path.splitext(schematic_path(filename))[0] + ".placed.json"
+
+def surface_delta(previous, current):
+    """Cells that differ between two matrices, as ``(y, x, old block, new block)``.
+
+    A block is None where its cell is empty; blocks are equal when their
+    command, type and orientation are.
+    """
+    def key(block):
+        return None if block is None else (block.command, block.type, block.orientation)
+
+    old = {(i, j): block for i, j, block in previous.blocks()}
+    changes = []
+    for i, j, block in current.blocks():
+        before = old.pop((i, j), None)
+        if key(before) != key(block):
+            changes.append((i, j, before, block))
+    changes.extend((i, j, block, None) for (i, j), block in old.items())
+    return changes
+
+def delta_commands(changes, origin):
+    """Commands applying ``changes`` to the grid placed with cell (0, 0) at ``origin`` (x, y, z).
+
+    ``setblock`` leaves the block entity alone when the block state does
+    not change, so a block that only has a new command gets ``data merge``.
+    """
+    ox, oy, oz = origin
+    commands = []
+    for i, j, before, block in changes:
+        position = f"{ox + i} {oy} {oz + j}"
+        if block is None:
+            commands.append(f"setblock {position} minecraft:air")
+        elif before is not None and schem_writer.block_state(before) == schem_writer.block_state(block):
+            commands.append(f"data merge block {position} {{Command:{schem_writer.snbt_string(block.command)}}}")
+        else:
+            commands.append(f"setblock {position} {schem_writer.block_string(block)}")
+    return commands
+
+def export_delta(command_block_matrix, filename, origin, max_changed=0.5, on_event=None, **export_options):
+    '''Export only the blocks that changed since the last export_delta of ``filename``.
+
+    ``origin`` is the world position (x, y, z) of cell (0, 0) of the grid
+    in the world. The grid exported last time is read from
+    placed_path(filename). The changed, added and removed cells are
+    written as absolute ``setblock`` commands to
+    ``<name>.delta.mcfunction``. When there is no previous export, the
+    origin or grid width changed, or more than ``max_changed`` of the
+    blocks differ (the layout shifted), a full export_to_schematic is done
+    instead with ``export_options``. Either way the current grid is
+    recorded for the next call.
+
+    Returns a report dict with the "mode" ("delta" or "full"), the
+    "changed", "added" and "removed" block counts (every block counts as
+    added when there was nothing to compare with) and the "path" written,
+    or None when saving failed.
+    '''
+    origin = list(origin)
+    previous = None
+    try:
+        with open(placed_path(filename), "r") as f:
+            placed = json.load(f)
+        if placed["origin"] == origin:
+            previous = surface_from_dict(placed["surface"])
+    except (OSError, ValueError, KeyError) as e:
+        log.info("No usable record of the last export for %s (%s), doing a full export", filename, e)
+
+    report = {"mode": "full", "changed": 0, "added": sum(1 for _ in command_block_matrix.blocks()), "removed": 0}
+    if previous is not None and previous.cols == command_block_matrix.cols:
+        changes = surface_delta(previous, command_block_matrix)
+        report["added"] = sum(1 for _, _, before, _ in changes if before is None)
+        report["removed"] = sum(1 for _, _, _, block in changes if block is None)
+        report["changed"] = len(changes) - report["added"] - report["removed"]
+        blocks = max(sum(1 for _ in previous.blocks()), sum(1 for _ in command_block_matrix.blocks()), 1)
+        if len(changes) <= max_changed * blocks:
+            report["mode"] = "delta"
+        else:
+            log.info("%d of %d blocks differ, doing a full export", len(changes), blocks)
+
+    delta_path = os.path.splitext(schematic_path(filename))[0] + ".delta.mcfunction"
+    try:
+        if report["mode"] == "delta":
+            path = delta_path
+            with open(path, "w") as f:
+                f.writelines(command + "\n" for command in delta_commands(changes, origin))
+            if on_event is not None:
+                on_event("saved", {"path": path})
+        else:
+            # A patch for the previous grid must not be applied over the new one
+            if os.path.exists(delta_path):
+                os.remove(delta_path)
+            if not export_to_schematic(command_block_matrix, filename, on_event=on_event, **export_options):
+                return None
+            path = export_path(filename, export_options.get("export_format", "schem"), export_options.get("chunk_size"))
+        with open(placed_path(filename), "w") as f:
+            json.dump({"origin": origin, "surface": surface_to_dict(command_block_matrix)}, f)
+    except OSError as e:
+        log.error("Error saving delta export: %s", e)
+        return None
+    report["path"] = path
+    log.info("%s export: %d changed, %d added, %d removed blocks", report["mode"], report["changed"],
+             report["added"], report["removed"])
+    return report
+
+def export_with_mcschematic(command_block_matrix, filename="command_blocks.schem"):
+    '''The former export path through mcschematic.setBlock block strings, kept for comparison.'''
+    schem = MCSchematic()
+    for i, j, command_block in command_block_matrix.blocks():
+        schem.setBlock((i, 0, j), schem_writer.block_string(command_block))
+    schem.save(outputFolderPath=os.path.dirname(filename),
+               schemName=os.path.basename(filename).replace(".schem", ""),
+               version=mcschematic.Version.JE_1_18_2)
+    return schematic_path(filename)
 
 if __name__ == "__main__":
     # Initialize the command surface
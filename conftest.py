@@ -0,0 +1,7 @@
+import pytest
+from emulator import Emulator
+
+
+@pytest.fixture
+def emu():
+    return Emulator(reg_size=4)
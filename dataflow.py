@@ -0,0 +1,549 @@
+import argparse
+import sys
+from asm_decoder import Op, Kind
+from peephole import RULES, Peephole, decode, equivalent, format_report, is_slot, operand_text
+
+PASSES = ("unreachable", "jump-thread", "invert-branch", "copy-propagation", "dead-store")
+
+# The precompiler's scratch slots only carry values inside the expansion of
+# one statement, so their final values are not part of the result
+SCRATCH = ("SYS.OPR.TEMP", "SYS.OPR.IP", "SYS.OPR.FP")
+
+# A CMD mentioning one of these may read or write any scoreboard slot;
+# other commands (tp, summon, setblock, ...) leave the slots alone
+SCORE_KEYWORDS = ("score", "REG", "function", "trigger")
+
+NEGATED = {"=": "!=", "!=": "=", "<": ">=", ">=": "<", ">": "<=", "<=": ">"}
+STORES = (Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.SET)
+NO_FALLTHROUGH = (Op.GOTO, Op.RET, Op.CALL, Op.UNKNOWN)
+EXIT = -1
+
+def bits(mask):
+    """Indices of the set bits of ``mask``."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+class ControlFlowGraph:
+    """Basic blocks of an .asm program and the edges between them.
+
+    Control enters a block at the program start, at a label (GOTO and IF
+    targets, and CALL through the TAG before it), after an IF/ELSE/CLR
+    triple when the condition is false, or at a return point, two
+    instructions after an SLF. Running into a label ends the program, so
+    that is an edge to EXIT rather than to the label's block. RET may go
+    back to any return point, or end the program on an empty stack.
+
+    In game a GOTO or RET only takes effect once its chain has run, so
+    the instructions between it and the next label still run first (the
+    emulator skips them). Both orders are edges: the jump block goes to
+    its targets and to that trailing code, which goes on to the same
+    targets.
+
+    ``uses``, ``defs`` and ``clobbers`` are per-instruction bitmasks over
+    ``slots``: slots read, slots always overwritten, and slots that may
+    change (VAR, and CMDs that touch scores).
+
+    Raises ValueError for programs it cannot model: duplicate labels, an
+    IF not followed by ELSE and CLR, an SLF not followed by CALL, or a
+    CALL without a TAG before it in its block, or a second jump in the
+    code trailing a GOTO or RET.
+    """
+    def __init__(self, program):
+        self.program = program
+        n = len(program)
+        self.labels = {}
+        for i, ins in enumerate(program):
+            if ins.op is Op.LABEL:
+                if ins.label in self.labels:
+                    raise ValueError(f"Duplicate label {ins.label}")
+                self.labels[ins.label] = i
+        leaders = {0} if n else set()
+        returns = []
+        for i, ins in enumerate(program):
+            if ins.op is Op.LABEL:
+                leaders.add(i)
+            elif ins.op in NO_FALLTHROUGH:
+                leaders.add(i + 1)
+            elif ins.op is Op.IF:
+                if i + 2 >= n or program[i + 1].op is not Op.ELSE or program[i + 2].op is not Op.CLR:
+                    raise ValueError(f"IF without ELSE and CLR: {ins.text}")
+                leaders.add(i + 3)
+            elif ins.op is Op.SLF:
+                if i + 1 >= n or program[i + 1].op is not Op.CALL:
+                    raise ValueError(f"SLF not followed by CALL: {ins.text}")
+                returns.append(i + 2)
+        starts = sorted(leader for leader in leaders if leader < n)
+        self.blocks = [(start, starts[b + 1] if b + 1 < len(starts) else n) for b, start in enumerate(starts)]
+        self.block_of = [0] * n
+        for b, (start, end) in enumerate(self.blocks):
+            for i in range(start, end):
+                self.block_of[i] = b
+        self.return_points = [self.block_of[i] for i in returns if i < n]
+        self.successors = []
+        pending = None  # targets of the jump whose trailing code this is
+        for b, (start, end) in enumerate(self.blocks):
+            if program[start].op is Op.LABEL:
+                pending = None
+            successors = self.block_successors(b)
+            last = program[end - 1]
+            if pending is not None:
+                if last.op in NO_FALLTHROUGH or last.op is Op.CLR:
+                    raise ValueError(f"Jump in the code after a GOTO or RET: {last.text}")
+                successors = successors + pending
+            elif last.op in (Op.GOTO, Op.RET) and end < n and program[end].op is not Op.LABEL:
+                pending = successors
+                successors = successors + [b + 1]
+            self.successors.append(successors)
+        self.predecessors = [[] for _ in self.blocks]
+        for b, successors in enumerate(self.successors):
+            for s in successors:
+                if s != EXIT:
+                    self.predecessors[s].append(b)
+        self.build_slots()
+
+    def target(self, label):
+        return self.block_of[self.labels[label]] if label in self.labels else EXIT
+
+    def fall(self, i):
+        """Where execution goes after running past instruction i - 1."""
+        if i >= len(self.program) or self.program[i].op is Op.LABEL:
+            return EXIT
+        return self.block_of[i]
+
+    def callee(self, b):
+        """Label called by the CALL ending block b."""
+        start, end = self.blocks[b]
+        for i in range(end - 2, start - 1, -1):
+            if self.program[i].op is Op.TAG:
+                return self.program[i].label
+        raise ValueError(f"CALL without TAG: {self.program[end - 1].text}")
+
+    def block_successors(self, b):
+        start, end = self.blocks[b]
+        last = self.program[end - 1]
+        if last.op is Op.GOTO:
+            return [self.target(last.label)]
+        if last.op is Op.RET:
+            return self.return_points + [EXIT]
+        if last.op is Op.CALL:
+            return [self.target(self.callee(b))]
+        if last.op is Op.UNKNOWN:
+            return [EXIT]
+        if last.op is Op.CLR and end - 3 >= start and self.program[end - 3].op is Op.IF:
+            return [self.target(self.program[end - 3].label), self.fall(end)]
+        return [self.fall(end)]
+
+    def build_slots(self):
+        self.slots = {}
+        for ins in self.program:
+            for operand in (ins.a, ins.b):
+                if is_slot(operand):
+                    self.slots.setdefault(operand[1], len(self.slots))
+            if ins.op is Op.SAY:
+                for is_name, text in ins.parts:
+                    if is_name:
+                        self.slots.setdefault(text, len(self.slots))
+        self.all_slots = (1 << len(self.slots)) - 1
+        self.uses, self.defs, self.clobbers = [], [], []
+        for ins in self.program:
+            op = ins.op
+            uses = defs = clobbers = 0
+            if op in STORES:
+                defs = clobbers = self.mask(ins.a)
+                uses = self.mask(ins.b) | (defs if op is not Op.SET else 0)
+            elif op is Op.IF:
+                uses = self.mask(ins.a) | self.mask(ins.b)
+            elif op is Op.SHOW:
+                uses = self.mask(ins.a)
+            elif op is Op.VAR:
+                # Resets the slot in the emulator, leaves it alone in game
+                uses = clobbers = self.mask(ins.a)
+            elif op is Op.SAY:
+                for is_name, text in ins.parts:
+                    if is_name:
+                        uses |= 1 << self.slots[text]
+            elif op is Op.CMD and any(keyword in ins.text for keyword in SCORE_KEYWORDS):
+                uses = clobbers = self.all_slots
+            self.uses.append(uses)
+            self.defs.append(defs)
+            self.clobbers.append(clobbers)
+
+    def mask(self, operand):
+        return 1 << self.slots[operand[1]] if is_slot(operand) else 0
+
+    def reachable(self):
+        """Blocks that can run, following RET only to return points of reachable calls."""
+        seen = set()
+        pending = [0] if self.blocks else []
+        returns_to = {}  # return point block -> reached
+        returned = False
+        while pending:
+            b = pending.pop()
+            if b in seen or b == EXIT:
+                continue
+            seen.add(b)
+            start, end = self.blocks[b]
+            last = self.program[end - 1]
+            for i in range(start, end):
+                ins = self.program[i]
+                if ins.op is Op.TAG:
+                    # Jumped to by whichever CALL runs next
+                    pending.append(self.target(ins.label))
+                elif ins.op is Op.SLF and i + 2 < len(self.program):
+                    returns_to[self.block_of[i + 2]] = True
+                    if returned:
+                        pending.append(self.block_of[i + 2])
+            if last.op is Op.RET:
+                if not returned:
+                    returned = True
+                    pending.extend(returns_to)
+                if end < len(self.program) and self.program[end].op is not Op.LABEL:
+                    pending.append(b + 1)
+            else:
+                pending.extend(self.successors[b])
+        return seen
+
+    def liveness(self, exit_live):
+        """Slots live on entry to and exit from every block, as bitmasks."""
+        count = len(self.blocks)
+        live_in, live_out = [0] * count, [0] * count
+        changed = True
+        while changed:
+            changed = False
+            for b in reversed(range(count)):
+                out = 0
+                for s in self.successors[b]:
+                    out |= exit_live if s == EXIT else live_in[s]
+                live = out
+                start, end = self.blocks[b]
+                for i in range(end - 1, start - 1, -1):
+                    live = (live & ~self.defs[i]) | self.uses[i]
+                if out != live_out[b] or live != live_in[b]:
+                    live_out[b], live_in[b] = out, live
+                    changed = True
+        return live_in, live_out
+
+    def reaching_definitions(self):
+        """Definitions (instruction bitmasks) reaching the entry of every block.
+
+        Every instruction that may change a slot is a definition; only the
+        ones that always overwrite it kill the earlier definitions.
+        """
+        defined_by = [0] * len(self.slots)
+        for i, clobbers in enumerate(self.clobbers):
+            for slot in bits(clobbers):
+                defined_by[slot] |= 1 << i
+        self.defined_by = defined_by
+        count = len(self.blocks)
+        reach_in, reach_out = [0] * count, [0] * count
+        changed = True
+        while changed:
+            changed = False
+            for b in range(count):
+                reach = 0
+                for p in self.predecessors[b]:
+                    reach |= reach_out[p]
+                reach_in[b] = reach
+                reach = self.reach_through(b, reach, self.blocks[b][1])
+                if reach != reach_out[b]:
+                    reach_out[b] = reach
+                    changed = True
+        return reach_in
+
+    def reach_through(self, b, reach, stop):
+        """Reaching definitions just before instruction ``stop`` of block b."""
+        for i in range(self.blocks[b][0], stop):
+            if self.clobbers[i]:
+                for slot in bits(self.defs[i]):
+                    reach &= ~self.defined_by[slot]
+                reach |= 1 << i
+        return reach
+
+    def available_copies(self):
+        """Copies ``SET x y`` (instruction bitmasks) holding on entry to every block.
+
+        A copy is available when every path from the start passes it with no
+        later change to x or y.
+        """
+        copies = 0
+        involving = [0] * len(self.slots)
+        for i, ins in enumerate(self.program):
+            if ins.op is Op.SET and is_slot(ins.a) and ins.a != ins.b:
+                copies |= 1 << i
+                for slot in bits(self.mask(ins.a) | self.mask(ins.b)):
+                    involving[slot] |= 1 << i
+        self.involving = involving
+        self.copies = copies
+        count = len(self.blocks)
+        avail_in = [0] + [copies if self.predecessors[b] else 0 for b in range(1, count)]
+        avail_out = [copies] * count
+        changed = True
+        while changed:
+            changed = False
+            for b in range(count):
+                if b and self.predecessors[b]:
+                    avail = copies
+                    for p in self.predecessors[b]:
+                        avail &= avail_out[p]
+                    avail_in[b] = avail
+                avail = self.copies_through(b, avail_in[b], self.blocks[b][1])
+                if avail != avail_out[b]:
+                    avail_out[b] = avail
+                    changed = True
+        return avail_in
+
+    def copies_through(self, b, avail, stop):
+        """Available copies just before instruction ``stop`` of block b."""
+        for i in range(self.blocks[b][0], stop):
+            for slot in bits(self.clobbers[i]):
+                avail &= ~self.involving[slot]
+            if self.copies >> i & 1:
+                avail |= 1 << i
+        return avail
+
+class Dataflow:
+    """Optimizations driven by a ControlFlowGraph of the whole program.
+
+    - ``unreachable``: removes blocks no path from the start reaches.
+    - ``jump-thread``: a GOTO, IF or TAG whose label starts with
+      ``GOTO :Y`` goes to Y directly, saving a tick per jump.
+    - ``invert-branch``: ``IF c :T / ELSE / CLR / GOTO :U / :T`` becomes
+      ``IF not c :U / ELSE / CLR`` when nothing else jumps to T.
+    - ``copy-propagation``: a read of x reached only by ``SET x y``, with
+      neither changed since on any path, reads y instead (reaching
+      definitions and available copies).
+    - ``dead-store``: removes arithmetic and SETs whose slot is overwritten
+      on every path before being read (liveness).
+
+    Every slot is live when the program ends except the precompiler's
+    ``scratch`` slots. Programs the graph cannot model are left unchanged
+    (``unsupported`` holds the reason). Attributes match Peephole.
+    """
+    def __init__(self, passes=PASSES, scratch=SCRATCH):
+        unknown = [name for name in passes if name not in PASSES]
+        if unknown:
+            raise ValueError(f"Unknown dataflow passes: {', '.join(unknown)}")
+        self.passes = tuple(passes)
+        self.scratch = scratch
+        self.saved = dict.fromkeys(self.passes, 0)
+        self.changes = dict.fromkeys(self.passes, 0)
+        self.before = 0
+        self.after = 0
+        self.origins = []
+        self.unsupported = None
+
+    def optimize(self, script):
+        """Optimized copy of ``script`` (a list of lines)."""
+        code = [(line, decode(line), index) for index, line in enumerate(script) if line.strip()]
+        self.before = len(code)
+        try:
+            changed = True
+            while changed:
+                changed = False
+                for name in self.passes:
+                    cfg = ControlFlowGraph([ins for _, ins, _ in code])
+                    new_code, changes = getattr(self, "pass_" + name.replace("-", "_"))(code, cfg)
+                    self.saved[name] += len(code) - len(new_code)
+                    self.changes[name] += changes
+                    changed = changed or changes > 0
+                    code = new_code
+        except ValueError as e:
+            self.unsupported = str(e)
+        self.after = len(code)
+        self.origins = [origin for _, _, origin in code]
+        return [line for line, _, _ in code]
+
+    def rewrite(self, entry, text):
+        """Entry for the instruction ``text`` replacing ``entry`` (keeps indentation and origin)."""
+        line, _, origin = entry
+        text = line[:len(line) - len(line.lstrip())] + text
+        return text, decode(text), origin
+
+    def pass_unreachable(self, code, cfg):
+        reachable = cfg.reachable()
+        out = []
+        for b, (start, end) in enumerate(cfg.blocks):
+            if b in reachable:
+                out.extend(code[start:end])
+            elif (code[start][1].op is Op.LABEL and out and out[-1][1].op not in NO_FALLTHROUGH):
+                # The block before runs into this label, which ends the program
+                out.append(code[start])
+        return out, len(code) - len(out)
+
+    def pass_jump_thread(self, code, cfg):
+        program = cfg.program
+        out = []
+        changes = 0
+        for entry in code:
+            ins = entry[1]
+            if ins.op in (Op.GOTO, Op.IF, Op.TAG) and ins.label in cfg.labels:
+                label, seen = ins.label, {ins.label}
+                while True:
+                    after = cfg.labels[label] + 1
+                    if after >= len(program) or program[after].op is not Op.GOTO:
+                        break
+                    if after + 1 < len(program) and program[after + 1].op is not Op.LABEL:
+                        # The code after that GOTO runs before it jumps
+                        break
+                    following = program[after].label
+                    if following not in cfg.labels or following in seen:
+                        break
+                    label = following
+                    seen.add(label)
+                if label != ins.label:
+                    if ins.op is Op.IF:
+                        entry = self.rewrite(entry, f"IF {operand_text(ins.a)} {ins.cmp} {operand_text(ins.b)} :{label}")
+                    else:
+                        entry = self.rewrite(entry, f"{ins.op.name} :{label}")
+                    changes += 1
+            out.append(entry)
+        return out, changes
+
+    def pass_invert_branch(self, code, cfg):
+        references = {}
+        for _, ins, _ in code:
+            if ins.op in (Op.GOTO, Op.IF, Op.TAG):
+                references[ins.label] = references.get(ins.label, 0) + 1
+        out = []
+        changes = 0
+        i = 0
+        while i < len(code):
+            ins = code[i][1]
+            if (ins.op is Op.IF and i + 4 < len(code) and code[i + 3][1].op is Op.GOTO
+                    and code[i + 4][1].op is Op.LABEL and code[i + 4][1].label == ins.label
+                    and references[ins.label] == 1 and code[i + 3][1].label != ins.label):
+                jump = code[i + 3][1].label
+                out.append(self.rewrite(code[i], f"IF {operand_text(ins.a)} {NEGATED[ins.cmp]} {operand_text(ins.b)} :{jump}"))
+                out.extend(code[i + 1:i + 3])
+                i += 5
+                changes += 1
+                continue
+            out.append(code[i])
+            i += 1
+        return out, changes
+
+    def pass_copy_propagation(self, code, cfg):
+        reach_in = cfg.reaching_definitions()
+        avail_in = cfg.available_copies()
+        program = cfg.program
+        out = list(code)
+        changes = 0
+        for b, (start, end) in enumerate(cfg.blocks):
+            for i in range(start, end):
+                ins = program[i]
+                if ins.op in STORES:
+                    positions = ("b",)
+                elif ins.op is Op.IF:
+                    positions = ("a", "b")
+                else:
+                    continue
+                operands = {"a": ins.a, "b": ins.b}
+                for position in positions:
+                    operand = operands[position]
+                    if not is_slot(operand):
+                        continue
+                    # The only definition of the operand reaching here must be a copy still in effect
+                    reaching = cfg.reach_through(b, reach_in[b], i) & cfg.defined_by[cfg.slots[operand[1]]]
+                    if reaching == 0 or reaching & (reaching - 1):
+                        continue
+                    copy = reaching.bit_length() - 1
+                    if not (cfg.copies >> copy & 1 and cfg.copies_through(b, avail_in[b], i) >> copy & 1):
+                        continue
+                    operands[position] = program[copy].b
+                if operands["a"] is ins.a and operands["b"] is ins.b:
+                    continue
+                a, b_operand = operand_text(operands["a"]), operand_text(operands["b"])
+                if ins.op is Op.IF:
+                    out[i] = self.rewrite(code[i], f"IF {a} {ins.cmp} {b_operand} :{ins.label}")
+                else:
+                    out[i] = self.rewrite(code[i], f"{ins.op.name} {a} {b_operand}")
+                changes += 1
+        return out, changes
+
+    def pass_dead_store(self, code, cfg):
+        exit_live = cfg.all_slots
+        for name in self.scratch:
+            if name in cfg.slots:
+                exit_live &= ~(1 << cfg.slots[name])
+        _, live_out = cfg.liveness(exit_live)
+        program = cfg.program
+        dead = set()
+        for b, (start, end) in enumerate(cfg.blocks):
+            live = live_out[b]
+            for i in range(end - 1, start - 1, -1):
+                ins = program[i]
+                if (ins.op in STORES and not live & cfg.defs[i]
+                        and not (i > 0 and program[i - 1].op is Op.CALL)):
+                    dead.add(i)
+                    continue
+                live = (live & ~cfg.defs[i]) | cfg.uses[i]
+        out = [entry for i, entry in enumerate(code) if i not in dead]
+        return out, len(dead)
+
+    def report(self):
+        """Blocks saved and instructions changed per pass."""
+        lines = [f"{name}: {self.saved[name]} blocks, {self.changes[name]} changes" for name in self.passes]
+        if self.unsupported:
+            lines.append(f"left unchanged: {self.unsupported}")
+        return "\n".join(lines) + "\n" + format_report({}, self.before, self.after)
+
+class Optimizer:
+    """Peephole rules and dataflow passes, repeated until neither changes the program."""
+    def __init__(self, rules=RULES, passes=PASSES, scratch=SCRATCH):
+        self.rules = rules
+        self.passes = passes
+        self.scratch = scratch
+        self.saved = dict.fromkeys(tuple(rules) + tuple(passes), 0)
+        self.before = 0
+        self.after = 0
+        self.origins = []
+
+    def optimize(self, script):
+        lines = [line for line in script if line.strip()]
+        origins = [index for index, line in enumerate(script) if line.strip()]
+        self.before = len(lines)
+        while True:
+            stages = [Peephole(self.rules), Dataflow(self.passes, self.scratch)]
+            for stage in stages:
+                lines = stage.optimize(lines)
+                origins = [origins[origin] for origin in stage.origins]
+                for name, saved in stage.saved.items():
+                    self.saved[name] += saved
+            if not any(stage.before - stage.after for stage in stages) and not any(stages[1].changes.values()):
+                break
+        self.after = len(lines)
+        self.origins = origins
+        return lines
+
+    def report(self):
+        return format_report(self.saved, self.before, self.after)
+
+def main():
+    parser = argparse.ArgumentParser(description="Peephole and dataflow optimizer for .asm programs")
+    parser.add_argument("input", help="Input .asm file")
+    parser.add_argument("-o", "--output", help="Optimized .asm file (default: print it)")
+    parser.add_argument("--rules", default=",".join(RULES), help="Comma-separated peephole rules")
+    parser.add_argument("--passes", default=",".join(PASSES), help="Comma-separated dataflow passes")
+    parser.add_argument("--verify", action="store_true", help="Check the optimized program in the emulator")
+    parser.add_argument("--registers", type=int, default=10, help="Registers for --verify (default: 10)")
+    args = parser.parse_args()
+
+    with open(args.input, "r") as f:
+        script = f.read().splitlines()
+    optimizer = Optimizer([rule for rule in args.rules.split(",") if rule],
+                          [name for name in args.passes.split(",") if name])
+    optimized = optimizer.optimize(script)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("\n".join(optimized) + "\n")
+    else:
+        print("\n".join(optimized))
+    print(optimizer.report(), file=sys.stderr)
+    if args.verify and not equivalent(script, optimized, args.registers, ignore=SCRATCH):
+        print("Optimized program behaves differently in the emulator", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import asm_compiler
+from asm_decoder import Op, decode_line
+from dataflow import ControlFlowGraph, EXIT
+
+log = logging.getLogger(__name__)
+
+# Minecraft 1.20.3/1.20.4: ``return run`` and function macros are needed
+PACK_FORMAT = 26
+FUNCTIONS_DIRECTORY = "functions"
+
+# Ops lowered to plain commands by the AssemblerCompiler emitters
+STRAIGHT_OPS = (Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.SET, Op.SAY, Op.SHOW, Op.VAR, Op.CMD)
+
+class DatapackCompiler:
+    """Lowers an .asm program to the functions of a datapack.
+
+    Each basic block (see dataflow.ControlFlowGraph) becomes the function
+    ``<namespace>:b<n>``, so straight-line code runs in one tick. The
+    instructions use the command block backend's commands (REG scores, the
+    CONST scoreboard, tellraw for SAY/SHOW). A block ends by jumping:
+    forward jumps and fall-through are ``return run function`` tail calls
+    in the same tick, while GOTO and IF jumps back to an earlier block (the
+    loops) are scheduled for the next tick, like a redstone hop.
+
+    SLF pushes the name of the return point's function onto the list
+    ``<namespace>:run stack`` (at most ``stack_size`` deep), and RET pops it
+    and calls it through the macro function ``<namespace>:ret``. RET with
+    an empty stack ends the program, like the emulator.
+
+    ``<namespace>:main`` sets up the registers, constants and stack, then
+    runs block 0.
+    """
+    def __init__(self, namespace="asm", stack_size=15, regex_size=8):
+        if not namespace or not all(c.islower() or c.isdigit() or c in "_-." for c in namespace):
+            raise ValueError(f"Invalid datapack namespace: {namespace}")
+        self.namespace = namespace
+        self.stack_size = stack_size
+        self.regex_size = regex_size
+        self.emitter = asm_compiler.AssemblerCompiler()
+
+    def function(self, block):
+        return f"{self.namespace}:b{block}"
+
+    def jump(self, block, target):
+        """Command continuing at ``target`` from the end of ``block``."""
+        if target > block:
+            return f"return run function {self.function(target)}"
+        return f"return run schedule function {self.function(target)} 1t"
+
+    def setup(self, lines):
+        commands = []
+        for i in range(self.regex_size):
+            commands.append(f"scoreboard objectives add R{i} dummy")
+            commands.append(f"scoreboard players set REG R{i} 0")
+        constants = asm_compiler.constants_needed(lines)
+        if constants:
+            commands.append(f"scoreboard objectives add {asm_compiler.CONSTANTS_OBJECTIVE} dummy")
+            for value in constants:
+                commands.append(f"scoreboard players set #{value} {asm_compiler.CONSTANTS_OBJECTIVE} {value}")
+        commands.append(f"data modify storage {self.namespace}:run stack set value []")
+        return commands
+
+    def compile(self, script):
+        """Functions of the datapack as a dict of name -> list of commands.
+
+        Raises ValueError for programs the control-flow graph cannot model
+        and for undefined labels.
+        """
+        lines = [line for line in script if line.strip()]
+        program = [decode_line(line, index) for index, line in enumerate(lines)]
+        cfg = ControlFlowGraph(program)
+        storage = f"{self.namespace}:run"
+        functions = {
+            "main": self.setup(lines) + ([f"function {self.function(0)}"] if cfg.blocks else []),
+            "ret": ["$return run function $(block)"],
+        }
+        for b, (start, end) in enumerate(cfg.blocks):
+            commands = [f"# {program[start].text.strip()} (line {start + 1})"]
+            for i in range(start, end):
+                ins = program[i]
+                if ins.op in STRAIGHT_OPS:
+                    command, _ = self.emitter.emitters[ins.op](ins, 0, 0)
+                    commands.append(command.lstrip("/"))
+                elif ins.op is Op.IF:
+                    target = self.target(cfg, ins)
+                    commands.append(f"{self.emitter.condition(ins)} run {self.jump(b, target)}")
+                elif ins.op is Op.GOTO:
+                    commands.append(self.jump(b, self.target(cfg, ins)))
+                elif ins.op is Op.SLF:
+                    value = json.dumps({"block": self.function(cfg.block_of[i + 2])}) if i + 2 < len(program) else None
+                    if value is None:
+                        raise ValueError(f"SLF without a return point: {ins.text}")
+                    commands.append(f"execute unless data storage {storage} stack[{self.stack_size - 1}] run "
+                                    f"data modify storage {storage} stack append value {value}")
+                elif ins.op is Op.CALL:
+                    callee = cfg.callee(b)
+                    if callee not in cfg.labels:
+                        raise ValueError(f"Error: TAG label {callee} not defined")
+                    commands.append(f"return run function {self.function(cfg.target(callee))}")
+                elif ins.op is Op.RET:
+                    commands.append(f"execute unless data storage {storage} stack[0] run return 0")
+                    commands.append(f"data modify storage {storage} frame set from storage {storage} stack[-1]")
+                    commands.append(f"data remove storage {storage} stack[-1]")
+                    commands.append(f"return run function {self.namespace}:ret with storage {storage} frame")
+                elif ins.op is Op.UNKNOWN:
+                    raise ValueError(f"Unknown command: {ins.text}")
+                # LABEL, TAG, ELSE and CLR only shape the graph
+            last = program[end - 1].op
+            if last not in (Op.GOTO, Op.CALL, Op.RET):
+                following = cfg.fall(end)
+                if following != EXIT:
+                    commands.append(self.jump(b, following))
+            functions[f"b{b}"] = commands
+        return functions
+
+    def target(self, cfg, ins):
+        target = cfg.target(ins.label)
+        if target == EXIT:
+            raise ValueError(f"Error: {ins.op.name} label {ins.label} not defined")
+        return target
+
+def write_datapack(functions, output_dir, namespace="asm", description="Compiled .asm program"):
+    """Write ``functions`` (name -> commands) as a datapack folder; returns its path."""
+    directory = os.path.join(output_dir, "data", namespace, FUNCTIONS_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(output_dir, "pack.mcmeta"), "w") as f:
+        json.dump({"pack": {"pack_format": PACK_FORMAT, "description": description}}, f, indent=2)
+    for name, commands in functions.items():
+        with open(os.path.join(directory, name + ".mcfunction"), "w") as f:
+            f.write("\n".join(commands) + "\n")
+    log.info("Datapack with %d functions saved in %s", len(functions), output_dir)
+    return output_dir
+
+def export_datapack(script, output_dir, namespace="asm", stack_size=15, regex_size=8):
+    """Compile ``script`` and write it as a datapack; run it in game with ``/function <namespace>:main``."""
+    functions = DatapackCompiler(namespace, stack_size, regex_size).compile(script)
+    return write_datapack(functions, output_dir, namespace)
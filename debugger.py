@@ -1,51 +1,135 @@
 import tkinter as tk
 import tkinter as tk
+from collections import deque
 from tkinter import filedialog, messagebox, scrolledtext, ttk
+from asm_decoder import Op
 from emulator import Emulator
+from output_sink import CallbackSink, NullSink
+
+# Instructions that write the slot in their first operand
+WRITES = (Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.SET, Op.VAR)
 
 class Debugger(Emulator):
-    def __init__(self, reg_size, output_callback=None, minecraft_tick=False):
-        super().__init__(reg_size, minecraft_tick=minecraft_tick)
+    def __init__(self, reg_size, output_callback=None, minecraft_tick=False,
+                 snapshot_interval=1000, max_snapshots=64, max_instructions=10000):
+        # output_callback receives batches of SAY/SHOW lines
+        output = CallbackSink(output_callback) if output_callback else NullSink()
+        super().__init__(reg_size, minecraft_tick=minecraft_tick, max_instructions=max_instructions,
+                         output=output)
         self.script_lines = []
         self.paused = True
         self.last_error = None
         self.output_callback = output_callback
+        # History: a snapshot every snapshot_interval steps, oldest evicted
+        # first, plus a log of (step, line, slot, old, new) writes since the
+        # oldest snapshot. Earlier steps are reached by restoring a snapshot
+        # and replaying forward.
+        self.step_count = 0
+        self.snapshot_interval = snapshot_interval
+        self.snapshots = deque(maxlen=max_snapshots)
+        self.writes = deque()
+        self._replaying = False
 
     def load_script(self, script):
         self.script_lines = script.splitlines()
-        self.find_labels(self.script_lines)
-        self.script = self.script_lines
+        self.labels = {}
+        self.load_program(self.script_lines)
         self.line = 0
+        self.ticks = 0
         self.end = False
         self.last_error = None
+        self.step_count = 0
+        self.snapshots.clear()
+        self.writes.clear()
+        self.checkpoint()
 
     def step(self):
         if self.end or self.line >= len(self.script_lines):
             self.end = True
             return False
+        line = self.line
+        ins = self.program[line]
+        slot = ins.sa if ins.op in WRITES else None
+        old = self.slots[slot] if slot is not None else None
         try:
-            self.execute_line(self.script_lines[self.line])
+            self._handlers[ins.op](ins)
             self.last_error = None
         except Exception as e:
             self.last_error = str(e)
             self.end = True
+        self.step_count += 1
+        if not self._replaying:
+            if slot is not None:
+                self.writes.append((self.step_count - 1, line, slot, old, self.slots[slot]))
+            if self.step_count % self.snapshot_interval == 0:
+                self.checkpoint()
         return True
 
-    def handle_say(self, line, *kwargs):
-        # Override to capture output
-        text = super().handle_say(line, return_text=True)
-        if self.output_callback:
-            self.output_callback(text)
+    def checkpoint(self):
+        """Snapshot the full machine state at the current step."""
+        self.snapshots.append((self.step_count, list(self.slots), list(self.STACK), self.line,
+                               self.target, self.ticks, self.end, self.last_error))
+        oldest = self.snapshots[0][0]
+        while self.writes and self.writes[0][0] < oldest:
+            self.writes.popleft()
+
+    def restore(self, snapshot):
+        self.step_count, slots, stack, self.line, self.target, self.ticks, self.end, self.last_error = snapshot
+        self.slots[:] = slots
+        self.STACK[:] = stack
+
+    def goto_step(self, step):
+        """Move to the state just before instruction number ``step`` executes.
+
+        Returns False when the step has been evicted from history.
+        """
+        if step >= self.step_count:
+            while self.step_count < step and self.step():
+                pass
+            return self.step_count == step
+        if not self.snapshots or self.snapshots[0][0] > step:
+            return False
+        while self.snapshots[-1][0] > step:
+            self.snapshots.pop()
+        while self.writes and self.writes[-1][0] >= step:
+            self.writes.pop()
+        self.restore(self.snapshots[-1])
+        # Replayed steps must not print their output again
+        self.output.flush()
+        output, self.output = self.output, NullSink()
+        self._replaying = True
+        try:
+            while self.step_count < step and self.step():
+                pass
+        finally:
+            self._replaying = False
+            self.output = output
+        return True
+
+    def step_back(self, count=1):
+        return self.goto_step(max(0, self.step_count - count))
+
+    def last_write(self, name):
+        """Step number of the most recent write to a register or variable, or None."""
+        slot = self.register_slots.get(name, self.variable_slots.get(name))
+        for step, line, written, old, new in reversed(self.writes):
+            if written == slot:
+                return step
+        return None
+
+    def run_back_to_write(self, name):
+        """Rewind to the instruction that last wrote ``name``; False if it is not in history."""
+        step = self.last_write(name)
+        if step is None:
+            return False
+        return self.goto_step(step)
 
     def get_state(self): 
-        return {
-            'line': self.line,
-            'current': self.script_lines[self.line] if self.line < len(self.script_lines) else '',
-            'registers': dict(self.REGISTERS),
-            'variables': dict(self.VARIABLE),
-            'stack': list(self.STACK),
-            'last_error': self.last_error
-        }
+        state = super().get_state()
+        state['current'] = self.script_lines[self.line] if self.line < len(self.script_lines) else ''
+        state['last_error'] = self.last_error
+        state['step'] = self.step_count
+        return state
 
 class DebuggerUI:
     def __init__(self, root):
@@ -84,6 +168,12 @@ class DebuggerUI:
                                   padx=15, pady=8, relief=tk.RAISED, cursor='hand2')
         self.step_btn.pack(side=tk.LEFT, padx=5)
         
+        # Step back button
+        self.back_btn = tk.Button(controls, text='◀ Back', command=self.step_back, state=tk.DISABLED,
+                                  bg='#2196F3', fg='white', font=('Arial', 10, 'bold'),
+                                  padx=15, pady=8, relief=tk.RAISED, cursor='hand2')
+        self.back_btn.pack(side=tk.LEFT, padx=5)
+        
         # Run button
         self.run_btn = tk.Button(controls, text='▶▶ Run All', command=self.toggle_run, state=tk.DISABLED,
                                  bg='#FF9800', fg='white', font=('Arial', 10, 'bold'),
@@ -127,6 +217,16 @@ class DebuggerUI:
         
         tk.Label(controls, text='ms', font=('Arial', 9), bg='#f0f0f0').pack(side=tk.LEFT)
 
+        # Run back to the last write of a register/variable
+        sep = tk.Frame(controls, width=2, bg='#bdc3c7')
+        sep.pack(side=tk.LEFT, padx=10, fill=tk.Y)
+        self.write_entry = tk.Entry(controls, width=10, font=('Arial', 9))
+        self.write_entry.pack(side=tk.LEFT, padx=2)
+        self.write_btn = tk.Button(controls, text='⏪ Last write', command=self.run_back_to_write, state=tk.DISABLED,
+                                   bg='#9E9E9E', fg='white', font=('Arial', 9, 'bold'),
+                                   padx=8, pady=4, relief=tk.RAISED, cursor='hand2')
+        self.write_btn.pack(side=tk.LEFT, padx=2)
+
         # Status label
         self.status_label = tk.Label(controls, text='No script loaded', font=('Arial', 10), 
                                      bg='#f0f0f0', fg='#666')
@@ -248,14 +348,15 @@ class DebuggerUI:
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 script = f.read()
-            # Use minecraft tick if speed is set to MC Tick
-            use_mc_tick = (self.speed_var.get() == 1)
-            self.debugger = Debugger(reg_size=8, output_callback=self.on_output, minecraft_tick=use_mc_tick)
+            # MC Tick speed is paced by run_continuous from the virtual tick count
+            self.debugger = Debugger(reg_size=8, output_callback=self.on_output)
             self.debugger.load_script(script)
             self.script_loaded = True
             self.step_btn.config(state=tk.NORMAL)
             self.run_btn.config(state=tk.NORMAL)
             self.reset_btn.config(state=tk.NORMAL)
+            self.back_btn.config(state=tk.NORMAL)
+            self.write_btn.config(state=tk.NORMAL)
             self.display_script()
             self.update_state()
             filename = file_path.split('/')[-1].split('\\')[-1]
@@ -277,6 +378,29 @@ class DebuggerUI:
                     self.notebook.select(2)  # Switch to output tab
                 else:
                     self.status_label.config(text='✓ Execution completed', fg='#27ae60')
+
+    def step_back(self):
+        if not self.script_loaded or self.running:
+            return
+        if self.debugger.step_back():
+            self.step_btn.config(state=tk.NORMAL)
+            self.run_btn.config(state=tk.NORMAL)
+            self.update_state()
+            self.status_label.config(text=f'◀ Step {self.debugger.step_count}', fg='#3498db')
+        else:
+            self.status_label.config(text='⚠ Earlier steps are no longer in history', fg='#e67e22')
+
+    def run_back_to_write(self):
+        if not self.script_loaded or self.running:
+            return
+        name = self.write_entry.get().strip()
+        if self.debugger.run_back_to_write(name):
+            self.step_btn.config(state=tk.NORMAL)
+            self.run_btn.config(state=tk.NORMAL)
+            self.update_state()
+            self.status_label.config(text=f'⏪ Last write of {name} (step {self.debugger.step_count})', fg='#3498db')
+        else:
+            self.status_label.config(text=f'⚠ No write of {name} in history', fg='#e67e22')
     
     def update_speed(self):
         """Update speed settings when radio buttons change"""
@@ -288,10 +412,6 @@ class DebuggerUI:
                 self.custom_speed = 100
                 self.custom_speed_entry.delete(0, tk.END)
                 self.custom_speed_entry.insert(0, '100')
-        
-        # Update minecraft_tick setting if debugger is loaded
-        if self.debugger:
-            self.debugger.minecraft_tick = (self.speed == 1)
     
     def toggle_run(self):
         """Toggle between running and paused state"""
@@ -327,13 +447,14 @@ class DebuggerUI:
             return
         
         # Execute one step
+        ticks = self.debugger.ticks
         self.debugger.step()
         self.update_state()
         
         # Calculate delay based on speed setting
         delay = 0
-        if self.speed == 1:  # Minecraft tick - emulator handles the delays internally
-            delay = 0  # No UI delay, emulator time.sleep() handles it
+        if self.speed == 1:  # Minecraft tick - wait for the game ticks the step used
+            delay = (self.debugger.ticks - ticks) * 50
         elif self.speed == 2:  # Custom
             try:
                 delay = max(1, int(self.custom_speed_entry.get()))
@@ -343,7 +464,7 @@ class DebuggerUI:
         # Schedule next step
         if delay > 0:
             self.root.after(delay, self.run_continuous)
-        else:  # Max speed or MC tick (emulator handles delays)
+        else:  # Max speed or a step that used no ticks
             self.root.after(1, self.run_continuous)
     
     def run_to_end(self):
@@ -352,13 +473,15 @@ class DebuggerUI:
         self.status_label.config(text='⚙ Running...', fg='#f39c12')
         self.root.update()
         step_count = 0
-        while not self.debugger.end and step_count < 10000:  # Safety limit
+        limit = self.debugger.max_instructions
+        while not self.debugger.end and (limit is None or step_count < limit):
             self.debugger.step()
             step_count += 1
             if step_count % 100 == 0:  # Update UI periodically
+                self.debugger.output.flush()
                 self.root.update()
         self.update_state()
-        if step_count >= 10000:
+        if not self.debugger.end:
             self.status_label.config(text='⚠ Stopped: maximum steps reached', fg='#e67e22')
         elif self.debugger.last_error:
             self.status_label.config(text='✗ Execution stopped with error', fg='#e74c3c')
@@ -366,10 +489,10 @@ class DebuggerUI:
         else:
             self.status_label.config(text=f'✓ Completed in {step_count} steps', fg='#27ae60')
 
-    def on_output(self, text):
-        """Callback for SAY command output"""
+    def on_output(self, lines):
+        """Callback for batches of SAY/SHOW output"""
         self.tab_output.config(state=tk.NORMAL)
-        self.tab_output.insert(tk.END, f'{text}\n', 'output')
+        self.tab_output.insert(tk.END, '\n'.join(lines) + '\n', 'output')
         self.tab_output.tag_config('output', foreground='#27ae60', font=('Consolas', 10))
         self.tab_output.see(tk.END)
         self.tab_output.config(state=tk.DISABLED)
@@ -382,7 +505,9 @@ class DebuggerUI:
             self.running = False
             self.run_btn.config(text='▶▶ Run All', bg='#FF9800')
         
-        self.debugger.load_script('\n'.join(self.debugger.script_lines))
+        # Rewind to the first snapshot when it is still in history
+        if not self.debugger.goto_step(0):
+            self.debugger.load_script('\n'.join(self.debugger.script_lines))
         self.step_btn.config(state=tk.NORMAL)
         self.run_btn.config(state=tk.NORMAL)
         # Clear output tab
@@ -393,6 +518,7 @@ class DebuggerUI:
         self.status_label.config(text='↻ Reset to start', fg='#3498db')
 
     def update_state(self):
+        self.debugger.output.flush()
         state = self.debugger.get_state()
         self.highlight_script_line(state['line'])
 
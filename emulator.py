@@ -1,242 +1,794 @@
 import time
+import hashlib
+import operator
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from asm_decoder import Op, Kind, DecodeError, decode_line, decode_program, find_labels
+from profiler import Profiler
+from output_sink import FileSink, NullSink
+
+# Marks a slot whose variable has not been created yet
+UNSET = type("Unset", (), {"__repr__": lambda self: "UNSET"})()
+
+# Game ticks spent by each instruction when run as command blocks
+TICKS = {
+    Op.GOTO: 1,
+    Op.CALL: 1,
+    Op.RET: 1,
+    Op.IF: 2,
+}
+TICKS_PER_SECOND = 20
+
+# Scoreboard values are Java ints and wrap around at 32 bits
+INT_MIN = -2**31
+INT_MAX = 2**31 - 1
+
+def wrap32(value):
+    return ((value - INT_MIN) & 0xFFFFFFFF) + INT_MIN
+
+COMPARE = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+# Code objects generated by Emulator.compile_blocks, keyed by program hash;
+# the least recently used ones are dropped past COMPILED_CACHE_SIZE entries
+COMPILED_CACHE = OrderedDict()
+COMPILED_CACHE_SIZE = 64
+
+# Instructions that read their first operand as well as their second
+READS_BOTH = (Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.IF)
+
+def read_operands(ins):
+    """Names of the registers and variables ``ins`` reads when it runs."""
+    if ins.op in READS_BOTH:
+        operands = (ins.a, ins.b)
+    elif ins.op is Op.SET:
+        operands = (ins.b,)
+    elif ins.op is Op.SHOW:
+        operands = (ins.a,)
+    else:
+        return []
+    return [value for kind, value in operands if kind is not Kind.IMM]
+
+PYTHON_COMPARE = {"=": "==", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">="}
+PYTHON_ARITHMETIC = {Op.ADD: "+", Op.SUB: "-", Op.MUL: "*", Op.DIV: "//"}
+TERMINATORS = (Op.LABEL, Op.GOTO, Op.CALL, Op.RET, Op.IF, Op.UNKNOWN)
+
+def block_leaders(program):
+    """Indices where control can enter a basic block."""
+    leaders = {0}
+    for i, ins in enumerate(program):
+        if ins.op is Op.LABEL:
+            leaders.update((i, i + 1))
+        elif ins.op in TERMINATORS:
+            leaders.add(i + 1)
+        if ins.op is Op.IF:
+            leaders.add(i + 3)
+        elif ins.op is Op.SLF:
+            leaders.add(i + 2)
+    return sorted(leader for leader in leaders if leader < len(program))
+
+def block_sizes(program):
+    """Number of instructions each basic block runs, indexed by its leader."""
+    leaders = block_leaders(program)
+    sizes = [0] * len(program)
+    for n, start in enumerate(leaders):
+        end = leaders[n + 1] if n + 1 < len(leaders) else len(program)
+        for index in range(start, end):
+            if program[index].op in TERMINATORS:
+                end = index + 1
+                break
+        sizes[start] = end - start
+    return sizes
+
+def _tick_source(ins, indent):
+    return [
+        f"{indent}e.ticks += {TICKS[ins.op]}",
+        f"{indent}if e._minecraft_tick and e.ticks >= e._next_pace:",
+        f"{indent}    e.pace()",
+    ]
+
+def _raise_source(index, message, indent="    "):
+    return [f"{indent}e.line = {index}", f"{indent}raise AssertionError({message!r})"]
+
+def _unset_check(ins, index, read, unset):
+    """Read the operands of ``ins`` into ``a`` and ``b``, failing on a slot that may still be UNSET."""
+    reads = [("b", ins.b, ins.sb)] if ins.op is Op.SET else [("a", ins.a, ins.sa), ("b", ins.b, ins.sb)]
+    lines = [f"    {name} = {read(operand, slot)}" for name, operand, slot in reads]
+    checks = [name for name, _, slot in reads if slot in unset]
+    if checks:
+        lines.append(f"    if {' or '.join(f'{name} is UNSET' for name in checks)}:")
+        lines.append(f"        e.check_unset(program[{index}])")
+    return lines
+
+def instruction_source(ins, index, read, unset=()):
+    """Python statements for one instruction; terminators end with a return.
+
+    Reads of the slots in ``unset`` are checked, since those may still be
+    UNSET when the instruction runs.
+    """
+    op = ins.op
+    if op in PYTHON_ARITHMETIC:
+        return [
+            f"    v = s[{ins.sa}] {PYTHON_ARITHMETIC[op]} {read(ins.b, ins.sb)}",
+            f"    s[{ins.sa}] = v if {INT_MIN} <= v <= {INT_MAX} else wrap32(v)",
+        ]
+    if op is Op.SET:
+        if ins.sb not in unset:
+            return [f"    s[{ins.sa}] = {read(ins.b, ins.sb)}"]
+        return _unset_check(ins, index, read, unset) + [f"    s[{ins.sa}] = b"]
+    if op is Op.VAR:
+        return [f"    s[{ins.sa}] = None"]
+    if op is Op.SAY or op is Op.SHOW:
+        return [f"    e.line = {index}", f"    e.handle_{op.name.lower()}(program[{index}])"]
+    if op is Op.TAG:
+        return [f"    e.target = {ins.label!r}"]
+    if op is Op.SLF:
+        return [f"    stack.append({index + 2})"]
+    if op is Op.LABEL:
+        # Falling through into a label ends the program
+        return ["    e.end = True", f"    return {index}"]
+    if op is Op.GOTO:
+        if ins.target is None:
+            return _tick_source(ins, "    ") + _raise_source(index, "Label not found")
+        return _tick_source(ins, "    ") + [f"    return {ins.target + 1}"]
+    if op is Op.CALL:
+        return _tick_source(ins, "    ") + [
+            "    if e.target in e.labels:",
+            "        return e.labels[e.target] + 1",
+            f"    e.line = {index}",
+            f"    raise AssertionError(f\"Label {{e.target}} not found on line :\\n{{program[{index}].text}}\\n list of labels: {{e.labels}}\")",
+        ]
+    if op is Op.RET:
+        return _tick_source(ins, "    ") + [
+            "    if stack:",
+            "        return stack.pop()",
+        ] + _raise_source(index, "Stack is empty")
+    if op is Op.IF:
+        lines = _tick_source(ins, "    ")
+        if ins.error:
+            return lines + _raise_source(index, ins.error)
+        if ins.sa in unset or ins.sb in unset:
+            lines += _unset_check(ins, index, read, unset)
+            lines.append(f"    if a {PYTHON_COMPARE[ins.cmp]} b:")
+        else:
+            lines.append(f"    if {read(ins.a, ins.sa)} {PYTHON_COMPARE[ins.cmp]} {read(ins.b, ins.sb)}:")
+        if ins.target is None:
+            lines += _raise_source(index, f"Label not found: {ins.label} in IF line {index}", "        ")
+        else:
+            lines.append(f"        return {ins.target + 1}")
+        return lines + [f"    return {index + 3}"]
+    if op is Op.UNKNOWN:
+        return _raise_source(index, f"Unknown command: {ins.text} at line {index}")
+    # NOP, CMD, ELSE and CLR do nothing
+    return []
+
+def program_source(program, constants, unset=()):
+    """Generate one Python function per basic block of a linked program.
+
+    Every function takes (slots, stack, emulator) and returns the index of
+    the next instruction to run. ``LINES`` maps each line of the generated
+    source to the instruction it was generated for, so an exception raised
+    inside a block can be traced back to its line. Reads of the slots in
+    ``unset`` check that the slot has been written by then.
+    """
+    constant_values = {slot: value for value, slot in constants.items()}
+
+    def read(operand, slot):
+        return repr(constant_values[slot]) if operand[0] is Kind.IMM else f"s[{slot}]"
+
+    leaders = block_leaders(program)
+    lines = []
+    line_map = [None]  # source lines are numbered from 1
+    for n, start in enumerate(leaders):
+        end = leaders[n + 1] if n + 1 < len(leaders) else len(program)
+        lines.append(f"def block_{start}(s, stack, e):")
+        line_map.append(start)
+        for index in range(start, end):
+            source = instruction_source(program[index], index, read, unset)
+            lines += source
+            line_map += [index] * len(source)
+            if program[index].op in TERMINATORS:
+                break
+        else:
+            lines.append(f"    return {end}")
+            line_map.append(end - 1)
+        lines.append("")
+        line_map.append(None)
+    lines.append(f"BLOCKS = {{{', '.join(f'{start}: block_{start}' for start in leaders)}}}")
+    lines.append(f"LINES = {line_map!r}")
+    return "\n".join(lines) + "\n"
+
+def say_template(slot_parts):
+    """Pre-build a SAY message as a format string and the slots it reads."""
+    template = ""
+    say_slots = []
+    for slot, text in slot_parts:
+        if slot is None:
+            template += text.replace("{", "{{").replace("}", "}}")
+        else:
+            template += "{}"
+            say_slots.append(slot)
+    return template, tuple(say_slots)
+
+class SlotView(MutableMapping):
+    """Dict-like view of the registers or variables held in the slot file."""
+    def __init__(self, emulator, table):
+        self._emulator = emulator
+        self._table = table
+
+    def __getitem__(self, name):
+        value = self._emulator.slots[self._table[name]]
+        if value is UNSET:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self._emulator.slots[self._emulator.slot(name)] = value
+
+    def __delitem__(self, name):
+        self[name]
+        self._emulator.slots[self._table[name]] = UNSET
+
+    def __iter__(self):
+        slots = self._emulator.slots
+        return (name for name, slot in self._table.items() if slots[slot] is not UNSET)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class RunResult:
+    """Outcome of Emulator.execute_script.
+
+    ``status`` is "completed", "exhausted" (``exhausted`` then names the
+    budget that ran out: "instructions", "ticks" or "time") or "error".
+    """
+    __slots__ = ("status", "exhausted", "error", "instructions", "ticks", "seconds", "line")
+
+    def __init__(self, status, exhausted=None, error=None, instructions=0, ticks=0, seconds=0.0, line=0):
+        self.status = status
+        self.exhausted = exhausted
+        self.error = error
+        self.instructions = instructions
+        self.ticks = ticks
+        self.seconds = seconds
+        self.line = line
+
+    @property
+    def completed(self):
+        return self.status == "completed"
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"RunResult({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
 class Emulator:
-    def __init__(self, reg_size, minecraft_tick=False):
-        self.REGISTERS = {f"R{i}": 0 for i in range(reg_size)}
-        self.VARIABLE={}
+    def __init__(self, reg_size, minecraft_tick=False, tick_batch=TICKS_PER_SECOND, compiled=False,
+                 profile=False, source_map=None, max_instructions=None, max_ticks=None, max_seconds=None,
+                 budget_chunk=4096, output=None):
+        # Registers, variables and immediates all live in one flat slot list
+        self.slots = []
+        self.register_slots = {}
+        self.variable_slots = {}
+        self.constant_slots = {}
+        for i in range(reg_size):
+            self.slot(f"R{i}", 0)
+        self.REGISTERS = SlotView(self, self.register_slots)
+        self.VARIABLE = SlotView(self, self.variable_slots)
         self.STACK = []
         self.line = 0
         self.end = False
         self.labels = {}
         self.script = None
+        self.program = []
         self.target = None
+        # Virtual game clock; minecraft_tick only paces it against wall time
+        self.ticks = 0
+        self.tick_batch = tick_batch
+        self._pace_origin = None
+        self._next_pace = 0
         self.minecraft_tick = minecraft_tick
+        self.compiled = compiled
+        self.profiler = Profiler(self, source_map) if profile else None
+        # Budgets are checked between chunks of budget_chunk instructions
+        # (basic blocks in compiled mode); max_instructions is exact, the
+        # tick and wall-time budgets may overshoot by up to one chunk.
+        self.max_instructions = max_instructions
+        self.max_ticks = max_ticks
+        self.max_seconds = max_seconds
+        self.budget_chunk = budget_chunk
+        self.instructions = 0
+        self.exhausted = None
+        # SAY/SHOW lines go through a buffered sink, stdout by default
+        self.output = output if output is not None else FileSink()
+        self._handlers = [None] * len(Op)
+        for op in Op:
+            self._handlers[op] = getattr(self, f"handle_{op.name.lower()}")
+
+    @property
+    def minecraft_tick(self):
+        return self._minecraft_tick
+
+    @minecraft_tick.setter
+    def minecraft_tick(self, value):
+        self._minecraft_tick = value
+        self._pace_origin = None
+        self._next_pace = self.ticks
+
+    def pace(self):
+        """Sleep once to bring wall-clock time in line with the virtual tick count."""
+        now = time.perf_counter()
+        if self._pace_origin is None:
+            self._pace_origin = (now, self.ticks)
+        else:
+            origin_time, origin_ticks = self._pace_origin
+            delay = (self.ticks - origin_ticks) / TICKS_PER_SECOND - (now - origin_time)
+            if delay > 0:
+                self.output.flush()
+                time.sleep(delay)
+        self._next_pace = self.ticks + self.tick_batch
+
+    def slot(self, name, value=UNSET):
+        """Return the slot index for a register or variable name, allocating it if needed."""
+        table = self.register_slots if name.startswith("R") else self.variable_slots
+        index = table.get(name)
+        if index is None:
+            index = table[name] = len(self.slots)
+            self.slots.append(value)
+        return index
+
+    def constant(self, value):
+        """Return a read-only slot holding an immediate value."""
+        value = wrap32(value)
+        index = self.constant_slots.get(value)
+        if index is None:
+            index = self.constant_slots[value] = len(self.slots)
+            self.slots.append(value)
+        return index
+
+    def operand_slot(self, operand):
+        kind, value = operand
+        if kind is Kind.IMM:
+            return self.constant(value)
+        return self.slot(value)
+
+    def link(self, ins):
+        """Resolve an instruction's operands to slot indices."""
+        if ins.a is not None:
+            if ins.a[0] is Kind.IMM and ins.op is not Op.IF and ins.op is not Op.SHOW:
+                raise AssertionError(f"Cannot write to an immediate value: {ins.text}")
+            ins.sa = self.operand_slot(ins.a)
+        if ins.b is not None:
+            ins.sb = self.operand_slot(ins.b)
+        if ins.parts is not None:
+            ins.slot_parts = [(self.slot(text), text) if is_name else (None, text) for is_name, text in ins.parts]
+            ins.template = say_template(ins.slot_parts)
+        return ins
 
-    def execute_script(self, script):
-        script = script.splitlines()
-        self.find_labels(script)
+    def load_program(self, script):
+        """Decode the script once so execution never touches the source text."""
+        if isinstance(script, str):
+            script = script.splitlines()
         self.script = script
-        while not self.end:
-            if self.line >= len(script):
+        self.program = [self.link(ins) for ins in decode_program(script)]
+        self.check_operands(self.program)
+        self.find_labels(self.program)
+
+    def check_operands(self, program):
+        """Raise DecodeError for a register or variable that is read but never given a value.
+
+        A name is defined if ``program`` sets or declares it, or if it
+        already holds a value (registers, or inputs set before loading).
+        """
+        written = {ins.a[1] for ins in program if ins.op is Op.SET or ins.op is Op.VAR}
+        slots = self.slots
+        for ins in program:
+            if ins.error:
+                continue
+            for name in read_operands(ins):
+                if name not in written and slots[self.slot(name)] is UNSET:
+                    raise DecodeError(f"Undefined register or variable {name}: {ins.text.strip()}", ins.index)
+
+    def check_unset(self, ins):
+        """Raise KeyError naming the first operand ``ins`` reads that has no value yet."""
+        slots = self.slots
+        for name in read_operands(ins):
+            if slots[self.slot(name)] is UNSET:
+                raise KeyError(name) from None
+
+    def execute_script(self, script, raise_errors=True):
+        """Load and run a script, returning a RunResult.
+
+        Errors raised by the program, including malformed lines
+        (asm_decoder.DecodeError), propagate unless ``raise_errors`` is
+        False, in which case they are reported in the result.
+        """
+        started = time.perf_counter()
+        error = None
+        try:
+            self.load_program(script)
+            if self.profiler is not None:
+                self.run_profiled()
+            elif self.compiled:
+                self.run_compiled()
+            else:
+                self.run()
+        except Exception as e:
+            if raise_errors:
+                raise
+            if isinstance(e, DecodeError):
+                self.line = e.index
+            error = str(e) if isinstance(e, AssertionError) else f"{type(e).__name__}: {e}"
+        finally:
+            self.output.flush()
+        if error is not None:
+            status = "error"
+        elif self.exhausted is not None:
+            status = "exhausted"
+        else:
+            status = "completed"
+        return RunResult(status, self.exhausted, error, self.instructions, self.ticks,
+                         time.perf_counter() - started, self.line)
+
+    def next_chunk(self):
+        """Number of instructions to run before the budget is checked again."""
+        if self.max_instructions is None:
+            return self.budget_chunk
+        return max(0, min(self.budget_chunk, self.max_instructions - self.instructions))
+
+    def check_budget(self, started):
+        """Record which budget ran out, if any; called between chunks."""
+        if self.max_instructions is not None and self.instructions >= self.max_instructions:
+            self.exhausted = "instructions"
+        elif self.max_ticks is not None and self.ticks >= self.max_ticks:
+            self.exhausted = "ticks"
+        elif self.max_seconds is not None and time.perf_counter() - started >= self.max_seconds:
+            self.exhausted = "time"
+        return self.exhausted is not None
+
+    def run(self):
+        program = self.program
+        handlers = self._handlers
+        size = len(program)
+        started = time.perf_counter()
+        self.exhausted = None
+        if self._minecraft_tick:
+            self.pace()
+        while not self.end and self.line < size:
+            executed = 0
+            try:
+                for executed in range(1, self.next_chunk() + 1):
+                    ins = program[self.line]
+                    handlers[ins.op](ins)
+                    if self.end or self.line >= size:
+                        break
+            finally:
+                self.instructions += executed
+            if self.check_budget(started):
                 break
-            self.execute_line(script[self.line])
+        if self._minecraft_tick:
+            self.pace()
+
+    def run_profiled(self):
+        """Same as run() but reports every instruction to self.profiler."""
+        program = self.program
+        handlers = self._handlers
+        profiler = self.profiler
+        size = len(program)
+        started = time.perf_counter()
+        self.exhausted = None
+        if self._minecraft_tick:
+            self.pace()
+        while not self.end and self.line < size:
+            executed = 0
+            try:
+                for executed in range(1, self.next_chunk() + 1):
+                    line = self.line
+                    ticks = self.ticks
+                    ins = program[line]
+                    handlers[ins.op](ins)
+                    profiler.record(ins, line, self.ticks - ticks, self.line)
+                    if self.end or self.line >= size:
+                        break
+            finally:
+                self.instructions += executed
+            if self.check_budget(started):
+                break
+        if self._minecraft_tick:
+            self.pace()
+
+    def compile_blocks(self):
+        """Compile the loaded program to one Python function per basic block."""
+        # Nothing a program runs makes a slot UNSET again, so only the slots
+        # that are UNSET now need checking when they are read
+        unset = {slot for slot, value in enumerate(self.slots) if value is UNSET}
+        key = hashlib.sha256(repr((self.script, self.register_slots, self.variable_slots,
+                                   self.constant_slots, sorted(unset))).encode()).hexdigest()
+        code = COMPILED_CACHE.pop(key, None)
+        if code is None:
+            source = program_source(self.program, self.constant_slots, unset)
+            code = compile(source, f"<asm {key[:12]}>", "exec")
+        COMPILED_CACHE[key] = code
+        while len(COMPILED_CACHE) > COMPILED_CACHE_SIZE:
+            COMPILED_CACHE.popitem(last=False)
+        namespace = {"wrap32": wrap32, "program": self.program, "UNSET": UNSET}
+        exec(code, namespace)
+        blocks = [None] * len(self.program)
+        for start, block in namespace["BLOCKS"].items():
+            blocks[start] = block
+        return blocks, namespace
+
+    @staticmethod
+    def failing_line(error, namespace):
+        """Index of the instruction a compiled block was running when it raised ``error``."""
+        index = None
+        tb = error.__traceback__
+        while tb is not None:
+            if tb.tb_frame.f_globals is namespace:
+                index = namespace["LINES"][tb.tb_lineno]
+            tb = tb.tb_next
+        return index
+
+    def run_compiled(self):
+        """Run the loaded program through compile_blocks instead of the interpreter loop."""
+        blocks, namespace = self.compile_blocks()
+        sizes = block_sizes(self.program)
+        program = self.program
+        handlers = self._handlers
+        slots = self.slots
+        stack = self.STACK
+        size = len(program)
+        started = time.perf_counter()
+        self.exhausted = None
+        if self._minecraft_tick:
+            self.pace()
+        line = self.line
+        while not self.end and line < size:
+            budget = self.next_chunk()
+            executed = 0
+            try:
+                while executed < budget and not self.end and line < size:
+                    block = blocks[line]
+                    if block is None or sizes[line] > budget - executed:
+                        # Entered mid-block (e.g. a hand-edited STACK) or the block
+                        # would overrun the budget: interpret one step
+                        self.line = line
+                        handlers[program[line].op](program[line])
+                        line = self.line
+                        executed += 1
+                    else:
+                        try:
+                            next_line = block(slots, stack, self)
+                        except Exception as e:
+                            self.line = self.failing_line(e, namespace)
+                            executed += self.line - line + 1
+                            if isinstance(e, TypeError):
+                                self.check_unset(program[self.line])
+                            raise
+                        executed += sizes[line]
+                        line = next_line
+            finally:
+                self.instructions += executed
+            if self.check_budget(started):
+                break
+        self.line = line
+        if self._minecraft_tick:
+            self.pace()
 
     def execute_line(self, line):
-        #print(f"Executing line {self.line}: {line.strip()}")
-        match line.split(" ")[0]:
-            case "ADD":
-                self.handle_add(line)
-                self.line += 1
-            case "SUB":
-                self.handle_sub(line)
-                self.line += 1
-            case "MUL":
-                self.handle_mul(line)
-                self.line += 1
-            case "DIV":
-                self.handle_div(line)
-                self.line += 1
-            case "SET":
-                self.handle_set(line)
-                self.line += 1
-            case "SAY":
-                self.handle_say(line)
-                self.line += 1
-            case "GOTO":
-                if self.minecraft_tick:
-                    time.sleep(1/20)
-                self.handle_goto(line)
-            case "TAG":
-                self.handle_tag(line)
-                self.line += 1
-            case "SLF":
-                self.handle_slf(line)
-                self.line += 1
-            case "CALL":
-                if self.minecraft_tick:
-                    time.sleep(1/20)
-                self.handle_call(line)
-            case "RET":
-                if self.minecraft_tick:
-                    time.sleep(1/20)
-                self.handle_ret(line)
-            case "IF":
-                if self.minecraft_tick:
-                    time.sleep(2/20)
-                self.handle_if(line)
-            case "VAR":
-                self.handle_var(line)
-                self.line +=1
-            case "CMD":
-                # Ignore CMD in emulator
-                self.line += 1
-            case _:
-                if line.startswith(":"):
-                    self.end=True
-                else:
-                    AssertionError(f"Unknown command: {line} at line {self.line}")
-                
-    def find_labels(self, script):
-        for i, line in enumerate(script):
-            if line.startswith(":"):
-                label = line.split(":")[1].strip()
-                self.labels[label] = i
-                #print(f"Found label '{label}' at line {i}")
-
-    def handle_add(self, line):
-        _, var, value = line.split()
-        var = var.replace(",", "")
-        storage = self.REGISTERS if var.startswith("R") else self.VARIABLE
-        if value.startswith("R"):
-            storage[var] += self.REGISTERS[value]
-        elif value.startswith("#"):
-            storage[var] += int(value.replace("#", ""))
-        else:
-            storage[var] += self.VARIABLE[value]
-    def handle_sub(self, line):
-        _, var, value = line.split()
-        var = var.replace(",", "")
-        storage = self.REGISTERS if var.startswith("R") else self.VARIABLE
-        if value.startswith("R"):
-            storage[var] -= self.REGISTERS[value]
-        elif value.startswith("#"):
-            storage[var] -= int(value.replace("#", ""))
-        else:
-            storage[var] -= self.VARIABLE[value]
-    def handle_mul(self, line):
-        _, var, value = line.split()
-        var = var.replace(",", "")
-        storage = self.REGISTERS if var.startswith("R") else self.VARIABLE
-        if value.startswith("R"):
-            storage[var] *= self.REGISTERS[value]
-        elif value.startswith("#"):
-            storage[var] *= int(value.replace("#", ""))
-        else:
-            storage[var] *= self.VARIABLE[value]
-    def handle_div(self, line):
-        _, var, value = line.split()
-        storage = self.REGISTERS if var.startswith("R") else self.VARIABLE
-        var = var.replace(",", "")
-        if value.startswith("R"):
-            storage[var] //= self.REGISTERS[value]
-        elif value.startswith("#"):
-            storage[var] //= int(value.replace("#", ""))
-        else:
-            storage[var] //= self.VARIABLE[value]
-    def handle_set(self, line):
-        _, var, value = line.split()
-        var = var.replace(",", "")
-        storage = self.REGISTERS if var.startswith("R") else self.VARIABLE
-        if value.startswith("R"):
-            storage[var] = self.REGISTERS[value]
-        elif value.startswith("#"):
-            storage[var] = int(value.replace("#", ""))
-        else:
-            storage[var] = self.VARIABLE[value]
+        """Execute a single instruction, decoding it first if given as text."""
+        if isinstance(line, str):
+            line = self.link(decode_line(line, self.line))
+        self._handlers[line.op](line)
+        self.output.flush()
+
+    def find_labels(self, program):
+        self.labels.update(find_labels(program))
+
+    def get_state(self):
+        return {
+            'line': self.line,
+            'registers': dict(self.REGISTERS),
+            'variables': dict(self.VARIABLE),
+            'stack': list(self.STACK),
+            'ticks': self.ticks,
+        }
 
-    def handle_say(self, line, return_text=False):
-        text = line.split('"')[1]
-        text = text.replace("{", "ùVAR:").replace("}", "ù").split("ù")
+    def handle_add(self, ins):
+        slots = self.slots
+        try:
+            value = slots[ins.sa] + slots[ins.sb]
+        except TypeError:
+            self.check_unset(ins)
+            raise
+        slots[ins.sa] = value if INT_MIN <= value <= INT_MAX else wrap32(value)
+        self.line += 1
+    def handle_sub(self, ins):
+        slots = self.slots
+        try:
+            value = slots[ins.sa] - slots[ins.sb]
+        except TypeError:
+            self.check_unset(ins)
+            raise
+        slots[ins.sa] = value if INT_MIN <= value <= INT_MAX else wrap32(value)
+        self.line += 1
+    def handle_mul(self, ins):
+        slots = self.slots
+        try:
+            value = slots[ins.sa] * slots[ins.sb]
+        except TypeError:
+            self.check_unset(ins)
+            raise
+        slots[ins.sa] = value if INT_MIN <= value <= INT_MAX else wrap32(value)
+        self.line += 1
+    def handle_div(self, ins):
+        slots = self.slots
+        try:
+            value = slots[ins.sa] // slots[ins.sb]
+        except TypeError:
+            self.check_unset(ins)
+            raise
+        slots[ins.sa] = value if INT_MIN <= value <= INT_MAX else wrap32(value)
+        self.line += 1
+    def handle_set(self, ins):
+        slots = self.slots
+        value = slots[ins.sb]
+        if value is UNSET:
+            self.check_unset(ins)
+        slots[ins.sa] = value
+        self.line += 1
+
+    def format_say(self, ins):
+        slots = self.slots
+        template, say_slots = ins.template
+        values = [slots[slot] for slot in say_slots]
+        if UNSET not in values:
+            return template.format(*values)
         final_text = ""
-        for i in range(len(text)):
-            if text[i].startswith("VAR:"):
-                var_name = text[i][len("VAR:"):]
-                if var_name in self.VARIABLE:
-                    final_text += str(self.VARIABLE.get(var_name, f"ERROR NOT FOUND {var_name}"))
-                else:
-                    final_text += str(self.REGISTERS.get(var_name, f"ERROR NOT FOUND {var_name}"))
+        for slot, text in ins.slot_parts:
+            if slot is None:
+                final_text += text
+            elif slots[slot] is UNSET:
+                final_text += f"ERROR NOT FOUND {text}"
             else:
-                final_text += text[i]
+                final_text += str(slots[slot])
+        return final_text
+
+    def handle_say(self, ins, return_text=False):
+        self.line += 1
+        final_text = self.format_say(ins)
         if return_text:
             return final_text
         else:
-            print(final_text)
-    def handle_goto(self, line):
-        _, label = line.split()
-        label = label.replace(":", "")
-        if label in self.labels:
-            self.line = self.labels[label]+1
+            self.output.write(final_text)
+    def handle_show(self, ins):
+        value = self.slots[ins.sa]
+        if value is UNSET:
+            self.check_unset(ins)
+        self.line += 1
+        self.output.write(f": {value}")
+    def handle_goto(self, ins):
+        self.ticks += 1
+        if self._minecraft_tick and self.ticks >= self._next_pace:
+            self.pace()
+        if ins.target is not None:
+            self.line = ins.target+1
         else:
             raise AssertionError("Label not found")
-    def handle_tag(self, line):
-        _, label = line.split()
-        label = label.replace(":", "")
-        self.target = label
-    def handle_slf(self, line):
+    def handle_tag(self, ins):
+        self.target = ins.label
+        self.line += 1
+    def handle_slf(self, ins):
         self.STACK.append(self.line+2)
-    def handle_call(self, line):
+        self.line += 1
+    def handle_call(self, ins):
+        self.ticks += 1
+        if self._minecraft_tick and self.ticks >= self._next_pace:
+            self.pace()
         if self.target in self.labels:
             self.line = self.labels[self.target]+1
         else:
-            raise AssertionError(f"Label {self.target} not found on line :\n{line}\n list of labels: {self.labels}")
-    def handle_ret(self, line):
+            raise AssertionError(f"Label {self.target} not found on line :\n{ins.text}\n list of labels: {self.labels}")
+    def handle_ret(self, ins):
+        self.ticks += 1
+        if self._minecraft_tick and self.ticks >= self._next_pace:
+            self.pace()
         if self.STACK:
             self.line = self.STACK.pop()
         else:
             raise AssertionError("Stack is empty")
-    def handle_if(self, line):
-        _, A, op, B, label = line.split(" ", 4)
-        label = label.replace(":", "")
-        res = None
-        if self.script[self.line+1].startswith("ELSE") and  self.script[self.line+2].startswith("CLR"):
-            # Get value of A
-            if A.startswith("R"):
-                val_A = self.REGISTERS[A]
-            elif A.startswith("#"):
-                val_A = int(A.replace("#", ""))
+    def handle_if(self, ins):
+        self.ticks += 2
+        if self._minecraft_tick and self.ticks >= self._next_pace:
+            self.pace()
+        if ins.error:
+            raise AssertionError(ins.error)
+        a = self.slots[ins.sa]
+        b = self.slots[ins.sb]
+        if a is UNSET or b is UNSET:
+            self.check_unset(ins)
+        res = COMPARE[ins.cmp](a, b)
+        if res:
+            if ins.target is not None:
+                self.line = ins.target + 1
             else:
-                val_A = self.VARIABLE[A]
-            
-            # Get value of B
-            if B.startswith("R"):
-                val_B = self.REGISTERS[B]
-            elif B.startswith("#"):
-                val_B = int(B.replace("#", ""))
-            else:
-                val_B = self.VARIABLE[B]
-            
-            # Perform comparison
-            if op == "=":
-                res = val_A == val_B
-            elif op == "!=":
-                res = val_A != val_B
-            elif op == "<":
-                res = val_A < val_B
-            elif op == "<=":
-                res = val_A <= val_B
-            elif op == ">":
-                res = val_A > val_B
-            elif op == ">=":
-                res = val_A >= val_B
-
-            if res:
-                if self.labels.get(label):
-                    self.line = self.labels[label] + 1
-                else:
-                    raise AssertionError(f"Label not found: {label} in IF line {self.line}")
-            else:
-                self.line += 3
+                raise AssertionError(f"Label not found: {ins.label} in IF line {self.line}")
         else:
-            if not self.script[self.line+1].startswith("ELSE"):
-                raise AssertionError("ELSE not found after IF")
-            else:
-                raise AssertionError("CLR not found after ELSE")
-    def handle_var(self,line):
-        _, var = line.split()
-        self.VARIABLE[var] = None
-        
+            self.line += 3
+    def handle_var(self, ins):
+        self.slots[ins.sa] = None
+        self.line += 1
+    def handle_cmd(self, ins):
+        # Ignore CMD in emulator
+        self.line += 1
+    def handle_nop(self, ins):
+        self.line += 1
+    handle_else = handle_nop
+    handle_clr = handle_nop
+    def handle_label(self, ins):
+        # Falling through into a label ends the program
+        self.end = True
+    def handle_unknown(self, ins):
+        raise AssertionError(f"Unknown command: {ins.text} at line {self.line}")
+
 
 import argparse
+import json
+import sys
 
 def main():
     parser = argparse.ArgumentParser(description="Assembly Emulator")
     parser.add_argument("--input", required=True, help="Input .asm file")
     parser.add_argument("--registers", type=int, default=8, help="Number of registers")
+    parser.add_argument("--minecraft-tick", action="store_true", help="Pace execution to 20 game ticks per second")
+    parser.add_argument("--ticks", action="store_true", help="Print the number of game ticks used")
+    parser.add_argument("--compiled", action="store_true", help="Compile basic blocks to Python before running")
+    parser.add_argument("--profile", choices=["text", "json", "collapsed"], help="Profile the run and write a report")
+    parser.add_argument("--profile-output", default="-", help="Profile report file (default: stdout)")
+    parser.add_argument("--source-map", help="Source map written by asm_precompiler.py --source-map")
+    parser.add_argument("--max-instructions", type=int, help="Stop after executing this many instructions")
+    parser.add_argument("--max-ticks", type=int, help="Stop once this many game ticks have been used")
+    parser.add_argument("--max-seconds", type=float, help="Stop after this much wall-clock time")
+    parser.add_argument("--output", help="Write SAY/SHOW output to this file instead of stdout")
+    parser.add_argument("--quiet", action="store_true", help="Discard SAY/SHOW output")
     args = parser.parse_args()
 
-    emulator = Emulator(args.registers)
+    source_map = None
+    if args.source_map:
+        with open(args.source_map, "r") as f:
+            source_map = json.load(f)
+    output_file = open(args.output, "w") if args.output and not args.quiet else None
+    output = NullSink() if args.quiet else FileSink(output_file)
+    emulator = Emulator(args.registers, minecraft_tick=args.minecraft_tick, compiled=args.compiled,
+                        profile=bool(args.profile), source_map=source_map,
+                        max_instructions=args.max_instructions, max_ticks=args.max_ticks,
+                        max_seconds=args.max_seconds, output=output)
     with open(args.input, "r") as f:
         script = f.read()
-    emulator.execute_script(script)
+    result = emulator.execute_script(script, raise_errors=False)
+    if output_file is not None:
+        output_file.close()
+    if args.ticks:
+        print(f"Ticks: {emulator.ticks}")
+    if args.profile:
+        emulator.profiler.save(args.profile_output, args.profile)
+    if result.status == "exhausted":
+        print(f"Stopped: {result.exhausted} budget exhausted at line {result.line} "
+              f"after {result.instructions} instructions, {result.ticks} ticks")
+        sys.exit(2)
+    if result.status == "error":
+        print(f"Error at line {result.line}: {result.error}")
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
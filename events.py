@@ -0,0 +1,20 @@
+class EventSource:
+    """Structured events for tools, instead of parsing printed output.
+
+    ``subscribe(callback)`` registers ``callback(kind, data)`` where ``data``
+    is a dict of the event's fields. Callers check ``self.listeners`` before
+    building an event, so there is no cost without subscribers.
+    """
+    def __init__(self):
+        self.listeners = []
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self.listeners.remove(callback)
+
+    def notify(self, kind, **data):
+        for callback in self.listeners:
+            callback(kind, data)
@@ -0,0 +1,426 @@
+import argparse
+import json
+import re
+import sys
+
+# Where component.memory_setup / AssemblerCompiler.setup_memory put the
+# impulse blocks that start the memory setup and the program
+SETUP_ORIGIN = (0, 0, 0)
+PROGRAM_ORIGIN = (5, 0, 1)
+
+FACING = {
+    "south": (0, 0, 1),
+    "north": (0, 0, -1),
+    "east": (1, 0, 0),
+    "west": (-1, 0, 0),
+    "up": (0, 1, 0),
+    "down": (0, -1, 0),
+}
+
+INT_MIN = -2**31
+
+def wrap32(value):
+    return ((value - INT_MIN) & 0xFFFFFFFF) + INT_MIN
+
+class CommandError(Exception):
+    """A command that would fail in game (unknown objective, missing score...)."""
+
+class Entity:
+    __slots__ = ("tags", "pos")
+
+    def __init__(self, tags, pos):
+        self.tags = tags
+        self.pos = pos
+
+def parse_coordinates(tokens):
+    """Parse ``~dx ~dy ~dz`` (or absolute numbers) into a resolver."""
+    parts = []
+    for token in tokens:
+        if token.startswith("~"):
+            parts.append((True, float(token[1:]) if len(token) > 1 else 0))
+        else:
+            parts.append((False, float(token)))
+    def resolve(pos):
+        return tuple(int(pos[i] + value) if relative else int(value) for i, (relative, value) in enumerate(parts))
+    return resolve
+
+def parse_selector(token):
+    """Return a function giving the entities matched by a target selector."""
+    if token == "@s":
+        return lambda sim, executor: [executor] if executor is not None else []
+    match = re.match(r"@e\[(.*)\]$", token)
+    if not match:
+        raise CommandError(f"Unsupported selector: {token}")
+    tags = [value for key, value in (item.split("=", 1) for item in match.group(1).split(",")) if key == "tag"]
+    if not tags:
+        raise CommandError(f"Unsupported selector: {token}")
+    tag = tags[0]
+    if "limit=1" in match.group(1).split(","):
+        return lambda sim, executor: list(sim.tagged.get(tag, ()))[:1]
+    return lambda sim, executor: list(sim.tagged.get(tag, ()))
+
+def parse_range(text):
+    if ".." in text:
+        low, high = text.split("..")
+        return (int(low) if low else -2**31, int(high) if high else 2**31 - 1)
+    return (int(text), int(text))
+
+SCORE_COMPARE = {
+    "=": lambda a, b: a == b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+def parse_execute(tokens):
+    """Split ``execute`` sub-commands into (kind, argument) steps."""
+    steps = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token in ("as", "at"):
+            steps.append((token, parse_selector(tokens[i + 1])))
+            i += 2
+        elif token == "positioned":
+            steps.append((token, parse_coordinates(tokens[i + 1:i + 4])))
+            i += 4
+        elif token in ("if", "unless") and tokens[i + 1] == "score":
+            holder, objective, op = tokens[i + 2:i + 5]
+            expect = token == "if"
+            if op == "matches":
+                low, high = parse_range(tokens[i + 5])
+                test = (lambda h, o, low, high: lambda sim: (
+                    (h, o) in sim.scores and low <= sim.scores[(h, o)] <= high))(holder, objective, low, high)
+            else:
+                other = (tokens[i + 5], tokens[i + 6])
+                compare = SCORE_COMPARE[op]
+                test = (lambda a, b, compare: lambda sim: (
+                    a in sim.scores and b in sim.scores and compare(sim.scores[a], sim.scores[b])))(
+                    (holder, objective), other, compare)
+            steps.append(("if", (test, expect)))
+            i += 7 if op != "matches" else 6
+        elif token == "run":
+            steps.append(("run", parse_command(" ".join(tokens[i + 1:]))))
+            break
+        else:
+            raise CommandError(f"Unsupported execute sub-command: {token}")
+    return steps
+
+def parse_data(tokens):
+    """The ``data`` commands of the storage call stack: a list of entity positions in storage.
+
+    Paths are ``<list>`` or ``<list>[-1]`` and the only entity field is Pos.
+    """
+    def last(path):
+        return path[:-len("[-1]")] if path.endswith("[-1]") else None
+
+    if tokens[1] == "remove" and tokens[2] == "storage" and last(tokens[4]):
+        key = (tokens[3], last(tokens[4]))
+        def remove(sim, pos, executor):
+            if not sim.storage.get(key):
+                raise CommandError(f"Nothing in storage {key[0]} {key[1]}")
+            sim.storage[key].pop()
+        return remove
+    if tokens[1] == "modify" and tokens[2] == "storage" and tokens[5:8] == ["set", "value", "[]"]:
+        key = (tokens[3], tokens[4])
+        return lambda sim, pos, executor: sim.storage.__setitem__(key, [])
+    if tokens[1] == "modify" and tokens[2] == "storage" and tokens[5:8] == ["append", "from", "entity"] and tokens[9] == "Pos":
+        key, targets = (tokens[3], tokens[4]), parse_selector(tokens[8])
+        def append(sim, pos, executor):
+            entities = targets(sim, executor)
+            if len(entities) != 1:
+                raise CommandError(f"Expected one entity for {tokens[8]}")
+            sim.storage.setdefault(key, []).append(list(entities[0].pos))
+        return append
+    if (tokens[1] == "modify" and tokens[2] == "entity" and tokens[4:8] == ["Pos", "set", "from", "storage"]
+            and last(tokens[9])):
+        targets, key = parse_selector(tokens[3]), (tokens[8], last(tokens[9]))
+        def restore(sim, pos, executor):
+            if not sim.storage.get(key):
+                raise CommandError(f"Nothing in storage {key[0]} {key[1]}")
+            for entity in targets(sim, executor):
+                entity.pos = list(sim.storage[key][-1])
+        return restore
+    raise CommandError(f"Unsupported command: {' '.join(tokens)}")
+
+def parse_command(command):
+    """Parse a command once into a function of (simulator, position, executor)."""
+    command = command.strip().lstrip("/")
+    if not command:
+        return lambda sim, pos, executor: None
+    tokens = command.split()
+    head = tokens[0]
+
+    if head == "scoreboard" and tokens[1] == "objectives" and tokens[2] == "add":
+        name = tokens[3]
+        return lambda sim, pos, executor: sim.objectives.add(name)
+
+    if head == "scoreboard" and tokens[1] == "players":
+        action, holder, objective = tokens[2:5]
+        key = (holder, objective)
+        if action in ("set", "add", "remove"):
+            amount = int(tokens[5])
+            def players(sim, pos, executor):
+                if objective not in sim.objectives:
+                    raise CommandError(f"Unknown objective: {objective}")
+                if action == "set":
+                    sim.scores[key] = wrap32(amount)
+                elif action == "add":
+                    sim.scores[key] = wrap32(sim.scores.get(key, 0) + amount)
+                else:
+                    sim.scores[key] = wrap32(sim.scores.get(key, 0) - amount)
+            return players
+        if action == "operation":
+            op, source = tokens[5], (tokens[6], tokens[7])
+            def operation(sim, pos, executor):
+                if objective not in sim.objectives or source[1] not in sim.objectives:
+                    raise CommandError(f"Unknown objective in: {command}")
+                if source not in sim.scores:
+                    raise CommandError(f"No score for {source[0]} in {source[1]}")
+                a, b = sim.scores.get(key, 0), sim.scores[source]
+                if op == "=":
+                    a = b
+                elif op == "+=":
+                    a = a + b
+                elif op == "-=":
+                    a = a - b
+                elif op == "*=":
+                    a = a * b
+                elif op == "/=":
+                    a = a // b if b != 0 else a
+                elif op == "%=":
+                    a = a % b if b != 0 else a
+                elif op == "<":
+                    a = min(a, b)
+                elif op == ">":
+                    a = max(a, b)
+                else:
+                    raise CommandError(f"Unsupported operation: {op}")
+                sim.scores[key] = wrap32(a)
+            return operation
+
+    if head == "data":
+        return parse_data(tokens)
+
+    if head == "setblock":
+        resolve = parse_coordinates(tokens[1:4])
+        block = tokens[4] if tokens[4].startswith("minecraft:") else f"minecraft:{tokens[4]}"
+        return lambda sim, pos, executor: sim.setblock(resolve(pos), block)
+
+    if head == "execute":
+        steps = parse_execute(tokens[1:])
+        def execute(sim, pos, executor, index=0):
+            while index < len(steps):
+                kind, argument = steps[index]
+                index += 1
+                if kind == "as":
+                    for entity in argument(sim, executor):
+                        execute(sim, pos, entity, index)
+                    return
+                if kind == "at":
+                    for entity in argument(sim, executor):
+                        execute(sim, tuple(entity.pos), executor, index)
+                    return
+                if kind == "positioned":
+                    pos = argument(pos)
+                elif kind == "if":
+                    test, expect = argument
+                    if test(sim) != expect:
+                        return
+                else:
+                    argument(sim, pos, executor)
+        return execute
+
+    if head in ("tp", "teleport"):
+        targets = parse_selector(tokens[1])
+        resolve = parse_coordinates(tokens[2:5])
+        def teleport(sim, pos, executor):
+            # Relative coordinates are taken from the execution position, not the entity
+            for entity in targets(sim, executor):
+                entity.pos = list(resolve(pos))
+        return teleport
+
+    if head == "summon":
+        resolve = parse_coordinates(tokens[2:5])
+        nbt = " ".join(tokens[5:])
+        tags = set(re.findall(r'"([^"]+)"', re.search(r"Tags:\[([^\]]*)\]", nbt).group(1))) if "Tags:" in nbt else set()
+        return lambda sim, pos, executor: sim.summon(tags, resolve(pos))
+
+    if head == "kill":
+        targets = parse_selector(tokens[1])
+        return lambda sim, pos, executor: sim.kill(targets(sim, executor))
+
+    if head == "tellraw":
+        text = command.split(" ", 2)[2]
+        try:
+            component = json.loads(text)
+        except ValueError:
+            component = text
+        return lambda sim, pos, executor: sim.output.append(sim.render(component))
+
+    if head == "say":
+        text = command.split(" ", 1)[1] if len(tokens) > 1 else ""
+        return lambda sim, pos, executor: sim.chat.append(text)
+
+    raise CommandError(f"Unsupported command: {command}")
+
+class GridSimulator:
+    """Execute a compiled command_surface tick by tick.
+
+    Command blocks sit at (row, 0, column) like in export_to_schematic.
+    Placing a redstone block on top of an impulse block powers it, and it
+    runs on the next game tick; every block then passes execution along
+    its facing direction to the chain blocks that follow it in the same
+    tick. Only the commands the compiler and sys_modules emit are
+    understood; anything else is reported in ``failures``.
+    """
+    def __init__(self, command_surface):
+        self.blocks = {(i, 0, j): block for i, j, block in command_surface.blocks()}
+        self.world = {}
+        self.powered = set()
+        self.scheduled = []
+        self.scores = {}
+        self.objectives = set()
+        self.entities = []
+        self.tagged = {}
+        self.storage = {}  # (storage id, path) -> list
+        self.output = []
+        self.chat = []
+        self.failures = []
+        self.commands = 0
+        self.tick = 0
+        self._parsed = {}
+
+    def setblock(self, pos, block):
+        previous = self.world.get(pos)
+        self.world[pos] = block
+        below = (pos[0], pos[1] - 1, pos[2])
+        if block == "minecraft:redstone_block":
+            if previous != block and below not in self.powered:
+                target = self.blocks.get(below)
+                if target is not None and target.type == "":
+                    self.powered.add(below)
+                    self.scheduled.append(below)
+        else:
+            self.powered.discard(below)
+
+    def summon(self, tags, pos):
+        entity = Entity(tags, list(pos))
+        self.entities.append(entity)
+        for tag in tags:
+            self.tagged.setdefault(tag, []).append(entity)
+
+    def kill(self, entities):
+        for entity in entities:
+            if entity in self.entities:
+                self.entities.remove(entity)
+                for tag in entity.tags:
+                    self.tagged[tag].remove(entity)
+
+    def render(self, component):
+        if isinstance(component, str):
+            return component
+        if isinstance(component, list):
+            return "".join(self.render(part) for part in component)
+        text = component.get("text", "")
+        if "score" in component:
+            score = component["score"]
+            value = self.scores.get((score["name"], score["objective"]))
+            text = "" if value is None else str(value)
+        return text + "".join(self.render(part) for part in component.get("extra", []))
+
+    def run_block(self, pos):
+        """Run one command block and every chain block it leads to."""
+        for _ in range(65536):
+            block = self.blocks[pos]
+            command = self._parsed.get(block.command)
+            if command is None:
+                try:
+                    command = parse_command(block.command)
+                except (CommandError, IndexError, ValueError, KeyError, AttributeError) as e:
+                    command = (lambda error: lambda sim, pos, executor: (_ for _ in ()).throw(CommandError(error)))(str(e))
+                self._parsed[block.command] = command
+            self.commands += 1
+            try:
+                command(self, pos, None)
+            except CommandError as e:
+                self.failures.append((self.tick, pos, block.command, str(e)))
+            dx, dy, dz = FACING.get(block.orientation, (0, 0, 1))
+            pos = (pos[0] + dx, pos[1] + dy, pos[2] + dz)
+            following = self.blocks.get(pos)
+            if following is None or following.type != "chain":
+                return
+
+    def run_tick(self):
+        scheduled, self.scheduled = self.scheduled, []
+        for pos in scheduled:
+            self.run_block(pos)
+        self.tick += 1
+
+    def run_until_idle(self, max_ticks):
+        start = self.tick
+        while self.scheduled:
+            if self.tick - start >= max_ticks:
+                return False
+            self.run_tick()
+        return True
+
+    def run(self, max_ticks=1_000_000, setup=SETUP_ORIGIN, start=PROGRAM_ORIGIN):
+        """Run the memory setup, then the program, and report the final state."""
+        completed = True
+        if setup in self.blocks:
+            self.scheduled.append(setup)
+            completed = self.run_until_idle(max_ticks)
+        setup_output = self.output
+        self.output = []
+        start_tick = self.tick
+        if completed:
+            self.scheduled.append(start)
+            completed = self.run_until_idle(max_ticks)
+        # The last tick that ran something is the one the program finished in
+        ticks = max(0, self.tick - start_tick - 1)
+        return {
+            'completed': completed,
+            'ticks': ticks,
+            'commands': self.commands,
+            'registers': {objective: value for (holder, objective), value in self.scores.items() if holder == "REG"},
+            'scores': {f"{holder} {objective}": value for (holder, objective), value in self.scores.items()},
+            'output': self.output,
+            'setup_output': setup_output,
+            'failures': self.failures,
+        }
+
+def simulate_script(script, stack_size=15, regex_size=8, max_ticks=1_000_000, stack_backend="pile"):
+    """Compile an .asm script in memory and run it on the simulator."""
+    import asm_compiler
+    command_surface = asm_compiler.AssemblerCompiler(stack_backend).build_surface(script, stack_size, regex_size)
+    return GridSimulator(command_surface).run(max_ticks=max_ticks)
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate compiled command blocks")
+    parser.add_argument("input", nargs="+", help="Input assembly files (.asm)")
+    parser.add_argument("-s", "--stack-size", type=int, default=15, help="Stack size for memory setup (default: 15)")
+    parser.add_argument("-r", "--register-size", type=int, default=8, help="Number of registers (default: 8)")
+    parser.add_argument("--stack", default="pile", help="Call stack backend, pile or storage (default: pile)")
+    parser.add_argument("--max-ticks", type=int, default=1_000_000, help="Stop after this many game ticks")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print the summary line per file")
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.input:
+        with open(path, "r") as f:
+            script = f.read().splitlines()
+        result = simulate_script(script, args.stack_size, args.register_size, args.max_ticks, args.stack)
+        if not args.quiet:
+            for text in result['output']:
+                print(text)
+            for tick, pos, command, reason in result['failures']:
+                print(f"  tick {tick} at {pos}: {reason}")
+        status = "ok" if result['completed'] and not result['failures'] else "FAILED"
+        print(f"{path}: {status}, {result['ticks']} ticks, {result['commands']} commands")
+        failed = failed or status != "ok"
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+
+# Every non-empty source line becomes exactly one command block
+def is_block_line(line):
+    return bool(line.strip())
+
+class SerpentineLayout:
+    """Closed-form positions of the program's command blocks.
+
+    The chain starts at ``(start_y, start_x)`` and runs south along its
+    row; the last column of each row is a turn slot (a rotation block
+    facing east, then a directional block on the next row), after which the
+    next row runs back the other way. Column 0 and column ``width - 1`` are
+    only ever used for turns, so each row after the first holds
+    ``width - 2`` blocks.
+
+    The first ``skip`` blocks of the chain are the setup (see
+    setup_blocks); block numbers ``n`` in the other methods count program
+    blocks only, so ``position(0)`` is where the program starts.
+
+    Positions are ``(y, x)`` tuples, i.e. (row, column) in command_surface.
+    Nothing here touches the grid.
+    """
+    def __init__(self, start_x, start_y, width=40, skip=0):
+        if not 1 <= start_x <= width - 2:
+            raise ValueError(f"Program start column {start_x} does not fit in a row of {width} blocks")
+        self.chain_x = start_x
+        self.chain_y = start_y
+        self.width = width
+        self.skip = skip
+        self.first_row = width - 1 - start_x
+        self.row_size = width - 2
+        self.start_y, self.start_x = self.position(0)
+
+    def _row(self, m):
+        """Row offset from the chain start and index within that row of chain block m."""
+        if m < self.first_row:
+            return 0, m
+        row, k = divmod(m - self.first_row, self.row_size)
+        return row + 1, k
+
+    def _position(self, m):
+        row, k = self._row(m)
+        if row == 0:
+            return self.chain_y, self.chain_x + k
+        if row % 2:
+            return self.chain_y + row, self.width - 2 - k
+        return self.chain_y + row, 1 + k
+
+    def _turn_after(self, m):
+        row, k = self._row(m)
+        size = self.first_row if row == 0 else self.row_size
+        if k != size - 1:
+            return None
+        if row % 2:
+            return self.chain_y + row, 0, "south"
+        return self.chain_y + row, self.width - 1, "north"
+
+    def position(self, n):
+        """(y, x) of the n-th emitted block."""
+        return self._position(n + self.skip)
+
+    def orientation(self, n):
+        """Facing of the n-th block: south on rows running right, north on the others."""
+        return "north" if self._row(n + self.skip)[0] % 2 else "south"
+
+    def index(self, y, x):
+        """Inverse of position(): which block lands on (y, x)."""
+        row = y - self.chain_y
+        if row == 0:
+            return x - self.chain_x - self.skip
+        k = self.width - 2 - x if row % 2 else x - 1
+        return self.first_row + (row - 1) * self.row_size + k - self.skip
+
+    def offset(self, y, x, steps):
+        """Position ``steps`` blocks after the block at (y, x)."""
+        return self.position(self.index(y, x) + steps)
+
+    def turn_after(self, n):
+        """Turn placed once block n fills its row, else None.
+
+        Returns ``(y, x, orientation)``: the rotation block goes at (y, x),
+        the directional block at (y + 1, x) facing ``orientation``.
+        """
+        return self._turn_after(n + self.skip)
+
+    def blocks(self, count):
+        """Yield ``(y, x, orientation, turn)`` for the first ``count`` blocks.
+
+        Same values as position(), orientation() and turn_after(), walked
+        incrementally.
+        """
+        return self._walk(self.skip, count)
+
+    def setup_blocks(self):
+        """Like blocks(), for the ``skip`` setup blocks before the program."""
+        return self._walk(0, self.skip)
+
+    def _walk(self, first, count):
+        y, x, step, size = self.chain_y, self.chain_x, 1, self.first_row
+        k = 0
+        for m in range(first + count):
+            orientation = "south" if step == 1 else "north"
+            if k == size - 1:
+                turn_x = self.width - 1 if step == 1 else 0
+                if m >= first:
+                    yield y, x, orientation, (y, turn_x, "north" if step == 1 else "south")
+                y, step, size, k = y + 1, -step, self.row_size, 0
+                x = turn_x + step
+            else:
+                if m >= first:
+                    yield y, x, orientation, None
+                x += step
+                k += 1
+
+    def rows_needed(self, count):
+        """Rows command_surface must have to hold ``count`` blocks and their turns."""
+        last = self.skip + count - 1
+        if last < 0:
+            return self.chain_y + 1
+        y, _ = self._position(last)
+        return y + (2 if self._turn_after(last) else 1)
+
+    def label_positions(self, script):
+        """Map every ``:label`` to the position of its block, in one pass."""
+        labels = {}
+        n = 0
+        for line in script:
+            if not is_block_line(line):
+                continue
+            if line.lstrip().startswith(":"):
+                labels[line.split(":")[1].strip()] = self.position(n)
+            n += 1
+        return labels
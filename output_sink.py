@@ -0,0 +1,65 @@
+import sys
+
+class OutputSink:
+    """Collects SAY/SHOW lines and hands them on in batches.
+
+    Lines are buffered and flushed once ``threshold`` lines are pending,
+    when the program ends, or when flush() is called.
+    """
+    def __init__(self, threshold=256):
+        self.threshold = threshold
+        self.buffer = []
+
+    def write(self, text):
+        buffer = self.buffer
+        buffer.append(text)
+        if len(buffer) >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            lines, self.buffer = self.buffer, []
+            self.emit(lines)
+
+    def emit(self, lines):
+        raise NotImplementedError
+
+class FileSink(OutputSink):
+    """Write lines to a file object; ``file=None`` means the current sys.stdout."""
+    def __init__(self, file=None, threshold=256):
+        super().__init__(threshold)
+        self.file = file
+
+    def emit(self, lines):
+        file = self.file if self.file is not None else sys.stdout
+        file.write("\n".join(lines) + "\n")
+        file.flush()
+
+class ListSink(OutputSink):
+    """Keep every line in ``lines``."""
+    def __init__(self):
+        super().__init__(threshold=1)
+        self.lines = []
+
+    def write(self, text):
+        self.lines.append(text)
+
+    def emit(self, lines):
+        self.lines.extend(lines)
+
+class CallbackSink(OutputSink):
+    """Call ``callback(lines)`` with each batch of lines."""
+    def __init__(self, callback, threshold=64):
+        super().__init__(threshold)
+        self.callback = callback
+
+    def emit(self, lines):
+        self.callback(lines)
+
+class NullSink(OutputSink):
+    """Discard all output."""
+    def write(self, text):
+        pass
+
+    def emit(self, lines):
+        pass
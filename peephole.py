@@ -0,0 +1,227 @@
+import argparse
+import sys
+from asm_decoder import Op, Kind, Instruction, decode_line
+from emulator import Emulator, INT_MAX, wrap32
+from output_sink import ListSink
+
+RULES = ("fallthrough-goto", "self-move", "merge-immediate", "redundant-set", "temp-swap")
+
+# Ops that only read or write the slots they name, so known slot values
+# survive them; anything else (jumps, labels, CMD) forgets everything
+STRAIGHT = (Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.SET, Op.VAR, Op.SAY, Op.SHOW, Op.TAG, Op.SLF)
+COMPUTE = (Op.ADD, Op.SUB, Op.MUL, Op.DIV)
+
+def operand_text(operand):
+    kind, value = operand
+    return f"#{value}" if kind is Kind.IMM else value
+
+def is_slot(operand):
+    return operand is not None and operand[0] is not Kind.IMM
+
+def decode(line):
+    try:
+        return decode_line(line)
+    except ValueError:
+        # Left for the compiler to report
+        return Instruction(Op.UNKNOWN, line)
+
+class Peephole:
+    """Local rewrites of an .asm program that save command blocks.
+
+    Every rule keeps the emulator's (and the game's) observable behaviour:
+    output, final registers and variables, and where control goes.
+
+    - ``fallthrough-goto``: ``GOTO :X`` right before ``:X`` drops both when
+      nothing else refers to ``X``. The GOTO alone must stay otherwise,
+      because falling into a label ends the chain.
+    - ``self-move``: drops ``SET x x``.
+    - ``merge-immediate``: folds consecutive immediate ADD/SUB (and a SET
+      followed by them) on one slot into a single instruction, dropping a
+      net ``#0``.
+    - ``redundant-set``: drops a SET whose slot already holds that value
+      within a basic block, like repeated loads of ``SYS.OPR.TEMP``.
+    - ``temp-swap``: ``SET t x / OP t y / SET x t``, the OPR expansion
+      when the result overwrites its first operand, becomes
+      ``OP x y / SET t x``.
+
+    The block after a CALL is never deleted, since it is the return point.
+    Blank lines are dropped; ``origins`` maps every output line to the
+    index of the script line it came from.
+    """
+    def __init__(self, rules=RULES):
+        unknown = [rule for rule in rules if rule not in RULES]
+        if unknown:
+            raise ValueError(f"Unknown peephole rules: {', '.join(unknown)}")
+        self.rules = tuple(rules)
+        self.saved = dict.fromkeys(self.rules, 0)
+        self.before = 0
+        self.after = 0
+        self.origins = []
+
+    def optimize(self, script):
+        """Optimized copy of ``script`` (a list of lines)."""
+        code = [(line, decode(line), index) for index, line in enumerate(script) if line.strip()]
+        self.before = len(code)
+        changed = True
+        while changed:
+            changed = False
+            for rule in self.rules:
+                code, saved = getattr(self, "rule_" + rule.replace("-", "_"))(code)
+                self.saved[rule] += saved
+                changed = changed or saved > 0
+        self.after = len(code)
+        self.origins = [origin for _, _, origin in code]
+        return [line for line, _, _ in code]
+
+    def rewrite(self, entry, op, a, b):
+        """Entry for ``op a b`` replacing ``entry`` (keeps its indentation and origin)."""
+        line, _, origin = entry
+        indent = line[:len(line) - len(line.lstrip())]
+        text = f"{indent}{op.name} {operand_text(a)} {operand_text(b)}"
+        return text, Instruction(op, text, a=a, b=b), origin
+
+    def rule_fallthrough_goto(self, code):
+        references = {}
+        for _, ins, _ in code:
+            if ins.op is Op.GOTO or ins.op is Op.IF or ins.op is Op.TAG:
+                references[ins.label] = references.get(ins.label, 0) + 1
+        out = []
+        saved = 0
+        i = 0
+        while i < len(code):
+            ins = code[i][1]
+            if (ins.op is Op.GOTO and i + 1 < len(code) and code[i + 1][1].op is Op.LABEL
+                    and code[i + 1][1].label == ins.label and references[ins.label] == 1
+                    and not (out and out[-1][1].op is Op.CALL)):
+                i += 2
+                saved += 2
+                continue
+            out.append(code[i])
+            i += 1
+        return out, saved
+
+    def rule_self_move(self, code):
+        out = []
+        for entry in code:
+            ins = entry[1]
+            if (ins.op is Op.SET and is_slot(ins.b) and ins.a == ins.b
+                    and not (out and out[-1][1].op is Op.CALL)):
+                continue
+            out.append(entry)
+        return out, len(code) - len(out)
+
+    def rule_merge_immediate(self, code):
+        out = []
+        for entry in code:
+            ins = entry[1]
+            if ins.op is Op.ADD or ins.op is Op.SUB:
+                if ins.b[0] is Kind.IMM and is_slot(ins.a):
+                    value = ins.b[1] if ins.op is Op.ADD else -ins.b[1]
+                    previous = out[-1][1] if out else None
+                    protected = len(out) > 1 and out[-2][1].op is Op.CALL
+                    if (previous is not None and previous.op in (Op.ADD, Op.SUB, Op.SET)
+                            and previous.a == ins.a and previous.b[0] is Kind.IMM):
+                        if previous.op is Op.SET:
+                            out[-1] = self.rewrite(out[-1], Op.SET, ins.a, (Kind.IMM, wrap32(previous.b[1] + value)))
+                            continue
+                        total = value + (previous.b[1] if previous.op is Op.ADD else -previous.b[1])
+                        if total == 0 and not protected:
+                            out.pop()
+                            continue
+                        if 0 < abs(total) <= INT_MAX:
+                            out[-1] = self.rewrite(out[-1], Op.ADD if total > 0 else Op.SUB, ins.a, (Kind.IMM, abs(total)))
+                            continue
+                    elif value == 0 and not (out and out[-1][1].op is Op.CALL):
+                        continue
+            out.append(entry)
+        return out, len(code) - len(out)
+
+    def rule_redundant_set(self, code):
+        out = []
+        known = {}  # slot operand -> operand it is known to equal
+
+        def forget(slot):
+            known.pop(slot, None)
+            for key in [key for key, value in known.items() if value == slot]:
+                del known[key]
+
+        for entry in code:
+            ins = entry[1]
+            if ins.op is Op.SET and is_slot(ins.a):
+                if known.get(ins.a) == ins.b or (is_slot(ins.b) and known.get(ins.b) == ins.a):
+                    continue
+                forget(ins.a)
+                if ins.a != ins.b:
+                    known[ins.a] = ins.b
+            elif ins.op in COMPUTE or ins.op is Op.VAR:
+                forget(ins.a)
+            elif ins.op not in STRAIGHT:
+                known.clear()
+            out.append(entry)
+        return out, len(code) - len(out)
+
+    def rule_temp_swap(self, code):
+        out = []
+        for entry in code:
+            ins = entry[1]
+            if ins.op is Op.SET and len(out) >= 2 and is_slot(ins.a) and is_slot(ins.b):
+                load, compute = out[-2][1], out[-1][1]
+                temp, target = ins.b, ins.a
+                if (load.op is Op.SET and load.a == temp and load.b == target and target != temp
+                        and compute.op in COMPUTE and compute.a == temp and compute.b != temp):
+                    out[-2] = self.rewrite(out[-2], compute.op, target, compute.b)
+                    out[-1] = self.rewrite(out[-1], Op.SET, temp, target)
+                    continue
+            out.append(entry)
+        return out, len(code) - len(out)
+
+    def report(self):
+        """Blocks saved per rule and in total."""
+        return format_report(self.saved, self.before, self.after)
+
+def format_report(saved, before, after):
+    lines = [f"{rule}: {blocks} blocks" for rule, blocks in saved.items()]
+    fewer = before - after
+    percent = 100 * fewer / before if before else 0
+    lines.append(f"{before} -> {after} blocks ({fewer} saved, {percent:.1f}%)")
+    return "\n".join(lines)
+
+def run_for_check(script, reg_size, max_instructions, ignore=()):
+    emu = Emulator(reg_size, output=ListSink(), max_instructions=max_instructions)
+    result = emu.execute_script(script, raise_errors=False)
+    variables = {name: value for name, value in emu.VARIABLE.items() if name not in ignore}
+    return result.status, emu.output.lines, dict(emu.REGISTERS), variables
+
+def equivalent(original, optimized, reg_size=10, max_instructions=1000000, ignore=()):
+    """Whether both programs give the same status, output, registers and variables in the emulator.
+
+    Variables named in ``ignore`` may end with different values.
+    """
+    return (run_for_check(original, reg_size, max_instructions, ignore)
+            == run_for_check(optimized, reg_size, max_instructions, ignore))
+
+def main():
+    parser = argparse.ArgumentParser(description="Peephole optimizer for .asm programs")
+    parser.add_argument("input", help="Input .asm file")
+    parser.add_argument("-o", "--output", help="Optimized .asm file (default: print it)")
+    parser.add_argument("--rules", default=",".join(RULES), help=f"Comma-separated rules (default: {','.join(RULES)})")
+    parser.add_argument("--verify", action="store_true", help="Check the optimized program in the emulator")
+    parser.add_argument("--registers", type=int, default=10, help="Registers for --verify (default: 10)")
+    args = parser.parse_args()
+
+    with open(args.input, "r") as f:
+        script = f.read().splitlines()
+    optimizer = Peephole([rule for rule in args.rules.split(",") if rule])
+    optimized = optimizer.optimize(script)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("\n".join(optimized) + "\n")
+    else:
+        print("\n".join(optimized))
+    print(optimizer.report(), file=sys.stderr)
+    if args.verify and not equivalent(script, optimized, args.registers):
+        print("Optimized program behaves differently in the emulator", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
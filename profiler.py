@@ -0,0 +1,155 @@
+import json
+from collections import Counter
+from asm_decoder import Op
+
+class Profiler:
+    """Collects per-line, per-label and call-graph statistics for an Emulator.
+
+    Attach it with ``Emulator(..., profile=True)`` (or ``emulator.profiler =
+    Profiler(emulator)``); the emulator then runs a separate profiled loop, so
+    the normal loop carries no profiling code at all.
+
+    Ticks are attributed to the call frame (the label entered by CALL) and
+    the label region (the label last jumped to) that executed them. Stacks
+    are reported as ``main;FUNC;REGION`` for flamegraph tools.
+    """
+    def __init__(self, emulator, source_map=None):
+        self.emulator = emulator
+        self.source_map = source_map
+        self.hits = Counter()
+        self.line_ticks = Counter()
+        self.calls = Counter()
+        self.edges = Counter()
+        self.stack_ticks = Counter()
+        self.stack_hits = Counter()
+        # Each frame is [function, current label region]
+        self.frames = [["main", "main"]]
+        self._key = None
+
+    def stack_key(self):
+        if self._key is None:
+            names = []
+            for function, region in self.frames:
+                names.append(function)
+                if region != function:
+                    names.append(region)
+            self._key = tuple(names)
+        return self._key
+
+    def record(self, ins, line, ticks, next_line):
+        """Account for one executed instruction."""
+        self.hits[line] += 1
+        key = self.stack_key()
+        self.stack_hits[key] += 1
+        if ticks:
+            self.line_ticks[line] += ticks
+            self.stack_ticks[key] += ticks
+        op = ins.op
+        if op is Op.CALL:
+            callee = self.emulator.target
+            self.calls[callee] += 1
+            self.edges[(self.frames[-1][0], callee)] += 1
+            self.frames.append([callee, callee])
+            self._key = None
+        elif op is Op.RET:
+            if len(self.frames) > 1:
+                self.frames.pop()
+            self._key = None
+        elif op is Op.GOTO or (op is Op.IF and ins.target is not None and next_line == ins.target + 1):
+            # A taken IF lands after its label, which can also be the fall-through line
+            self.frames[-1][1] = self.emulator.program[next_line - 1].label
+            self._key = None
+
+    def _inclusive(self, weights):
+        totals = Counter()
+        for key, weight in weights.items():
+            for name in set(key):
+                totals[name] += weight
+        return totals
+
+    def _self(self, weights):
+        totals = Counter()
+        for key, weight in weights.items():
+            totals[key[-1]] += weight
+        return totals
+
+    def source_hits(self):
+        """Hit counts and ticks per original source line, through the precompiler map."""
+        hits = Counter()
+        ticks = Counter()
+        if not self.source_map:
+            return hits, ticks
+        for line, count in self.hits.items():
+            origin = self.source_map[line] if line < len(self.source_map) else None
+            if origin is not None:
+                origin = tuple(origin)
+                hits[origin] += count
+                ticks[origin] += self.line_ticks[line]
+        return hits, ticks
+
+    def to_dict(self):
+        program = self.emulator.program
+        inclusive = self._inclusive(self.stack_ticks)
+        own = self._self(self.stack_ticks)
+        source_hits, source_ticks = self.source_hits()
+        return {
+            'total_ticks': sum(self.stack_ticks.values()),
+            'total_instructions': sum(self.hits.values()),
+            'lines': [
+                {'line': line, 'code': program[line].text.strip(), 'hits': count, 'ticks': self.line_ticks[line]}
+                for line, count in sorted(self.hits.items())
+            ],
+            'labels': [
+                {'label': name, 'inclusive_ticks': inclusive[name], 'self_ticks': own[name], 'calls': self.calls[name]}
+                for name in sorted(inclusive, key=lambda name: -inclusive[name])
+            ],
+            'call_graph': [
+                {'caller': caller, 'callee': callee, 'calls': count}
+                for (caller, callee), count in self.edges.most_common()
+            ],
+            'source_lines': [
+                {'file': origin[0], 'line': origin[1], 'hits': count, 'ticks': source_ticks[origin]}
+                for origin, count in sorted(source_hits.items())
+            ],
+        }
+
+    def to_json(self, indent=2):
+        return json.dumps(self.to_dict(), indent=indent)
+
+    def collapsed(self, weight="ticks"):
+        """Stacks in the collapsed format read by flamegraph.pl / speedscope."""
+        weights = self.stack_ticks if weight == "ticks" else self.stack_hits
+        return "\n".join(f"{';'.join(key)} {count}" for key, count in sorted(weights.items()) if count) + "\n"
+
+    def text_report(self, top=20):
+        data = self.to_dict()
+        lines = [f"Total: {data['total_instructions']} instructions, {data['total_ticks']} ticks", ""]
+        lines.append(f"{'label':<40} {'incl ticks':>10} {'self ticks':>10} {'calls':>6}")
+        for entry in data['labels'][:top]:
+            lines.append(f"{entry['label']:<40} {entry['inclusive_ticks']:>10} {entry['self_ticks']:>10} {entry['calls']:>6}")
+        lines += ["", f"{'line':>6} {'hits':>8} {'ticks':>8}  code"]
+        for entry in sorted(data['lines'], key=lambda entry: (-entry['ticks'], -entry['hits']))[:top]:
+            lines.append(f"{entry['line']:>6} {entry['hits']:>8} {entry['ticks']:>8}  {entry['code']}")
+        if data['source_lines']:
+            lines += ["", f"{'source':<50} {'hits':>8} {'ticks':>8}"]
+            for entry in sorted(data['source_lines'], key=lambda entry: (-entry['ticks'], -entry['hits']))[:top]:
+                location = f"{entry['file']}:{entry['line']}"
+                lines.append(f"{location:<50} {entry['hits']:>8} {entry['ticks']:>8}")
+        if data['call_graph']:
+            lines += ["", "call graph:"]
+            for entry in data['call_graph']:
+                lines.append(f"  {entry['caller']} -> {entry['callee']} ({entry['calls']})")
+        return "\n".join(lines) + "\n"
+
+    def save(self, path, fmt="text"):
+        if fmt == "json":
+            text = self.to_json()
+        elif fmt == "collapsed":
+            text = self.collapsed()
+        else:
+            text = self.text_report()
+        if path in (None, "-"):
+            print(text, end="")
+        else:
+            with open(path, "w") as f:
+                f.write(text)
@@ -0,0 +1,304 @@
+import gzip
+import logging
+import struct
+
+log = logging.getLogger(__name__)
+
+SCHEMATIC_VERSIONS = (2, 3)
+# Minecraft 1.18.2, the version the mcschematic export targeted
+DATA_VERSION = 2975
+AIR = "minecraft:air"
+# Largest structure a structure block loads, per side
+STRUCTURE_MAX_SIZE = 48
+
+# NBT tag ids
+TAG_END, TAG_BYTE, TAG_SHORT, TAG_INT = 0, 1, 2, 3
+TAG_BYTE_ARRAY, TAG_STRING, TAG_LIST, TAG_COMPOUND, TAG_INT_ARRAY = 7, 8, 9, 10, 11
+
+def block_state(command_block):
+    """``(block id, facing, auto)`` of a command block: impulse for type "", chain otherwise."""
+    if command_block.type == "":
+        return "minecraft:command_block", command_block.orientation, 0
+    return "minecraft:chain_command_block", command_block.orientation, 1
+
+def snbt_string(text):
+    """``text`` as a single-quoted SNBT string."""
+    return "'" + text.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def block_string(command_block):
+    """Block state with its NBT, as in a /setblock command or mcschematic.setBlock."""
+    block_id, facing, auto = block_state(command_block)
+    return f"{block_id}[facing={facing}]{{Command:{snbt_string(command_block.command)},auto:{auto},UpdateLastExecution:0b}}"
+
+def varint(value):
+    """Sponge block data encoding: 7 bits per byte, low bits first."""
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+class NBTStream:
+    """Writes big-endian NBT tags to a binary stream as they come.
+
+    Compounds are opened with ``compound`` and closed with ``end``; a
+    list's length and element type are written up front, then its
+    elements follow without names (``compound(None)``). Tags are gathered
+    in a buffer and handed to ``out`` in chunks of ``chunk_size`` bytes,
+    since each write to a gzip stream is costly.
+    """
+    def __init__(self, out, chunk_size=1 << 16):
+        self.out = out
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.headers = {}  # (tag, name) -> encoded tag header
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        self.out.write(self.buffer)
+        self.buffer = bytearray()
+
+    def name(self, tag, name):
+        if name is not None:
+            header = self.headers.get((tag, name))
+            if header is None:
+                encoded = name.encode("utf-8")
+                header = self.headers[tag, name] = struct.pack(">bH", tag, len(encoded)) + encoded
+            self.buffer += header
+
+    def compound(self, name):
+        self.name(TAG_COMPOUND, name)
+
+    def end(self):
+        self.write(b"\x00")
+
+    def byte(self, name, value):
+        self.name(TAG_BYTE, name)
+        self.write(struct.pack(">b", value))
+
+    def short(self, name, value):
+        self.name(TAG_SHORT, name)
+        self.write(struct.pack(">h", value))
+
+    def int(self, name, value):
+        self.name(TAG_INT, name)
+        self.write(struct.pack(">i", value))
+
+    def string(self, name, value):
+        # Java's modified UTF-8 only differs for NUL and astral characters
+        encoded = value.encode("utf-8")
+        self.name(TAG_STRING, name)
+        self.write(struct.pack(">H", len(encoded)) + encoded)
+
+    def byte_array(self, name, data):
+        self.name(TAG_BYTE_ARRAY, name)
+        self.write(struct.pack(">i", len(data)))
+        self.write(data)
+
+    def int_array(self, name, values):
+        self.name(TAG_INT_ARRAY, name)
+        self.write(struct.pack(f">i{len(values)}i", len(values), *values))
+
+    def list(self, name, tag, length):
+        self.name(TAG_LIST, name)
+        self.write(struct.pack(">bi", tag if length else TAG_END, length))
+
+class SchematicWriter:
+    """Writes a command block surface as a Sponge schematic (.schem).
+
+    Blocks sit at (row, 0, column) like in the mcschematic export. The
+    palette holds one entry per (block id, facing), with air as 0, in the
+    order they first appear; the block data is that palette index per
+    cell, varint encoded, ordered by y, then z, then x. Version 2 is the
+    layout mcschematic wrote (WorldEdit 7.2); version 3 is the one
+    WorldEdit 7.3 writes, with the blocks nested under ``Blocks``.
+
+    The NBT goes straight into the gzip stream: no block-state strings
+    are built or parsed and no NBT tree is held in memory.
+    """
+    def __init__(self, version=2, data_version=DATA_VERSION):
+        if version not in SCHEMATIC_VERSIONS:
+            raise ValueError(f"Unsupported Sponge schematic version: {version}")
+        self.version = version
+        self.data_version = data_version
+
+    def write(self, command_block_matrix, filename, on_event=None, origin=(0, 0), crop=True):
+        """Write the schematic to ``filename``; returns the number of blocks.
+
+        ``origin`` is the (row, column) of the matrix in a larger surface it
+        was cut from: it is added to the WorldEdit offset, so every piece
+        pasted from the same spot lands where it was in the whole surface.
+        With ``crop``, the schematic only spans the occupied blocks;
+        otherwise it spans the whole matrix, so its corner is cell (0, 0).
+        """
+        origin_x, origin_z = origin
+        cells = list(command_block_matrix.blocks())
+        if not crop:
+            min_x = min_z = 0
+            width, length = command_block_matrix.rows, command_block_matrix.cols
+        elif cells:
+            min_x = min(i for i, _, _ in cells)
+            min_z = min(j for _, j, _ in cells)
+            width = max(i for i, _, _ in cells) - min_x + 1
+            length = max(j for _, j, _ in cells) - min_z + 1
+        else:
+            min_x = min_z = 0
+            width = length = 1
+
+        palette = {AIR: 0}
+        indexes = {}  # (block id, facing) -> palette index
+        data = bytearray(width * length)
+        for i, j, block in cells:
+            block_id, facing, _ = block_state(block)
+            index = indexes.get((block_id, facing))
+            if index is None:
+                index = indexes[block_id, facing] = len(palette)
+                palette[f"{block_id}[facing={facing}]"] = index
+            data[(j - min_z) * width + (i - min_x)] = index
+        if len(palette) > 0x80:
+            data = b"".join(varint(index) for index in data)
+
+        with gzip.open(filename, "wb") as f:
+            nbt = NBTStream(f)
+            if self.version == 2:
+                nbt.compound("Schematic")
+            else:
+                nbt.compound("")
+                nbt.compound("Schematic")
+            nbt.int("Version", self.version)
+            nbt.int("DataVersion", self.data_version)
+            nbt.compound("Metadata")
+            nbt.int("WEOffsetX", origin_x + min_x)
+            nbt.int("WEOffsetY", 0)
+            nbt.int("WEOffsetZ", origin_z + min_z)
+            nbt.end()
+            nbt.short("Height", 1)
+            nbt.short("Length", length)
+            nbt.short("Width", width)
+            if self.version == 2:
+                nbt.int("PaletteMax", len(palette))
+                self.write_palette(nbt, palette)
+                nbt.byte_array("BlockData", data)
+            else:
+                nbt.int_array("Offset", [0, 0, 0])
+                nbt.compound("Blocks")
+                self.write_palette(nbt, palette)
+                nbt.byte_array("Data", data)
+            nbt.list("BlockEntities", TAG_COMPOUND, len(cells))
+            for i, j, block in cells:
+                self.write_block_entity(nbt, i - min_x, j - min_z, block)
+                if on_event is not None:
+                    on_event("export_block", {"position": (origin_x + i, 0, origin_z + j), "block": block_string(block)})
+            if self.version == 3:
+                nbt.end()
+                nbt.end()
+            nbt.end()
+            nbt.flush()
+        log.info("Schematic with %d blocks saved as %s", len(cells), filename)
+        return len(cells)
+
+    def write_palette(self, nbt, palette):
+        nbt.compound("Palette")
+        for state, index in palette.items():
+            nbt.int(state, index)
+        nbt.end()
+
+    def write_block_entity(self, nbt, x, z, block):
+        block_id, _, auto = block_state(block)
+        nbt.compound(None)
+        if self.version == 2:
+            self.write_command(nbt, block, auto)
+            nbt.int_array("Pos", [x, 0, z])
+            nbt.string("Id", block_id)
+        else:
+            nbt.int_array("Pos", [x, 0, z])
+            nbt.string("Id", block_id)
+            nbt.compound("Data")
+            self.write_command(nbt, block, auto)
+            nbt.end()
+        nbt.end()
+
+    def write_command(self, nbt, block, auto):
+        nbt.string("Command", block.command)
+        nbt.int("auto", auto)
+        nbt.byte("UpdateLastExecution", 0)
+
+class StructureWriter:
+    """Writes a command block surface as a vanilla structure (.nbt).
+
+    The structure covers the whole matrix, rows along x and columns along
+    z, so it loads with a structure block at the position of cell (0, 0).
+    Empty cells are left out and keep whatever is in the world. The game
+    only loads structures up to ``STRUCTURE_MAX_SIZE`` blocks on a side;
+    larger surfaces have to be exported in chunks.
+    """
+    def __init__(self, data_version=DATA_VERSION):
+        self.data_version = data_version
+
+    def write(self, command_block_matrix, filename, on_event=None, origin=(0, 0)):
+        """Write the structure to ``filename``; returns the number of blocks.
+
+        Raises ValueError when the matrix is larger than a structure can be.
+        """
+        rows, cols = command_block_matrix.rows, command_block_matrix.cols
+        if rows > STRUCTURE_MAX_SIZE or cols > STRUCTURE_MAX_SIZE:
+            raise ValueError(f"{rows}x{cols} blocks exceed the {STRUCTURE_MAX_SIZE}-block structure size limit; "
+                             f"export in chunks")
+        origin_x, origin_z = origin
+        cells = list(command_block_matrix.blocks())
+        palette = {}  # (block id, facing) -> palette index
+        for _, _, block in cells:
+            block_id, facing, _ = block_state(block)
+            palette.setdefault((block_id, facing), len(palette))
+
+        with gzip.open(filename, "wb") as f:
+            nbt = NBTStream(f)
+            nbt.compound("")
+            nbt.int("DataVersion", self.data_version)
+            self.write_ints(nbt, "size", [rows, 1, cols])
+            nbt.list("palette", TAG_COMPOUND, len(palette))
+            for block_id, facing in palette:
+                nbt.compound(None)
+                nbt.string("Name", block_id)
+                nbt.compound("Properties")
+                nbt.string("facing", facing)
+                nbt.end()
+                nbt.end()
+            nbt.list("blocks", TAG_COMPOUND, len(cells))
+            for i, j, block in cells:
+                block_id, facing, auto = block_state(block)
+                nbt.compound(None)
+                nbt.int("state", palette[block_id, facing])
+                self.write_ints(nbt, "pos", [i, 0, j])
+                nbt.compound("nbt")
+                nbt.string("id", "minecraft:command_block")
+                nbt.string("Command", block.command)
+                nbt.byte("auto", auto)
+                nbt.byte("UpdateLastExecution", 0)
+                nbt.end()
+                nbt.end()
+                if on_event is not None:
+                    on_event("export_block", {"position": (origin_x + i, 0, origin_z + j), "block": block_string(block)})
+            nbt.list("entities", TAG_COMPOUND, 0)
+            nbt.end()
+            nbt.flush()
+        log.info("Structure with %d blocks saved as %s", len(cells), filename)
+        return len(cells)
+
+    def write_ints(self, nbt, name, values):
+        nbt.list(name, TAG_INT, len(values))
+        for value in values:
+            nbt.int(None, value)
+
+def write_schematic(command_block_matrix, filename, version=2, on_event=None):
+    """Write ``command_block_matrix`` to the .schem file ``filename``; returns the number of blocks."""
+    return SchematicWriter(version).write(command_block_matrix, filename, on_event)
+
+def write_structure(command_block_matrix, filename, on_event=None):
+    """Write ``command_block_matrix`` to the structure file ``filename``; returns the number of blocks."""
+    return StructureWriter().write(command_block_matrix, filename, on_event)
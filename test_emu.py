@@ -1,7 +1,29 @@
+import contextlib
+import io
+import json
+import os
 import random
-from emulator import Emulator
+from emulator import COMPILED_CACHE, COMPILED_CACHE_SIZE, Emulator, wrap32
+from batch_emulator import BatchEmulator
+from debugger import Debugger
+from grid_simulator import GridSimulator, simulate_script
+from output_sink import CallbackSink, ListSink
+from layout import SerpentineLayout
+import asm_compiler
+from asm_precompiler import Precompiler
+from build_cache import BuildCache
+from batch_compile import compile_batch, expand_inputs, format_summary, plan_jobs
+from peephole import Peephole, equivalent
+from dataflow import ControlFlowGraph, Optimizer, SCRATCH
+from datapack import DatapackCompiler, export_datapack
+import component
+import nbtlib
+import schem_writer
+from asm_decoder import Op, decode_line, decode_program
 
 NUM_TESTS = 1000
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_asm", "exponential.asm"), "r") as f:
+    EXPONENTIAL = f.read()
 
 def test_emulator_initialization():
     results = []
@@ -57,6 +79,182 @@ SET R1 #1
     emu.execute_script(script)
     return emu.REGISTERS['R1'] == 0
 
+def test_decoded_program():
+    program = decode_program(EXPONENTIAL)
+    goto = next(ins for ins in program if ins.op is Op.GOTO)
+    assert program[goto.target].op is Op.LABEL
+    assert program[goto.target].label == goto.label
+    emu = Emulator(reg_size=4)
+    emu.execute_script(EXPONENTIAL)
+    assert emu.REGISTERS['R0'] == 3 ** 10
+
+
+def test_slot_views():
+    emu = Emulator(reg_size=2)
+    emu.execute_script("VAR X\nSET X #7\nADD R1 X\nSAY \"{X} {R1} {Y}\"")
+    assert emu.VARIABLE['X'] == 7
+    assert emu.slots[emu.register_slots['R1']] == 7
+    assert 'Y' not in emu.VARIABLE
+    emu.REGISTERS['R0'] = 5
+    state = emu.get_state()
+    assert state['registers'] == {'R0': 5, 'R1': 7}
+    assert state['variables'] == {'X': 7}
+
+def test_undefined_operands():
+    # Names nothing defines fail when the program is loaded
+    for script, name in (("SET R0 R9\nSHOW R0\n", "R9"), ("VAR X\nSET X Y\n", "Y"),
+                         ("VAR X\nIF X = Z :L\nELSE\nCLR\n:L\n", "Z")):
+        for compiled in (False, True):
+            result = Emulator(reg_size=4, compiled=compiled).execute_script(script, raise_errors=False)
+            assert result.status == "error" and result.error.startswith(f"DecodeError: Undefined register or variable {name}")
+    # Names read before the program sets them fail when they are read
+    skip = "IF R0 = #0 :B\nELSE\nCLR\nSET X #1\nGOTO :B\n:B\n"
+    for read in ("SHOW X", "SET Y X", "ADD R1 X", "IF X < #3 :B\nELSE\nCLR"):
+        for compiled in (False, True):
+            emu = Emulator(reg_size=4, compiled=compiled, output=ListSink())
+            result = emu.execute_script(skip + read, raise_errors=False)
+            assert (result.error, result.line, emu.output.lines) == ("KeyError: 'X'", 6, [])
+    emu = Emulator(reg_size=4)
+    emu.VARIABLE['N'] = 3
+    emu.execute_script("SET R0 N\n")
+    assert emu.REGISTERS['R0'] == 3
+
+
+def test_virtual_ticks():
+    emu = Emulator(reg_size=4)
+    emu.execute_script(EXPONENTIAL)
+    # CALL + RET, 9 IFs and 9 GOTOs (including the one into the loop)
+    assert emu.ticks == 2 + 9 * 2 + 9
+    assert emu.get_state()['ticks'] == emu.ticks
+
+
+def test_batch_matches_emulator():
+    script = EXPONENTIAL.replace("SET R0, #3\n", "").replace("SET R1, #10\n", "")
+    bases, exponents = [], []
+    for base in range(-3, 13):
+        for exponent in range(2, 10):
+            bases.append(base)
+            exponents.append(exponent)
+    batch = BatchEmulator(reg_size=4, lanes=len(bases))
+    batch.execute_script(script, {"R0": bases, "R1": exponents})
+    for lane, state in enumerate(batch.results()):
+        emu = Emulator(reg_size=4)
+        emu.REGISTERS['R0'] = bases[lane]
+        emu.REGISTERS['R1'] = exponents[lane]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            emu.execute_script(script)
+        assert state['registers'] == emu.REGISTERS
+        assert state['output'] == output.getvalue().splitlines()
+        assert state['ticks'] == emu.ticks
+        assert state['error'] is None
+    assert batch.lane_state(bases.index(12) + 7)['registers']['R0'] == wrap32(12 ** 9)
+
+def test_batch_undefined_slots():
+    # Lanes with R0 <= 0 use a declared (None) variable, the lane with R0 = 2 reads Y before setting it
+    script = ("IF R0 > #0 :A\nELSE\nCLR\nVAR X\nGOTO :B\n:A\nSET X R0\nGOTO :B\n:B\nSHOW X\n"
+              "IF X = #2 :C\nELSE\nCLR\nSET Y R0\nGOTO :C\n:C\nSHOW Y\nIF R0 < #0 :D\nELSE\nCLR\nADD X #1\nGOTO :D\n"
+              ":D\nIF X > Y :E\nELSE\nCLR\n:E\nSHOW X\n")
+    inputs = [-1, 0, 1, 2, 3]
+    batch = BatchEmulator(reg_size=4, lanes=len(inputs))
+    batch.execute_script(script, {"R0": inputs})
+    for lane, value in enumerate(inputs):
+        emu = Emulator(reg_size=4, output=ListSink())
+        emu.REGISTERS['R0'] = value
+        result = emu.execute_script(script, raise_errors=False)
+        state = batch.lane_state(lane)
+        assert (state['error'], state['output']) == (result.error, emu.output.lines)
+        assert (state['registers'], state['variables']) == (dict(emu.REGISTERS), dict(emu.VARIABLE))
+        assert (state['instructions'], state['ticks']) == (result.instructions, result.ticks)
+    assert [batch.lane_state(lane)['error'] for lane in range(len(inputs))] == [
+        "TypeError: '>' not supported between instances of 'NoneType' and 'int'",
+        "TypeError: unsupported operand type(s) for +: 'NoneType' and 'int'",
+        None, "KeyError: 'Y'", None]
+
+def test_batch_budget():
+    # Lanes with R0 > 0 never stop; they must not hold up the others
+    script = "IF R0 > #0 :L\nELSE\nCLR\nGOTO :E\n:L\nADD R0 #1\nGOTO :L\n:E\n"
+    inputs = [0, 1, -2, 5]
+    batch = BatchEmulator(reg_size=4, lanes=len(inputs), max_instructions=1000)
+    batch.execute_script(script, {"R0": inputs})
+    for lane, value in enumerate(inputs):
+        emu = Emulator(reg_size=4, max_instructions=1000)
+        emu.REGISTERS['R0'] = value
+        result = emu.execute_script(script)
+        state = batch.lane_state(lane)
+        assert (state['exhausted'], state['instructions'], state['ticks']) == (result.exhausted, result.instructions, result.ticks)
+        assert state['registers'] == dict(emu.REGISTERS) and state['error'] is None
+    assert [batch.lane_state(lane)['exhausted'] for lane in range(len(inputs))] == [None, "instructions", None, "instructions"]
+    batch = BatchEmulator(reg_size=4, lanes=len(inputs), max_ticks=100)
+    batch.execute_script(script, {"R0": inputs})
+    assert all(state['exhausted'] == "ticks" and state['ticks'] >= 100 for state in batch.results() if state['registers']['R0'] > 0)
+
+
+def test_compiled_matches_interpreter():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_asm", "test_complex.asm"), "r") as f:
+        script = f.read()
+    states = []
+    for compiled in (False, True):
+        emu = Emulator(reg_size=8, compiled=compiled)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            emu.execute_script(script)
+        states.append((emu.get_state(), output.getvalue()))
+    assert states[0] == states[1]
+
+def test_compiled_errors_and_cache():
+    # An error inside a basic block is reported at its own line, not the block's first
+    script = "SET R0 #1\nSET R1 #0\nDIV R0 R1\nSET R2 #3\n"
+    results = [Emulator(reg_size=4, compiled=compiled).execute_script(script, raise_errors=False)
+               for compiled in (False, True)]
+    assert [(r.status, r.line, r.instructions) for r in results] == [("error", 2, 3)] * 2
+    for value in range(COMPILED_CACHE_SIZE + 8):
+        Emulator(reg_size=4, compiled=True).execute_script(f"SET R0 #{value}\n")
+    assert len(COMPILED_CACHE) == COMPILED_CACHE_SIZE
+
+
+def test_profiler():
+    emu = Emulator(reg_size=4, profile=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        emu.execute_script(EXPONENTIAL)
+    collapsed = dict(line.rsplit(" ", 1) for line in emu.profiler.collapsed().splitlines())
+    assert sum(int(weight) for weight in collapsed.values()) == emu.ticks
+    assert "main;POWER_FUNC;POWER_LOOP" in collapsed
+    data = emu.profiler.to_dict()
+    assert data['call_graph'] == [{'caller': 'main', 'callee': 'POWER_FUNC', 'calls': 1}]
+    loop = next(entry for entry in data['labels'] if entry['label'] == 'POWER_LOOP')
+    assert loop['inclusive_ticks'] == int(collapsed["main;POWER_FUNC;POWER_LOOP"])
+    # IFs that jump to the label right after their CLR enter its region
+    emu = Emulator(reg_size=4, profile=True)
+    emu.execute_script("SET R0 #0\nIF R0 = #0 :X\nELSE\nCLR\n:X\nADD R0 #1\nIF R0 < #3 :X\nELSE\nCLR\n")
+    assert emu.REGISTERS['R0'] == 3
+    assert emu.profiler.stack_key() == ("main", "X")
+    assert emu.profiler.collapsed() == "main 2\nmain;X 6\n"
+
+
+def test_debugger_history():
+    debugger = Debugger(reg_size=4, snapshot_interval=4, max_snapshots=3)
+    debugger.load_script(EXPONENTIAL)
+    states = []
+    while not debugger.end:
+        states.append(debugger.get_state())
+        debugger.step()
+    final = debugger.get_state()
+    # Only the last few snapshots are kept
+    assert len(debugger.snapshots) == 3
+    assert not debugger.goto_step(0)
+    oldest = debugger.snapshots[0][0]
+    for step in (len(states) - 1, len(states) - 5, oldest):
+        assert debugger.goto_step(step)
+        assert debugger.get_state() == states[step]
+    assert debugger.goto_step(len(states))
+    assert debugger.get_state() == final
+    assert debugger.run_back_to_write('R1')
+    assert debugger.program[debugger.line].text == "SUB R1, #1"
+    assert debugger.get_state() == states[debugger.step_count]
+    assert debugger.step_back()
+    assert debugger.get_state() == states[debugger.step_count]
+
 
 def show_results(results):
     op_results = {"add": [], "sub": [], "mul": [], "div": [], "goto": []}
@@ -70,6 +268,277 @@ def show_results(results):
         op_passed = sum(op_results[op])
         print(f"{op.upper()} - Tests: {op_total}, Passed: {op_passed}, Accuracy: {op_passed/op_total:.2%}")
 
+def test_budget():
+    loop = "GOTO LOOP\n:LOOP\nGOTO LOOP\n"
+    for compiled in (False, True):
+        result = Emulator(reg_size=4, compiled=compiled, max_instructions=10000, budget_chunk=64).execute_script(loop)
+        assert result.status == "exhausted" and result.exhausted == "instructions"
+        assert result.instructions == 10000
+    result = Emulator(reg_size=4, max_ticks=500).execute_script(loop)
+    assert result.exhausted == "ticks" and result.ticks >= 500
+    assert Emulator(reg_size=4, max_seconds=0.05).execute_script(loop).exhausted == "time"
+    result = Emulator(reg_size=4).execute_script("SET R0 #1\nDIV R0 R1\n", raise_errors=False)
+    assert result.status == "error" and result.line == 1
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert Emulator(reg_size=8).execute_script(EXPONENTIAL).completed
+
+def test_malformed_program():
+    for line in ("IF R0 ~ #1 :X", "SET R0", "SET R0 #abc", "SAY hello"):
+        for compiled in (False, True):
+            result = Emulator(reg_size=4, compiled=compiled).execute_script(f"SET R1 #1\n{line}\n", raise_errors=False)
+            assert result.status == "error" and result.line == 1 and line in result.error
+
+def test_output_sinks():
+    script = 'VAR X\nSET R0 #7\nSAY "R0={R0} X={X} Y={Y}!"\nSHOW R0\n'
+    sink = ListSink()
+    Emulator(reg_size=4, output=sink).execute_script(script)
+    assert sink.lines == ["R0=7 X=None Y=ERROR NOT FOUND Y!", ": 7"]
+    batches = []
+    emu = Emulator(reg_size=4, output=CallbackSink(batches.append, threshold=2))
+    emu.execute_script('SAY "a"\nSAY "b"\nSAY "c"\n')
+    assert batches == [["a", "b"], ["c"]]
+
+def test_grid_simulator_matches_emulator():
+    result = simulate_script(EXPONENTIAL.splitlines())
+    assert result['completed'] and not result['failures']
+    assert result['registers']['R0'] == 59049
+    emu = Emulator(reg_size=8)
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        emu.execute_script(EXPONENTIAL)
+    assert result['output'] == out.getvalue().splitlines()
+
+def test_layout_matches_compiler():
+    script = [line for line in EXPONENTIAL.splitlines() if line.strip()] * 4
+    with contextlib.redirect_stdout(io.StringIO()):
+        surface = asm_compiler.AssemblerCompiler().build_surface(script)
+    layout = SerpentineLayout(18, 5)
+    for n in range(len(script)):
+        y, x = layout.position(n)
+        assert layout.index(y, x) == n
+        assert surface[y, x].source_line == n + 1
+        assert surface[y, x].orientation == layout.orientation(n)
+    assert surface.rows == layout.rows_needed(len(script))
+    walked = [(layout.position(n), layout.orientation(n), layout.turn_after(n)) for n in range(len(script))]
+    assert [((y, x), orientation, turn) for y, x, orientation, turn in layout.blocks(len(script))] == walked
+
+def test_compiler_events(capsys):
+    compiler = asm_compiler.AssemblerCompiler()
+    events = []
+    compiler.subscribe(lambda kind, data: events.append((kind, data)))
+    script = EXPONENTIAL.splitlines()
+    surface = compiler.build_surface(script)
+    assert capsys.readouterr().out == ""
+    kinds = [kind for kind, data in events]
+    assert kinds.count("block") == sum(1 for line in script if line.strip())
+    assert kinds.count("wrap") == 1 and kinds[-1] == "done"
+    labels = {data["label"]: (data["y"], data["x"]) for kind, data in events if kind == "label"}
+    assert labels == compiler.goto
+    for kind, data in events:
+        if kind == "block":
+            assert surface[data["y"], data["x"]].command == data["command"]
+
+def test_build_cache(tmp_path):
+    cache = BuildCache(str(tmp_path / "cache"))
+    (tmp_path / "MATH.sasm").write_text("SET R1 #2\nEND\n")
+    (tmp_path / "main.sasm").write_text("IMPORT MATH\nSHOW R1\n")
+    main, output = str(tmp_path / "main.sasm"), str(tmp_path / "main.asm")
+    text = Precompiler(cache=cache).precompile(main, output)
+    os.remove(output)
+    precompiler = Precompiler(cache=cache)
+    assert precompiler.precompile(main, output) == text == open(output).read()
+    assert precompiler.source_map[-2] == (str(tmp_path / "MATH.sasm"), 1)
+    (tmp_path / "MATH.sasm").write_text("SET R1 #3\nEND\n")  # an imported module changed
+    assert "#3" in Precompiler(cache=cache).precompile(main, output)
+
+    events = []
+    compiler = asm_compiler.AssemblerCompiler()
+    assert compiler.compile_script(EXPONENTIAL.splitlines(), str(tmp_path / "a.schem"), cache=cache)
+    compiler.subscribe(lambda kind, data: events.append(kind))
+    assert compiler.compile_script(EXPONENTIAL.splitlines(), str(tmp_path / "b.schem"), cache=cache)
+    assert "done" not in events
+    assert open(tmp_path / "a.schem", "rb").read() == open(tmp_path / "b.schem", "rb").read()
+
+    cache.max_bytes = 0
+    cache.evict()
+    assert cache.entries() == []
+
+def test_build_cache_shared(tmp_path, monkeypatch):
+    cache = BuildCache(str(tmp_path / "cache"), max_bytes=1000)
+    listdir = os.listdir
+    listed = []
+    monkeypatch.setattr(os, "listdir", lambda path: listed.append(path) or listdir(path))
+    # The directory is counted once; stores under the limit and hits do not list it
+    for n in range(5):
+        cache.store(cache.key(n), ".txt", data=b"x" * 100)
+    assert cache.read(cache.key(0), ".txt") == b"x" * 100
+    assert len(listed) == 1
+    cache.store(cache.key(5), ".txt", data=b"y" * 600)
+    assert cache.read(cache.key(1), ".txt") is None and cache.read(cache.key(0), ".txt") is not None
+    # Files another process evicted since the directory was listed are skipped
+    gone = os.path.basename(cache.path(cache.key("gone"), ".txt"))
+    monkeypatch.setattr(os, "listdir", lambda path: listdir(path) + [gone])
+    assert len(cache.entries()) == 5
+    cache.clear()
+    assert cache.entries() == []
+    assert not cache.fetch(cache.key(0), ".txt", str(tmp_path / "out.txt"))
+
+def test_batch_compile(tmp_path):
+    (tmp_path / "bad.asm").write_text("GOTO :NOWHERE\n")
+    programs = expand_inputs([os.path.join(os.path.dirname(__file__), "test_asm", "exponential*.asm"),
+                              str(tmp_path / "*.asm")])
+    results = compile_batch(plan_jobs(programs, str(tmp_path / "build")), workers=2)
+    assert [result["ok"] for result in results] == [True, True, False]
+    assert "NOWHERE" in results[2]["error"]
+    assert os.path.exists(tmp_path / "build" / "exponential.schem")
+    assert format_summary(results).endswith("3 programs, 2 built, 1 failed")
+
+def test_peephole(tmp_path):
+    optimizer = Peephole()
+    script = ["SET R0 #1", "ADD R0 #2", "SUB R0 #5", "SET R1 R1", "SET SYS.OPR.TEMP R0", "MUL SYS.OPR.TEMP R2",
+              "SET R0 SYS.OPR.TEMP", "GOTO :NEXT", ":NEXT", "SHOW R0", "ADD R1 #3", "SUB R1 #3"]
+    assert optimizer.optimize(script) == ["SET R0 #-2", "MUL R0 R2", "SET SYS.OPR.TEMP R0", "SHOW R0"]
+    assert optimizer.before - optimizer.after == 8 == sum(optimizer.saved.values())
+
+    root = os.path.dirname(__file__)
+    for name in sorted(os.listdir(os.path.join(root, "test_sasm"))):
+        output = str(tmp_path / (name + ".asm"))
+        script = Precompiler().precompile(os.path.join(root, "test_sasm", name), output).splitlines()
+        assert equivalent(script, Peephole().optimize(script), max_instructions=10**7), name
+
+def test_dataflow(tmp_path):
+    script = ["SET R1 #4", "SET R2 R1", "SET R3 R2", "GOTO :LOOP", ":LOOP", "SUB R3 #1", "IF R3 = #0 :DONE", "ELSE", "CLR",
+              "GOTO :LOOP", ":DONE", "SHOW R3", "SET R0 #1", "SET R0 #2", "GOTO :END", "SAY \"after\"", ":END", "SHOW R0"]
+    cfg = ControlFlowGraph([decode_line(line) for line in script])
+    assert len(cfg.blocks) == 6
+    assert cfg.successors[cfg.block_of[13]] == [cfg.block_of[16], cfg.block_of[15]]
+    optimizer = Optimizer()
+    optimized = optimizer.optimize(script)
+    assert "IF R3 != #0 :LOOP" in optimized and "SET R3 #4" in optimized and "SET R0 #1" not in optimized and 'SAY "after"' in optimized
+    assert equivalent(script, optimized, ignore=SCRATCH)
+
+    root = os.path.dirname(__file__)
+    for name in sorted(os.listdir(os.path.join(root, "test_sasm"))):
+        output = str(tmp_path / (name + ".asm"))
+        script = Precompiler().precompile(os.path.join(root, "test_sasm", name), output).splitlines()
+        optimized = Optimizer().optimize(script)
+        assert equivalent(script, optimized, max_instructions=10**7, ignore=SCRATCH), name
+        if name in ("exponential.sasm", "test_screen_draw.sasm"):
+            before = Emulator(10, output=ListSink()).execute_script(script)
+            after = Emulator(10, output=ListSink()).execute_script(optimized)
+            assert len(optimized) < len(Peephole().optimize(script)) and after.ticks < before.ticks
+
+def test_immediate_constants():
+    script = ["SET R0 #7", "MUL R0 #6", "DIV R0 #4", "ADD R0 #-3", "IF R0 = #7 :DONE", "ELSE", "CLR", "SET R1 #1",
+              ":DONE", "SHOW #-3"]
+    assert asm_compiler.constants_needed(script) == [-3, 4, 6, 7]
+    with contextlib.redirect_stdout(io.StringIO()):
+        surface = asm_compiler.AssemblerCompiler().build_surface(script)
+    commands = [block.command for _, _, block in surface.blocks()]
+    assert "/scoreboard players set #-3 CONST -3" in commands
+    assert "/scoreboard players operation REG R0 *= #6 CONST" in commands
+    result = simulate_script(script)
+    assert result['completed'] and not result['failures']
+    assert result['registers']['R0'] == 7 and result['registers']['R1'] == 0
+    assert result['output'] == [": -3"]
+    # More constants than fit on the setup row wrap onto the next rows
+    script = ["SET R0 #0"] + [f"ADD R0 #{-k}" for k in range(1, 61)] + ["SHOW R0", "GOTO :END", ":END"]
+    result = simulate_script(script)
+    assert result['completed'] and not result['failures']
+    assert result['output'] == [": -1830"]
+
+def test_storage_stack():
+    script = ["SET R0 #12", "TAG :DOWN", "SLF", "CALL", "SHOW R1", "GOTO :END", ":DOWN", "IF R0 = #0 :BOTTOM", "ELSE",
+              "CLR", "SUB R0 #1", "TAG :DOWN", "SLF", "CALL", "ADD R1 #1", "RET", ":BOTTOM", "RET", ":END"]
+    pile = simulate_script(script, stack_size=15)
+    storage = simulate_script(script, stack_size=15, stack_backend="storage")
+    deep = simulate_script(script, stack_size=1000, stack_backend="storage")
+    assert pile['output'] == storage['output'] == deep['output'] == [": 12"]
+    assert not storage['failures'] and storage['ticks'] == pile['ticks']
+    assert deep['commands'] == storage['commands'] < pile['commands']
+
+def test_datapack(tmp_path):
+    script = ["SET R0 #3", "GOTO :LOOP", ":LOOP", "SUB R0 #1", "IF R0 > #0 :LOOP", "ELSE", "CLR", "TAG :SHOW", "SLF", "CALL",
+              "GOTO :END", ":SHOW", "SHOW R0", "RET", ":END"]
+    functions = DatapackCompiler().compile(script)
+    assert functions["b0"] == ["# SET R0 #3 (line 1)", "scoreboard players set REG R0 3", "return run function asm:b1"]
+    assert functions["b1"][-2:] == ["execute if score REG R0 > #0 CONST run return run schedule function asm:b1 1t",
+                                    "return run function asm:b2"]
+    assert functions["b2"][-2:] == ['execute unless data storage asm:run stack[14] run data modify storage asm:run stack '
+                                    'append value {"block": "asm:b3"}', "return run function asm:b4"]
+    assert functions["b4"][-1] == "return run function asm:ret with storage asm:run frame"
+    assert functions["ret"] == ["$return run function $(block)"]
+    export_datapack(script, str(tmp_path / "pack"))
+    assert json.load(open(tmp_path / "pack" / "pack.mcmeta"))["pack"]["pack_format"] == 26
+    assert (tmp_path / "pack" / "data" / "asm" / "functions" / "main.mcfunction").read_text().endswith("function asm:b0\n")
+
+def test_schematic_writer(tmp_path):
+    with contextlib.redirect_stdout(io.StringIO()):
+        surface = asm_compiler.AssemblerCompiler().build_surface(EXPONENTIAL.splitlines())
+    assert component.export_to_schematic(surface, str(tmp_path / "native.schem"))
+    component.export_with_mcschematic(surface, str(tmp_path / "mcschematic.schem"))
+    native = nbtlib.load(tmp_path / "native.schem")
+    reference = nbtlib.load(tmp_path / "mcschematic.schem")
+    del reference["Metadata"]["MCSchematicMetadata"]
+    assert native == reference
+    assert list(native["Palette"]) == list(reference["Palette"])
+    schem_writer.write_schematic(surface, tmp_path / "v3.schem", version=3)
+    blocks = nbtlib.load(tmp_path / "v3.schem")["Schematic"]["Blocks"]
+    assert blocks["Data"] == native["BlockData"]
+    assert [entity["Data"]["Command"] for entity in blocks["BlockEntities"]] == [entity["Command"] for entity in native["BlockEntities"]]
+    assert schem_writer.varint(300) == bytes([0xAC, 0x02])
+
+def test_chunked_structure_export(tmp_path):
+    with contextlib.redirect_stdout(io.StringIO()):
+        surface = asm_compiler.AssemblerCompiler().build_surface(EXPONENTIAL.splitlines(), stack_size=3)
+    expected = GridSimulator(surface).run()
+    for export_format in ("nbt", "schem"):
+        path = tmp_path / export_format / "prog.schem"
+        path.parent.mkdir()
+        assert component.export_to_schematic(surface, str(path), export_format=export_format, chunk_size=16)
+        manifest = json.load(open(path.parent / "prog.chunks.json"))
+        assert [chunk["offset"] for chunk in manifest["chunks"]] == [[0, 0, 0], [0, 0, 16], [0, 0, 32]]
+        # Placing every chunk at its offset rebuilds a grid that runs like the original
+        rebuilt = component.CommandSurface(surface.rows, surface.cols)
+        for chunk in manifest["chunks"]:
+            data = nbtlib.load(path.parent / chunk["file"])
+            if export_format == "nbt":
+                assert list(data["size"]) == chunk["size"]
+                palette = [(state["Name"], state["Properties"]["facing"]) for state in data["palette"]]
+                blocks = [(block["pos"], palette[block["state"]], block["nbt"]["Command"]) for block in data["blocks"]]
+            else:
+                assert [data["Width"], data["Height"], data["Length"]] == chunk["size"]
+                assert [data["Metadata"]["WEOffsetX"], 0, data["Metadata"]["WEOffsetZ"]] == chunk["offset"]
+                states = {index: state for state, index in data["Palette"].items()}
+                blocks = []
+                for entity in data["BlockEntities"]:
+                    x, _, z = entity["Pos"]
+                    name, facing = states[data["BlockData"][z * data["Width"] + x]].rstrip("]").split("[facing=")
+                    blocks.append((entity["Pos"], (name, facing), entity["Command"]))
+            for (x, _, z), (name, facing), command in blocks:
+                command_type = "" if name == "minecraft:command_block" else "chain"
+                rebuilt[chunk["offset"][0] + x, chunk["offset"][2] + z] = component.CommandBlock(str(command), command_type, str(facing))
+        result = GridSimulator(rebuilt).run()
+        assert (result["output"], result["registers"]) == (expected["output"], expected["registers"])
+    assert not component.export_to_schematic(component.CommandSurface(49), str(tmp_path / "big.nbt"), export_format="nbt")
+
+def test_delta_export(tmp_path):
+    def build(script):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return asm_compiler.AssemblerCompiler().build_surface(script)
+
+    path = str(tmp_path / "prog.schem")
+    script = EXPONENTIAL.splitlines()
+    first = component.export_delta(build(script), path, (100, 64, 0))
+    assert first["mode"] == "full" and os.path.exists(first["path"])
+    edited = build([line.replace("#1", "#7") for line in script])
+    report = component.export_delta(edited, path, (100, 64, 0))
+    assert (report["mode"], report["added"], report["removed"]) == ("delta", 0, 0) and report["changed"] > 0
+    commands = open(report["path"]).read().splitlines()
+    assert len(commands) == report["changed"]
+    assert all(command.startswith("data merge block 1") or command.startswith("setblock 1") for command in commands)
+    assert component.export_delta(build(["SET R9 #1"] + script), path, (100, 64, 0), max_changed=0.1)["mode"] == "full"
+    assert not os.path.exists(report["path"])
+
 if __name__ == "__main__":
     test_emulator_initialization()
-    print("All tests completed.")
\ No newline at end of file
+    print("All tests completed.")